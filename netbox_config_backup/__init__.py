@@ -22,6 +22,44 @@ class NetboxConfigBackup(PluginConfig):
     default_settings = {
         # Frequency in seconds
         'frequency': 3600,
+        # Run each backup at a fixed offset within the frequency window (derived from its UUID), plus up to `jitter`
+        # seconds of random delay
+        'spread': True,
+        'jitter': 0,
+        # How backups are collected: 'thread' (a pool inside the runner) or 'process' (one fork per device)
+        'executor': 'thread',
+        # Maximum number of backups collected concurrently
+        'workers': 10,
+        # Maximum number of backups collected concurrently per 'site', 'region' or 'platform' (NAPALM driver)
+        'limits': {},
+        # Collected backups are committed together once this many are waiting, or the oldest has waited this long
+        'commit_batch_size': 500,
+        'commit_interval': 60,
+        # Housekeeping deletes finished jobs beyond the newest `retention_jobs` of a backup which are also older than
+        # `retention_days` days (0 disables a limit), optionally counting them into daily rollups first
+        'retention_jobs': 0,
+        'retention_days': 0,
+        'retention_batch_size': 10000,
+        'retention_rollup': False,
+        # NAPALM timeout per device: `timeout_factor` times its smoothed connect/fetch time, within `timeout_min` and
+        # `timeout_max` seconds (None for NAPALM_TIMEOUT); a factor of 0 always uses NAPALM_TIMEOUT
+        'latency_smoothing': 0.3,
+        'timeout_factor': 3,
+        'timeout_min': 10,
+        'timeout_max': None,
+        # After `failure_threshold` connection failures in a row (0 disables) a backup is not retried for
+        # `failure_backoff` seconds, doubling per further failure up to `failure_backoff_max`
+        'failure_threshold': 3,
+        'failure_backoff': 3600,
+        'failure_backoff_max': 86400,
+        # Probe every due device with a TCP connect to `probe_ports` (or the port in its NAPALM arguments) before
+        # collecting, failing the jobs of devices which do not answer within `probe_timeout` seconds
+        'probe': False,
+        'probe_ports': [22, 830],
+        'probe_timeout': 2,
+        'probe_concurrency': 256,
+        # Extra or replacement config save time parsers, {driver: {'running'|'startup': {'marker', 'command', 'regex'}}}
+        'status_parsers': {},
     }
     queues = ['jobs']
     graphql_schema = 'graphql.schema.schema'
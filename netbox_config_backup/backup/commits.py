@@ -0,0 +1,143 @@
+import logging
+import queue
+import time
+import traceback
+
+from django.db import transaction
+from django.utils import timezone
+
+from core.choices import JobStatusChoices
+from netbox import settings
+from netbox_config_backup.models import Backup, BackupCommit, BackupFile, BackupJob, BackupStatus
+
+__all__ = (
+    'CommitCoordinator',
+    'get_coordinator',
+)
+
+
+logger = logging.getLogger("netbox_config_backup")
+
+
+class CommitCoordinator:
+    """
+    Collects the configurations fetched by the collection workers and writes them to the repository as a single
+    commit per batch, so workers never contend for the repository lock.  A batch is flushed when it holds
+    `batch_size` backups or when its oldest entry has been waiting `interval` seconds.
+    """
+
+    def __init__(self, queue, batch_size=500, interval=60):
+        self.queue = queue
+        self.batch_size = max(int(batch_size), 1)
+        self.interval = interval
+        self.batch = {}
+        self.started = None
+
+    def __len__(self):
+        return len(self.batch)
+
+    def __bool__(self):
+        return len(self.batch) > 0
+
+    def add(self, job_pk, backup_pk, configs, files, changes=None):
+        """
+        Queue a collected configuration, along with the times the device reports its files last changed, returning
+        the pks of any jobs it supersedes (which are completed)
+        """
+        if self.started is None:
+            self.started = time.monotonic()
+        previous = self.batch.get(backup_pk)
+        self.batch[backup_pk] = (job_pk, configs, files, changes or {})
+        if previous is None:
+            return []
+        # A newer collection of the same backup supersedes the queued one
+        self.complete_jobs([previous[0]], JobStatusChoices.STATUS_COMPLETED)
+        return [previous[0]]
+
+    def collect(self):
+        """
+        Drain the hand-off queue and flush the batch if it is full or old enough.  Returns the pks of the jobs
+        completed, either by being superseded or by a flush.
+        """
+        finished = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            finished.extend(self.add(*item))
+
+        if self.batch and (len(self.batch) >= self.batch_size or time.monotonic() - self.started >= self.interval):
+            finished.extend(self.flush())
+        return finished
+
+    def flush(self):
+        """
+        Commit the batch and complete (or, if the commit fails, error) its jobs, returning their pks
+        """
+        from netbox_config_backup.git import repository
+
+        if not self.batch:
+            return []
+
+        batch = self.batch
+        self.batch = {}
+        self.started = None
+
+        job_pks = [job_pk for job_pk, _, _, _ in batch.values()]
+        try:
+            backups = Backup.objects.select_related('device').in_bulk(list(batch.keys()))
+            committed = []
+            contents = {}
+            for pk, (job_pk, configs, files, _) in batch.items():
+                backup = backups.get(pk)
+                if backup is None:
+                    continue
+                changed = backup.get_changed_configs(configs, files=files)
+                for file, current in changed.items():
+                    contents[f'{backup.uuid}.{file}'] = current
+                if changed:
+                    committed.append(backup)
+
+            if committed:
+                if len(committed) == 1:
+                    message = committed[0].get_commit_message()
+                else:
+                    lines = '\n'.join(backup.get_commit_message() for backup in committed)
+                    message = f'Backup of {len(committed)} devices\n\n{lines}'
+                commit = repository.commit_files(contents, message)
+                log = next(repository.log(index=commit, depth=1, fields=('sha', 'time', 'changes')))
+                BackupCommit.record(log, backups=committed)
+                logger.info(f'Committed {len(committed)} of {len(batch)} backups as {commit}')
+            BackupFile.record_last_changes({pk: changes for pk, (_, _, _, changes) in batch.items() if pk in backups})
+        except Exception as e:
+            logger.error(f'Unable to commit batch of {len(batch)} backups: {e}')
+            logger.debug(f'\t{traceback.format_exc()}')
+            self.complete_jobs(job_pks, JobStatusChoices.STATUS_ERRORED, error=f'{e}')
+            return job_pks
+
+        self.complete_jobs(job_pks, JobStatusChoices.STATUS_COMPLETED)
+        return job_pks
+
+    @classmethod
+    def complete_jobs(cls, job_pks, status, error=None):
+        jobs = list(BackupJob.objects.filter(pk__in=job_pks))
+        for job in jobs:
+            job.status = status
+            job.completed = timezone.now()
+            if error is not None:
+                if not job.data:
+                    job.data = {}
+                job.data.update({'error': error})
+        with transaction.atomic():
+            BackupJob.objects.bulk_update(jobs, ['status', 'completed', 'data'])
+            BackupStatus.refresh(job.backup_id for job in jobs)
+
+
+def get_coordinator(queue):
+    config = settings.PLUGINS_CONFIG.get('netbox_config_backup', {})
+    return CommitCoordinator(
+        queue=queue,
+        batch_size=config.get('commit_batch_size', 500),
+        interval=config.get('commit_interval', 60),
+    )
@@ -0,0 +1,107 @@
+import logging
+from collections import Counter, deque
+
+from netbox import settings
+
+__all__ = (
+    'Dispatcher',
+    'get_dispatcher',
+)
+
+
+logger = logging.getLogger("netbox_config_backup")
+
+
+def get_scope_keys(job):
+    device = job.backup.device
+    if device is None:
+        return {}
+
+    site = device.site
+    platform = device.platform
+    napalm = getattr(platform, 'napalm', None) if platform is not None else None
+    return {
+        'site': site.pk if site is not None else None,
+        'region': site.region_id if site is not None else None,
+        'platform': napalm.napalm_driver if napalm is not None else None,
+    }
+
+
+class Dispatcher:
+    """
+    Queue of backup jobs waiting for a collection worker.  Jobs are handed out in order, skipping over (but keeping
+    their place for) jobs whose site, region or NAPALM driver already has its configured number of collections in
+    flight.
+    """
+
+    scopes = ('site', 'region', 'platform')
+
+    def __init__(self, limits=None):
+        self.limits = {scope: int(limit) for scope, limit in (limits or {}).items() if scope in self.scopes and limit}
+        self.queue = deque()
+        self.running = {}
+        self.counts = Counter()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __bool__(self):
+        return len(self.queue) > 0
+
+    def __iter__(self):
+        return iter(self.queue)
+
+    def get_keys(self, job):
+        if not self.limits:
+            return []
+        keys = get_scope_keys(job)
+        return [(scope, keys.get(scope)) for scope in self.limits if keys.get(scope) is not None]
+
+    def is_available(self, keys):
+        return all(self.counts[key] < self.limits[key[0]] for key in keys)
+
+    def extend(self, jobs):
+        self.queue.extend(jobs)
+
+    def take(self, count):
+        """
+        Remove up to `count` jobs which may be started right now from the queue and mark them as in flight.
+        """
+        taken = []
+        waiting = deque()
+        while self.queue:
+            job = self.queue.popleft()
+            keys = self.get_keys(job)
+            if len(taken) < count and self.is_available(keys):
+                self.running[job.pk] = keys
+                self.counts.update(keys)
+                taken.append(job)
+            else:
+                waiting.append(job)
+            if len(taken) >= count:
+                waiting.extend(self.queue)
+                self.queue.clear()
+        self.queue = waiting
+        return taken
+
+    def release(self, pk):
+        keys = self.running.pop(pk, [])
+        self.counts.subtract(keys)
+
+    def clear(self):
+        jobs = list(self.queue)
+        self.queue.clear()
+        return jobs
+
+    @property
+    def status(self):
+        return {
+            'queued': len(self.queue),
+            'in_flight': len(self.running),
+            'in_flight_by': {f'{scope}:{value}': count for (scope, value), count in self.counts.items() if count > 0},
+        }
+
+
+def get_dispatcher():
+    limits = settings.PLUGINS_CONFIG.get('netbox_config_backup', {}).get('limits', {})
+    return Dispatcher(limits=limits)
@@ -0,0 +1,173 @@
+import abc
+import logging
+import multiprocessing
+import queue
+from concurrent import futures
+
+from netbox import settings
+from netbox_config_backup.backup.processing import run_backup
+from netbox_config_backup.utils.db import close_db
+
+__all__ = (
+    'ProcessExecutor',
+    'ThreadExecutor',
+    'get_executor',
+)
+
+
+logger = logging.getLogger("netbox_config_backup")
+
+
+class BaseExecutor(abc.ABC):
+    """
+    Runs backup jobs on behalf of the BackupRunner, keeping at most `workers` of them in flight at any one time.
+    Collected configurations are handed back to the runner through `queue`.
+    """
+
+    def __init__(self, workers):
+        self.workers = max(int(workers), 1)
+        self.tasks = {}
+        self.queue = self.get_queue()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    @property
+    def available(self):
+        return max(self.workers - len(self.tasks), 0)
+
+    def get_queue(self):
+        return queue.Queue()
+
+    @abc.abstractmethod
+    def submit(self, job):
+        pass
+
+    @abc.abstractmethod
+    def is_alive(self, pk):
+        pass
+
+    def info(self, pk):
+        return {}
+
+    def reap(self):
+        """
+        Remove finished tasks from the executor and return them as a list of (job pk, info) tuples
+        """
+        finished = []
+        for pk in list(self.tasks.keys()):
+            if not self.is_alive(pk):
+                finished.append((pk, self.info(pk)))
+                self.discard(pk)
+        return finished
+
+    def discard(self, pk):
+        self.tasks.pop(pk, None)
+
+    def terminate(self, pk):
+        self.discard(pk)
+
+    def shutdown(self):
+        for pk in list(self.tasks.keys()):
+            self.terminate(pk)
+
+
+class ProcessExecutor(BaseExecutor):
+    """
+    Forks one child process per backup job.  Each child re-initializes its own database connections.
+    """
+
+    def __init__(self, workers, target):
+        self.target = target
+        self.ctx = multiprocessing.get_context()
+        super().__init__(workers)
+
+    def get_queue(self):
+        return self.ctx.Queue()
+
+    def submit(self, job):
+        close_db()
+        process = self.ctx.Process(
+            target=self.target,
+            args=(job.pk, self.queue),
+        )
+        self.tasks[job.pk] = process
+        process.start()
+        logger.debug(f'Forking process {process.pid} for {job.backup} backup')
+        return process
+
+    def is_alive(self, pk):
+        return self.tasks[pk].is_alive()
+
+    def info(self, pk):
+        process = self.tasks[pk]
+        return {'pid': process.pid, 'exitcode': process.exitcode}
+
+    def terminate(self, pk):
+        process = self.tasks.get(pk)
+        if process is not None:
+            if process.is_alive():
+                process.terminate()
+            try:
+                process.join()
+            except AssertionError:
+                pass
+        super().terminate(pk)
+
+
+class ThreadExecutor(BaseExecutor):
+    """
+    Runs backup jobs on a bounded thread pool inside the runner process, so that collection throughput scales with
+    I/O wait rather than with process count.  Each worker thread uses (and closes) its own database connection.
+    """
+
+    def __init__(self, workers):
+        super().__init__(workers)
+        self.pool = futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='netbox_config_backup')
+
+    @staticmethod
+    def run(pk, commit_queue):
+        try:
+            run_backup(pk, commit_queue=commit_queue)
+        finally:
+            close_db()
+
+    def submit(self, job):
+        future = self.pool.submit(self.run, job.pk, self.queue)
+        self.tasks[job.pk] = future
+        logger.debug(f'Submitted {job.backup} backup to thread pool')
+        return future
+
+    def is_alive(self, pk):
+        return not self.tasks[pk].done()
+
+    def info(self, pk):
+        future = self.tasks[pk]
+        if future.cancelled():
+            return {'error': 'Cancelled'}
+        if future.exception() is not None:
+            return {'error': f'{future.exception()}'}
+        return {}
+
+    def terminate(self, pk):
+        # Running threads cannot be killed, they are only forgotten about; queued ones are cancelled
+        future = self.tasks.get(pk)
+        if future is not None:
+            future.cancel()
+        super().terminate(pk)
+
+    def shutdown(self):
+        super().shutdown()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def get_executor(runner):
+    config = settings.PLUGINS_CONFIG.get('netbox_config_backup', {})
+    executor = config.get('executor', 'thread')
+    workers = config.get('workers', 10)
+
+    if executor == 'process':
+        return ProcessExecutor(workers=workers, target=runner.run_backup)
+    elif executor == 'thread':
+        return ThreadExecutor(workers=workers)
+    raise ValueError(f'Unknown backup executor: {executor}')
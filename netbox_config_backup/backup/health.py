@@ -0,0 +1,126 @@
+import logging
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from netbox import settings
+from netbox_config_backup.models import BackupStatus
+
+__all__ = (
+    'DeviceHealth',
+    'get_health',
+)
+
+
+logger = logging.getLogger("netbox_config_backup")
+
+
+class DeviceHealth:
+    """
+    Keeps smoothed (exponentially weighted) connect and fetch durations per backup on its BackupStatus and derives
+    the NAPALM timeout from them: `timeout_factor` times the slower of the two, within `timeout_min` and
+    `timeout_max` seconds.  Backups without any history use the global NAPALM timeout.  It also acts as a circuit
+    breaker: once a backup has failed `failure_threshold` times in a row it is not retried for `backoff` seconds,
+    doubling with every further failure up to `backoff_max`, and a single success closes it again.
+    """
+
+    def __init__(
+        self,
+        smoothing=0.3,
+        timeout_factor=3,
+        timeout_min=10,
+        timeout_max=60,
+        failure_threshold=3,
+        backoff=3600,
+        backoff_max=86400,
+    ):
+        self.smoothing = min(max(float(smoothing), 0.01), 1)
+        self.timeout_factor = max(float(timeout_factor or 0), 0)
+        self.timeout_min = max(float(timeout_min or 0), 1)
+        self.timeout_max = max(float(timeout_max or 0), self.timeout_min)
+        self.failure_threshold = max(int(failure_threshold or 0), 0)
+        self.backoff = max(float(backoff or 0), 0)
+        self.backoff_max = max(float(backoff_max or 0), self.backoff)
+
+    def smooth(self, previous, value):
+        if previous is None:
+            return value
+        return previous + self.smoothing * (value - previous)
+
+    def get_timeout(self, status):
+        """
+        Timeout in seconds for connecting to and fetching from a backup's device, or None for the global default
+        """
+        if not self.timeout_factor or status is None or status.connect_time is None:
+            return None
+        latency = max(status.connect_time, status.fetch_time or 0)
+        return int(min(max(latency * self.timeout_factor, self.timeout_min), self.timeout_max))
+
+    def get_backoff(self, failures):
+        """
+        How long a backup which has failed `failures` times in a row is left alone, or None if it should be retried
+        on schedule
+        """
+        if not self.failure_threshold or failures < self.failure_threshold:
+            return None
+        exponent = min(failures - self.failure_threshold, 32)
+        return timedelta(seconds=min(self.backoff * 2**exponent, self.backoff_max))
+
+    def get_status(self, backup):
+        status, _ = BackupStatus.objects.select_for_update().get_or_create(backup_id=getattr(backup, 'pk', backup))
+        return status
+
+    def record_success(self, backup, connect_time, fetch_time):
+        with transaction.atomic():
+            status = self.get_status(backup)
+            status.connect_time = self.smooth(status.connect_time, connect_time)
+            status.fetch_time = self.smooth(status.fetch_time, fetch_time)
+            status.failures = 0
+            status.retry_after = None
+            status.save(update_fields=['connect_time', 'fetch_time', 'failures', 'retry_after'])
+        return status
+
+    def record_failure(self, backup, now=None):
+        """
+        Count a failed attempt and return the time before which the backup should not be retried, if any
+        """
+        return self.record_failures([backup], now=now)[getattr(backup, 'pk', backup)]
+
+    def record_failures(self, backups, now=None):
+        """
+        Count a failed attempt for each of the given backups (instances or pks) with one locking select and one bulk
+        update, returning the time before which each backup's pk should not be retried, or None
+        """
+        now = now or timezone.now()
+        pks = {getattr(backup, 'pk', backup) for backup in backups}
+        with transaction.atomic():
+            BackupStatus.objects.bulk_create([BackupStatus(backup_id=pk) for pk in pks], ignore_conflicts=True)
+            statuses = list(BackupStatus.objects.select_for_update().filter(backup_id__in=pks).order_by('pk'))
+            for status in statuses:
+                status.failures += 1
+                backoff = self.get_backoff(status.failures)
+                status.retry_after = now + backoff if backoff else None
+            BackupStatus.objects.bulk_update(statuses, ['failures', 'retry_after'])
+
+        for status in statuses:
+            if status.retry_after:
+                logger.warning(
+                    f'Backup {status.backup_id}: {status.failures} failures in a row, not retrying before '
+                    f'{status.retry_after}'
+                )
+        return {status.backup_id: status.retry_after for status in statuses}
+
+
+def get_health():
+    config = settings.PLUGINS_CONFIG.get('netbox_config_backup', {})
+    napalm_timeout = settings.PLUGINS_CONFIG.get('netbox_napalm_plugin', {}).get('NAPALM_TIMEOUT', None)
+    return DeviceHealth(
+        smoothing=config.get('latency_smoothing', 0.3),
+        timeout_factor=config.get('timeout_factor', 3),
+        timeout_min=config.get('timeout_min', 10),
+        timeout_max=config.get('timeout_max') or napalm_timeout or 60,
+        failure_threshold=config.get('failure_threshold', 3),
+        backoff=config.get('failure_backoff', 3600),
+        backoff_max=config.get('failure_backoff_max', 86400),
+    )
@@ -0,0 +1,269 @@
+import datetime
+import itertools
+import multiprocessing
+import os
+import time
+from collections import deque
+
+from django.db import transaction
+
+from netbox_config_backup.models import (
+    Backup,
+    BackupCommit,
+    BackupCommitTreeChange,
+    BackupFile,
+    BackupObject,
+    BackupStatus,
+)
+from netbox_config_backup.utils.db import close_db
+
+__all__ = ('HistoryIndexer',)
+
+
+LOCAL_TIMEZONE = datetime.datetime.now(datetime.timezone.utc).astimezone().tzinfo
+
+worker_repository = None
+
+
+def init_worker():
+    # Each worker opens its own handle on the repository rather than sharing the parent's pack files
+    global worker_repository
+    from netbox_config_backup.git import GitBackup
+
+    worker_repository = GitBackup()
+
+
+def get_changes(shas):
+    return worker_repository.commits_changes(shas)
+
+
+class HistoryIndexer:
+    """
+    Indexes git log entries into BackupCommit/BackupCommitTreeChange rows.  New rows are written with bulk_create
+    in one transaction per batch of `batch_size` changes.  The backups, files, objects and latest change of each file
+    which a batch refers to are looked up as the batch is written and kept in lookup tables for later batches, so
+    the cost of indexing follows the size of the history being indexed rather than of what is already in the
+    database.  Commits which are already indexed are skipped.
+    """
+
+    def __init__(self, batch_size=5000, output=print):
+        self.batch_size = max(int(batch_size), 1)
+        self.output = output
+
+        self.backups = {}
+        self.files = {}
+        self.file_backups = set()
+        self.objects = {}
+        self.commits = set()
+        self.last_change = {}
+        self.latest = {}
+
+        self.pending = []
+        self.pending_changes = 0
+        self.indexed = {'commits': 0, 'changes': 0}
+        self.started = None
+
+    def add(self, entry):
+        sha = entry.get('sha')
+        if sha in self.commits:
+            return
+        self.commits.add(sha)
+        self.pending.append(entry)
+        self.pending_changes += len(entry.get('changes', []))
+        if self.pending_changes >= self.batch_size:
+            self.flush()
+
+    def index(self, log):
+        self.started = time.monotonic()
+        for entry in log:
+            self.add(entry)
+        self.flush()
+        self.update_files()
+        return self.indexed
+
+    def index_parallel(self, log, workers=None, chunk_size=500):
+        """
+        Index log entries which only carry 'sha' and 'time'.  The commits are read from the log in ranges of
+        `chunk_size` whose tree changes are computed by a pool of `workers` processes, while this process remains the
+        only database writer and adds the results in commit order.
+        """
+        self.started = time.monotonic()
+        log = iter(log)
+
+        # Forked workers must not inherit open database connections, so every worker is started (which
+        # multiprocessing.Pool does up front) before the database is used again
+        close_db()
+        context = multiprocessing.get_context('fork')
+        with context.Pool(processes=workers, initializer=init_worker) as pool:
+            window = (workers or os.cpu_count() or 1) * 2
+            submitted = deque()
+            while chunk := list(itertools.islice(log, chunk_size)):
+                # Already indexed commits are dropped before their changes are computed
+                chunk = self.unindexed(chunk)
+                if not chunk:
+                    continue
+                submitted.append((chunk, pool.apply_async(get_changes, ([entry.get('sha') for entry in chunk],))))
+                while len(submitted) >= window:
+                    self.add_chunk(*submitted.popleft())
+            while submitted:
+                self.add_chunk(*submitted.popleft())
+
+        self.flush()
+        self.update_files()
+        return self.indexed
+
+    def add_chunk(self, chunk, result):
+        for entry, changes in zip(chunk, result.get()):
+            entry['changes'] = changes
+            self.add(entry)
+
+    def unindexed(self, entries):
+        shas = [entry.get('sha') for entry in entries]
+        indexed = set(BackupCommit.objects.filter(sha__in=shas).values_list('sha', flat=True))
+        return [entry for entry in entries if entry.get('sha') not in indexed]
+
+    def load(self, entries):
+        """
+        Fill the lookup tables with the existing backups, objects and files the entries refer to, and the latest
+        change of each of those files
+        """
+        uuids = set()
+        shas = set()
+        for entry in entries:
+            for _, uuid, _, sha in self.iter_files(entry):
+                uuids.add(uuid)
+                shas.add(sha)
+
+        missing = uuids - self.backups.keys()
+        if missing:
+            self.backups.update(
+                (f'{uuid}', pk) for pk, uuid in Backup.objects.filter(uuid__in=missing).values_list('pk', 'uuid')
+            )
+        missing = shas - self.objects.keys()
+        if missing:
+            self.objects.update(BackupObject.objects.filter(sha__in=missing).values_list('sha', 'pk'))
+
+        backups = {self.backups[uuid] for uuid in uuids if uuid in self.backups} - self.file_backups
+        if backups:
+            files = BackupFile.objects.filter(backup_id__in=backups).values_list('pk', 'backup_id', 'type')
+            self.files.update(((backup, type), pk) for pk, backup, type in files)
+            self.last_change.update(
+                BackupCommitTreeChange.objects.filter(backup_id__in=backups)
+                .order_by('file_id', '-commit__time', '-pk')
+                .distinct('file_id')
+                .values_list('file_id', 'pk')
+            )
+            self.file_backups.update(backups)
+
+    @staticmethod
+    def iter_files(entry):
+        """
+        Yield (key, uuid, type, sha) for each side of each change in a log entry
+        """
+        for change in entry.get('changes', []):
+            for key in ['old', 'new']:
+                sha = change.get(key, {}).get('sha', None)
+                file = change.get(key, {}).get('path', None)
+                if sha is not None and file is not None:
+                    uuid, type = file.split('.')
+                    yield key, uuid, type, sha
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        entries = self.unindexed(self.pending)
+        self.pending = []
+        self.pending_changes = 0
+        if not entries:
+            return
+
+        with transaction.atomic():
+            self.load(entries)
+
+            # Create any missing backups, files and objects first, so that every change can be resolved to pks
+            new_backups = {}
+            new_objects = {}
+            for entry in entries:
+                for _, uuid, _, sha in self.iter_files(entry):
+                    if uuid not in self.backups:
+                        new_backups.setdefault(uuid, Backup(uuid=uuid, name=uuid))
+                    if sha not in self.objects:
+                        new_objects.setdefault(sha, BackupObject(sha=sha))
+            for backup in Backup.objects.bulk_create(new_backups.values(), batch_size=self.batch_size):
+                self.backups[f'{backup.uuid}'] = backup.pk
+                self.file_backups.add(backup.pk)
+            for object in BackupObject.objects.bulk_create(new_objects.values(), batch_size=self.batch_size):
+                self.objects[object.sha] = object.pk
+
+            new_files = {}
+            for entry in entries:
+                for _, uuid, type, _ in self.iter_files(entry):
+                    key = (self.backups[uuid], type)
+                    if key not in self.files:
+                        new_files.setdefault(key, BackupFile(backup_id=key[0], type=type))
+            for file in BackupFile.objects.bulk_create(new_files.values(), batch_size=self.batch_size):
+                self.files[(file.backup_id, file.type)] = file.pk
+
+            commits = BackupCommit.objects.bulk_create(
+                [
+                    BackupCommit(
+                        sha=entry.get('sha'),
+                        time=entry.get('time', datetime.datetime.now()).replace(tzinfo=LOCAL_TIMEZONE),
+                    )
+                    for entry in entries
+                ],
+                batch_size=self.batch_size,
+            )
+
+            changes = []
+            for entry, commit in zip(entries, commits):
+                for change in entry.get('changes', []):
+                    backup = None
+                    backupfile = None
+                    change_data = {}
+                    for key, uuid, type, sha in self.iter_files({'changes': [change]}):
+                        backup = self.backups[uuid]
+                        backupfile = self.files[(backup, type)]
+                        change_data[key] = self.objects[sha]
+                    if backup is None:
+                        continue
+
+                    self.latest[backupfile] = change.get('new', {}).get('sha', None)
+                    changes.append(
+                        BackupCommitTreeChange(
+                            backup_id=backup,
+                            file_id=backupfile,
+                            commit_id=commit.pk,
+                            type=change.get('type', None),
+                            old_id=change_data.get('old', None),
+                            new_id=change_data.get('new', None),
+                        )
+                    )
+            BackupCommitTreeChange.objects.bulk_create(changes, batch_size=self.batch_size)
+
+            # Chain each change to the one before it for the same file, now that every change has a pk
+            linked = []
+            for change in changes:
+                change.previous_change_id = self.last_change.get(change.file_id)
+                self.last_change[change.file_id] = change.pk
+                if change.previous_change_id is not None:
+                    linked.append(change)
+            BackupCommitTreeChange.objects.bulk_update(linked, ['previous_change'], batch_size=self.batch_size)
+
+            # Keep the last change shown in (and filtered on by) the backup list in step with the new changes
+            BackupStatus.refresh({change.backup_id for change in changes})
+
+        self.indexed['commits'] += len(entries)
+        self.indexed['changes'] += len(changes)
+        elapsed = max(time.monotonic() - self.started, 0.001)
+        self.output(
+            f'Indexed {self.indexed["commits"]} commits and {self.indexed["changes"]} changes '
+            f'({self.indexed["commits"] / elapsed:.1f} commits/s, {self.indexed["changes"] / elapsed:.1f} changes/s)'
+        )
+
+    def update_files(self):
+        files = list(BackupFile.objects.filter(pk__in=self.latest.keys()))
+        for file in files:
+            file.sha = self.latest[file.pk]
+        BackupFile.objects.bulk_update(files, ['sha'], batch_size=self.batch_size)
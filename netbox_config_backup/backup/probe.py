@@ -0,0 +1,94 @@
+import asyncio
+import logging
+
+from netbox import settings
+
+__all__ = (
+    'Prober',
+    'get_prober',
+)
+
+
+logger = logging.getLogger("netbox_config_backup")
+
+
+def get_target(job, ports):
+    """
+    The address and ports to probe for a job's backup, or None if it has no address (left for run_backup to fail)
+    """
+    backup = job.backup
+    device = backup.device
+    ip = backup.ip if backup.ip is not None else getattr(device, 'primary_ip', None)
+    if ip is None:
+        return None
+
+    # A port set in the platform's NAPALM arguments is the only one worth probing
+    platform = getattr(device, 'platform', None)
+    napalm = getattr(platform, 'napalm', None) if platform is not None else None
+    port = (getattr(napalm, 'napalm_args', None) or {}).get('port') if napalm is not None else None
+    return str(ip.address.ip), [int(port)] if port else ports
+
+
+class Prober:
+    """
+    Checks which devices accept a TCP connection on any of `ports` before NAPALM sessions are opened to them.  All
+    connections are attempted concurrently, at most `concurrency` at a time, each given up after `timeout` seconds,
+    so a cycle's worth of unreachable devices costs seconds rather than a NAPALM timeout each.
+    """
+
+    def __init__(self, enabled=False, ports=(22, 830), timeout=2, concurrency=256):
+        self.enabled = enabled
+        self.ports = [int(port) for port in ports]
+        self.timeout = max(float(timeout), 0.1)
+        self.concurrency = max(int(concurrency), 1)
+
+    async def connect(self, semaphore, host, port):
+        async with semaphore:
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), self.timeout)
+            except (OSError, asyncio.TimeoutError):
+                return False
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+            return True
+
+    async def check(self, targets):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        attempts = [(key, host, port) for key, (host, ports) in targets.items() for port in ports]
+        results = await asyncio.gather(*(self.connect(semaphore, host, port) for _, host, port in attempts))
+        return {key for (key, _, _), reachable in zip(attempts, results) if reachable}
+
+    def probe(self, targets):
+        """
+        Return the keys of `targets`, a dict of key to (host, ports), which accepted a connection on any port
+        """
+        if not targets:
+            return set()
+        return asyncio.run(self.check(targets))
+
+    def split(self, jobs):
+        """
+        Split jobs into those whose device answered (or has no address to probe) and those whose device did not
+        """
+        targets = {}
+        for job in jobs:
+            target = get_target(job, self.ports)
+            if target is not None:
+                targets[job.pk] = target
+        reachable = self.probe(targets)
+        unreachable = [job for job in jobs if job.pk in targets and job.pk not in reachable]
+        logger.info(f'Probed {len(targets)} devices, {len(unreachable)} unreachable')
+        return [job for job in jobs if job.pk not in targets or job.pk in reachable], unreachable
+
+
+def get_prober():
+    config = settings.PLUGINS_CONFIG.get('netbox_config_backup', {})
+    return Prober(
+        enabled=config.get('probe', False),
+        ports=config.get('probe_ports', (22, 830)),
+        timeout=config.get('probe_timeout', 2),
+        concurrency=config.get('probe_concurrency', 256),
+    )
@@ -1,15 +1,20 @@
 import logging
 import os
+import time
 import traceback
-from datetime import timedelta
 
 import uuid
+from django.db import transaction
 from django.utils import timezone
 
+from netmiko.exceptions import NetmikoTimeoutException, ReadTimeout
+
 from core.choices import JobStatusChoices
-from netbox import settings
 from netbox.api.exceptions import ServiceUnavailable
-from netbox_config_backup.models import BackupJob, Backup
+from netbox_config_backup.backup.health import get_health
+from netbox_config_backup.backup.scheduling import get_scheduler
+from netbox_config_backup.exceptions import JobExit
+from netbox_config_backup.models import BackupJob, Backup, BackupFile, BackupStatus
 from netbox_config_backup.utils.db import close_db
 from netbox_config_backup.utils.configs import check_config_save_status
 from netbox_config_backup.utils.napalm import napalm_init
@@ -17,12 +22,45 @@ from netbox_config_backup.utils.rq import can_backup
 
 logger = logging.getLogger("netbox_config_backup")
 
+# Raised by a device which stops answering while its configuration is fetched
+FETCH_TIMEOUTS = (TimeoutError, NetmikoTimeoutException, ReadTimeout)
+
 
 def remove_stale_backupjobs(job: BackupJob):
     pass
 
 
-def run_backup(job_id):
+def get_next_job(backup, retry_after=None):
+    # The next backup runs on schedule, unless the circuit breaker holds it back for longer
+    scheduled = get_scheduler().next_run(backup.uuid)
+    if retry_after is not None and retry_after > scheduled:
+        scheduled = retry_after
+    new = BackupJob(
+        runner=None,
+        backup=backup,
+        status=JobStatusChoices.STATUS_SCHEDULED,
+        scheduled=scheduled,
+        job_id=uuid.uuid4(),
+        data={},
+    )
+    new.full_clean()
+    return new
+
+
+def fail_backup(job, backup, health, status, error):
+    """
+    Count a failed connection or collection towards the backup's circuit breaker, then fail the job and book the next
+    attempt
+    """
+    retry_after = health.record_failure(backup)
+    with transaction.atomic():
+        get_next_job(backup, retry_after=retry_after).save()
+        job.status = status
+        job.data = {'error': error}
+        job.save()
+
+
+def run_backup(job_id, commit_queue=None):
     close_db()
     logger.info(f'Starting backup for job {job_id}')
     try:
@@ -65,35 +103,75 @@ def run_backup(job_id):
             raise e
 
         if ip:
-            logger.debug(f'Trying to connect to device {backup.device} with ip {ip} for {job}')
+            health = get_health()
+            timeout = health.get_timeout(BackupStatus.objects.filter(backup=backup).first())
+            logger.debug(f'Trying to connect to device {backup.device} with ip {ip} for {job} (timeout {timeout})')
+            started = time.monotonic()
             try:
-                d = napalm_init(backup.device, ip)
+                d = napalm_init(backup.device, ip, timeout=timeout)
             except (TimeoutError, ServiceUnavailable):
-                job.status = JobStatusChoices.STATUS_FAILED
-                job.data = {'error': f'Timeout Connecting to {backup.device} with ip {ip}'}
-                logger.debug(f'Timeout Connecting to {backup.device} with ip {ip}')
-                job.save()
+                error = f'Timeout Connecting to {backup.device} with ip {ip}'
+                logger.debug(error)
+                fail_backup(job, backup, health, JobStatusChoices.STATUS_FAILED, error)
                 return
+            connect_time = time.monotonic() - started
             logger.debug(f'Connected to {backup.device} with ip {ip} for {job}')
             job.status = JobStatusChoices.STATUS_RUNNING
             job.pid = pid
             job.started = timezone.now()
             job.save()
             try:
-                logger.debug(f'Checking config save status for {backup}')
-                config_save_status = check_config_save_status(d)
-                status = config_save_status.get('status')
-                running = backup.files.filter(type='running').first()
-                startup = backup.files.filter(type='startup').first()
-                if running.last_change != config_save_status.get('running', None):
-                    running.last_change = config_save_status.get('running', None)
-                    running.clean()
-                    running.save()
-                if startup.last_change != config_save_status.get('startup', None):
-                    startup.last_change = config_save_status.get('startup', None)
-                    startup.clean()
-                    startup.save()
+                started = time.monotonic()
+                logger.debug(f'Getting running config for {backup}')
+                configs = d.get_config(retrieve='running')
+                files = ('running', 'startup')
+                config_save_status = {}
+                try:
+                    logger.debug(f'Checking config save status for {backup}')
+                    config_save_status = check_config_save_status(d, configs=configs) or {}
+                except FETCH_TIMEOUTS:
+                    raise
+                except Exception as e:
+                    logger.error(f'{backup}: had error checking backup status: {e}')
+
+                stored = {backupfile.type: backupfile for backupfile in backup.files.all()}
+                startup_change = config_save_status.get('startup', None)
+                if (
+                    startup_change is not None
+                    and stored.get('startup') is not None
+                    and stored['startup'].sha is not None
+                    and stored['startup'].last_change == startup_change
+                ):
+                    logger.debug(f'Startup config for {backup} unchanged since {startup_change}, not fetching it')
+                    files = ('running',)
+                else:
+                    logger.debug(f'Getting startup config for {backup}')
+                    configs['startup'] = d.get_config(retrieve='startup').get('startup', '')
+                fetch_time = time.monotonic() - started
+            except FETCH_TIMEOUTS:
+                error = f'Timeout fetching config from {backup.device} with ip {ip}'
+                logger.debug(error)
+                fail_backup(job, backup, health, JobStatusChoices.STATUS_FAILED, error)
+                return
+            except JobExit:
+                raise
+            except Exception as e:
+                logger.error(f'{backup}: had error fetching config: {e}')
+                logger.debug(f'\t{traceback.format_exc()}')
+                fail_backup(job, backup, health, JobStatusChoices.STATUS_ERRORED, f'{e}')
+                return
+            finally:
+                logger.debug(f'Closing connection for {backup}')
+                try:
+                    d.close()
+                except Exception as e:
+                    logger.warning(f'{backup}: had error closing connection: {e}')
 
+            # Saved with the commit, so that a failed commit leaves the startup config to be fetched again
+            changes = {file: config_save_status.get(file, None) for file in files}
+
+            try:
+                status = config_save_status.get('status')
                 if status is not None:
                     if status and not backup.config_status:
                         backup.config_status = status
@@ -111,36 +189,32 @@ def run_backup(job_id):
 
                 logger.error(f'{backup}: had error setting backup status: {e}')
 
-            logger.debug(f'Getting config for {backup}')
-            configs = d.get_config()
-            logger.debug(f'Committing config for {backup}')
-            commit = backup.set_config(configs)
-            logger.debug(f'Committed config for {backup} with {commit}; closing connection for {backup}')
-            d.close()
+            if commit_queue is not None:
+                logger.debug(f'Handing config for {backup} to the commit coordinator')
+                commit_queue.put((job.pk, backup.pk, configs, files, changes))
+            else:
+                logger.debug(f'Committing config for {backup}')
+                commit = backup.set_config(configs, files=files)
+                BackupFile.record_last_changes({backup.pk: changes})
+                logger.debug(f'Committed config for {backup} with {commit}')
+            health.record_success(backup, connect_time, fetch_time)
 
             logger.debug(f'Scheduling next backup for {backup}')
-            frequency = timedelta(
-                seconds=settings.PLUGINS_CONFIG.get('netbox_config_backup', {}).get('frequency', 3600)
-            )
-            new = BackupJob(
-                runner=None,
-                backup=job.backup,
-                status=JobStatusChoices.STATUS_SCHEDULED,
-                scheduled=timezone.now() + frequency,
-                job_id=uuid.uuid4(),
-                data={},
-            )
-            new.full_clean()
-            new.save()
-
-            logger.info(f'{backup}: Next scheduled')
-
-            job.status = JobStatusChoices.STATUS_COMPLETED
-            job.completed = timezone.now()
-            job.full_clean()
-            job.save()
-
-            logger.info(f'{backup}: Backup complete')
+            new = get_next_job(backup)
+            with transaction.atomic():
+                new.save()
+
+                logger.info(f'{backup}: Next scheduled')
+
+                if commit_queue is None:
+                    job.status = JobStatusChoices.STATUS_COMPLETED
+                    job.completed = timezone.now()
+                    job.full_clean()
+                    job.save()
+                    logger.info(f'{backup}: Backup complete')
+                else:
+                    # The commit coordinator completes the job once the config has been committed
+                    logger.info(f'{backup}: Backup collected')
             remove_stale_backupjobs(job=job)
         else:
             logger.debug(f'{backup}: No IP set')
@@ -161,3 +235,8 @@ def run_backup(job_id):
             job.data.update({'error': f'{e}'})
             job.full_clean()
             job.save()
+    finally:
+        try:
+            BackupStatus.refresh([job.backup_id])
+        except Exception as e:
+            logger.error(f'Unable to refresh backup status for job {job_id}: {e}')
@@ -0,0 +1,136 @@
+import logging
+from datetime import timedelta
+
+from django.db import models, transaction
+from django.db.models.functions import RowNumber, TruncDate
+from django.utils import timezone
+
+from core.choices import JobStatusChoices
+from netbox import settings
+from netbox_config_backup.models import BackupJob, BackupJobRollup
+
+__all__ = (
+    'JobRetention',
+    'get_retention',
+)
+
+
+logger = logging.getLogger("netbox_config_backup")
+
+
+class JobRetention:
+    """
+    Deletes finished backup jobs which are neither among the newest `keep_jobs` jobs of their backup, nor younger than
+    `keep_days` days (a limit of 0 is ignored), nor the last successful job of their backup.  Jobs are deleted
+    `batch_size` at a time, each batch in its own short transaction, and are optionally first counted into daily
+    BackupJobRollup rows.
+    """
+
+    def __init__(self, keep_jobs=0, keep_days=0, batch_size=10000, rollup=False):
+        self.keep_jobs = max(int(keep_jobs or 0), 0)
+        self.keep_days = max(int(keep_days or 0), 0)
+        self.batch_size = max(int(batch_size), 1)
+        self.rollup = rollup
+
+    @property
+    def enabled(self):
+        return bool(self.keep_jobs or self.keep_days)
+
+    def get_expired(self):
+        jobs = BackupJob.objects.filter(status__in=JobStatusChoices.TERMINAL_STATE_CHOICES)
+        if self.keep_days:
+            jobs = jobs.filter(created__lt=timezone.now() - timedelta(days=self.keep_days))
+        if self.keep_jobs:
+            # Rank against every finished job of the backup, not just the old ones
+            ranked = BackupJob.objects.filter(status__in=JobStatusChoices.TERMINAL_STATE_CHOICES).annotate(
+                rank=models.Window(
+                    expression=RowNumber(),
+                    partition_by=[models.F('backup')],
+                    order_by=[models.F('created').desc(), models.F('pk').desc()],
+                )
+            )
+            jobs = jobs.filter(pk__in=ranked.filter(rank__gt=self.keep_jobs).values('pk'))
+
+        # The last successful job of each backup is always kept, as it is what the backup's last backup time is
+        latest = (
+            BackupJob.objects.filter(status=JobStatusChoices.STATUS_COMPLETED)
+            .order_by('backup_id', '-completed')
+            .distinct('backup_id')
+            .values('pk')
+        )
+        return jobs.exclude(pk__in=latest).order_by().values_list('pk', flat=True)
+
+    def prune(self):
+        """
+        Delete expired jobs, returning the number deleted
+        """
+        if not self.enabled:
+            return 0
+
+        deleted = 0
+        batch = []
+        for pk in self.get_expired().iterator(chunk_size=self.batch_size):
+            batch.append(pk)
+            if len(batch) >= self.batch_size:
+                deleted += self.delete(batch)
+                batch = []
+        deleted += self.delete(batch)
+        return deleted
+
+    def delete(self, pks):
+        if not pks:
+            return 0
+        with transaction.atomic():
+            if self.rollup:
+                self.add_rollups(BackupJob.objects.filter(pk__in=pks))
+            BackupJob.objects.filter(pk__in=pks).delete()
+        logger.debug(f'Deleted {len(pks)} expired backup jobs')
+        return len(pks)
+
+    @staticmethod
+    def add_rollups(jobs):
+        counts = (
+            jobs.order_by()
+            .annotate(date=TruncDate('created'))
+            .values('backup_id', 'date')
+            .annotate(
+                completed=models.Count('pk', filter=models.Q(status=JobStatusChoices.STATUS_COMPLETED)),
+                failed=models.Count('pk', filter=models.Q(status=JobStatusChoices.STATUS_FAILED)),
+                errored=models.Count('pk', filter=models.Q(status=JobStatusChoices.STATUS_ERRORED)),
+            )
+        )
+        counts = {(row['backup_id'], row['date']): row for row in counts}
+        if not counts:
+            return
+
+        existing = {
+            (rollup.backup_id, rollup.date): rollup
+            for rollup in BackupJobRollup.objects.select_for_update().filter(
+                backup_id__in={backup for backup, _ in counts.keys()},
+                date__in={date for _, date in counts.keys()},
+            )
+        }
+        created = []
+        updated = []
+        for key, row in counts.items():
+            rollup = existing.get(key)
+            if rollup is None:
+                rollup = BackupJobRollup(backup_id=key[0], date=key[1])
+                created.append(rollup)
+            else:
+                updated.append(rollup)
+            rollup.completed += row['completed']
+            rollup.failed += row['failed']
+            rollup.errored += row['errored']
+        BackupJobRollup.objects.bulk_create(created)
+        BackupJobRollup.objects.bulk_update(updated, ['completed', 'failed', 'errored'])
+
+
+def get_retention():
+    config = settings.PLUGINS_CONFIG.get('netbox_config_backup', {})
+    return JobRetention(
+        keep_jobs=config.get('retention_jobs', 0),
+        keep_days=config.get('retention_days', 0),
+        batch_size=config.get('retention_batch_size', 10000),
+        rollup=config.get('retention_rollup', False),
+    )
@@ -0,0 +1,76 @@
+import datetime
+import hashlib
+import random
+
+from django.utils import timezone
+
+from netbox import settings
+
+__all__ = (
+    'Scheduler',
+    'get_scheduler',
+)
+
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class Scheduler:
+    """
+    Decides when backups run.  With `spread` set every backup gets a fixed phase within the `frequency` window,
+    derived from a hash of its UUID, and always runs at that phase, so collections are spread evenly over the window
+    and stay spread after a restart.  Without it backups run `frequency` seconds after the previous run finished.  Up
+    to `jitter` seconds of random delay are added to either.
+    """
+
+    def __init__(self, frequency=3600, spread=True, jitter=0):
+        self.frequency = max(float(frequency), 0)
+        self.spread = spread and self.frequency > 0
+        self.jitter = max(float(jitter or 0), 0)
+
+    @property
+    def period(self):
+        # The window length in whole microseconds, so slots are computed exactly
+        return datetime.timedelta(seconds=self.frequency) // datetime.timedelta(microseconds=1)
+
+    def phase(self, uuid):
+        digest = hashlib.sha256(f'{uuid}'.encode('ascii')).digest()
+        return int.from_bytes(digest[:8], 'big') % self.period
+
+    def slot(self, uuid, now, strict):
+        # Next time (after `now` if strict, otherwise at or after it) which is a whole number of periods from the phase
+        period = self.period
+        phase = self.phase(uuid)
+        elapsed = (now - EPOCH) // datetime.timedelta(microseconds=1) - phase
+        periods = elapsed // period + 1 if strict else -(-elapsed // period)
+        return EPOCH + datetime.timedelta(microseconds=phase + periods * period)
+
+    def get_jitter(self):
+        return datetime.timedelta(seconds=random.uniform(0, self.jitter)) if self.jitter else datetime.timedelta()
+
+    def first_run(self, uuid, now=None):
+        """
+        Time to run a backup which has nothing scheduled
+        """
+        now = now or timezone.now()
+        if not self.spread:
+            return now + self.get_jitter()
+        return self.slot(uuid, now, strict=False) + self.get_jitter()
+
+    def next_run(self, uuid, now=None):
+        """
+        Time to run a backup again after it has just run
+        """
+        now = now or timezone.now()
+        if not self.spread:
+            return now + datetime.timedelta(seconds=self.frequency) + self.get_jitter()
+        return self.slot(uuid, now, strict=True) + self.get_jitter()
+
+
+def get_scheduler():
+    config = settings.PLUGINS_CONFIG.get('netbox_config_backup', {})
+    return Scheduler(
+        frequency=config.get('frequency', 3600),
+        spread=config.get('spread', True),
+        jitter=config.get('jitter', 0),
+    )
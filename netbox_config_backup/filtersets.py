@@ -1,7 +1,10 @@
+from datetime import timedelta
+
 import django_filters
 import netaddr
 from django.core.exceptions import ValidationError
 from django.db.models import Q
+from django.utils import timezone
 from django.utils.translation import gettext as _
 from netaddr import AddrFormatError
 
@@ -57,6 +60,46 @@ class BackupFilterSet(BaseFilterSet):
         method='filter_address',
         label=_('Address'),
     )
+    last_backup__before = django_filters.DateTimeFilter(
+        field_name='summary__last_backup',
+        lookup_expr='lte',
+    )
+    last_backup__after = django_filters.DateTimeFilter(
+        field_name='summary__last_backup',
+        lookup_expr='gte',
+    )
+    next_attempt__before = django_filters.DateTimeFilter(
+        field_name='summary__next_attempt',
+        lookup_expr='lte',
+    )
+    next_attempt__after = django_filters.DateTimeFilter(
+        field_name='summary__next_attempt',
+        lookup_expr='gte',
+    )
+    last_change__before = django_filters.DateTimeFilter(
+        field_name='summary__last_change',
+        lookup_expr='lte',
+    )
+    last_change__after = django_filters.DateTimeFilter(
+        field_name='summary__last_change',
+        lookup_expr='gte',
+    )
+    backup_count = django_filters.NumberFilter(
+        field_name='backup_count',
+        method='filter_count',
+    )
+    backup_count__gte = django_filters.NumberFilter(
+        field_name='backup_count__gte',
+        method='filter_count',
+    )
+    backup_count__lte = django_filters.NumberFilter(
+        field_name='backup_count__lte',
+        method='filter_count',
+    )
+    unchanged_for = django_filters.NumberFilter(
+        method='filter_unchanged_for',
+        label=_('Unchanged for (days)'),
+    )
 
     class Meta:
         model = models.Backup
@@ -84,6 +127,15 @@ class BackupFilterSet(BaseFilterSet):
 
         return queryset.filter(qs_filter)
 
+    def filter_count(self, queryset, name, value):
+        if 'backup_count' not in queryset.query.annotations:
+            queryset = queryset.annotate_counts()
+        return queryset.filter(**{name: value})
+
+    def filter_unchanged_for(self, queryset, name, value):
+        since = timezone.now() - timedelta(days=float(value))
+        return queryset.filter(Q(summary__last_change__lt=since) | Q(summary__last_change__isnull=True))
+
     def filter_address(self, queryset, name, value):
         try:
             if type(value) is list:
@@ -14,6 +14,7 @@ from utilities.forms.fields import (
     DynamicModelMultipleChoiceField,
     CommentField,
 )
+from utilities.forms.widgets import DateTimePicker
 
 __all__ = (
     'BackupForm',
@@ -115,6 +116,11 @@ class BackupFilterSetForm(forms.Form):
         label=_('Config Saved'),
         widget=forms.Select(choices=BOOLEAN_WITH_BLANK_CHOICES),
     )
+    last_backup__after = forms.DateTimeField(required=False, label=_('Last backup after'), widget=DateTimePicker())
+    last_backup__before = forms.DateTimeField(required=False, label=_('Last backup before'), widget=DateTimePicker())
+    last_change__after = forms.DateTimeField(required=False, label=_('Last change after'), widget=DateTimePicker())
+    last_change__before = forms.DateTimeField(required=False, label=_('Last change before'), widget=DateTimePicker())
+    unchanged_for = forms.IntegerField(required=False, min_value=0, label=_('Unchanged for (days)'))
 
 
 class BackupBulkEditForm(NetBoxModelBulkEditForm):
@@ -1,9 +1,16 @@
+import hashlib
+import json
+import logging
 import os
+import sqlite3
+import stat
+import threading
+import time
 from datetime import datetime
 from time import sleep
 
-from deepdiff import DeepDiff
-from dulwich import repo, porcelain, object_store
+from dulwich import diff_tree, repo, object_store, objects
+from dulwich.file import FileLocked
 from pydriller import Git
 
 from netbox import settings
@@ -11,6 +18,13 @@ from netbox import settings
 __all__ = 'repository'
 
 from netbox_config_backup.helpers import get_repository_dir
+from netbox_config_backup.utils import Differ
+
+logger = logging.getLogger("netbox_config_backup")
+
+FILE_MODE = stat.S_IFREG | 0o644
+
+LOG_FIELDS = ('author', 'committer', 'message', 'parents', 'sha', 'time', 'tree', 'changes')
 
 
 def encode(value, encoding):
@@ -25,13 +39,87 @@ def decode(value, encoding):
     return None
 
 
+def get_blob_sha(data):
+    """
+    Return the git blob SHA-1 the given file contents would be stored under
+    """
+    encoded = data.encode('utf-8')
+    return hashlib.sha1(b'blob %d\x00' % len(encoded) + encoded).hexdigest()
+
+
+class ChangesCache:
+    """
+    On-disk cache of the tree changes made by each commit, keyed by commit SHA.  Commits are immutable, so entries
+    never need to be invalidated.  The cache is best effort: any error reading or writing it is logged and ignored.
+    It is opened in WAL mode without a sync per transaction, so that readers never block the writer and the
+    indexer's worker processes can each write a chunk of entries at a time.
+    """
+
+    chunk_size = 500
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS changes (sha TEXT PRIMARY KEY, changes TEXT NOT NULL)')
+            self.local.connection = connection
+        return connection
+
+    def get(self, sha):
+        return self.get_many([sha]).get(sha)
+
+    def get_many(self, shas):
+        """
+        Return the cached changes of the given commit SHAs, keyed by SHA
+        """
+        shas = list(shas)
+        found = {}
+        try:
+            for idx in range(0, len(shas), self.chunk_size):
+                chunk = shas[idx:idx + self.chunk_size]
+                rows = self.connection.execute(
+                    f'SELECT sha, changes FROM changes WHERE sha IN ({", ".join("?" * len(chunk))})', chunk
+                )
+                found.update((sha, json.loads(changes)) for sha, changes in rows)
+        except sqlite3.Error as e:
+            logger.debug(f'Unable to read the changes cache: {e}')
+        return found
+
+    def set(self, sha, changes):
+        self.set_many({sha: changes})
+
+    def set_many(self, entries):
+        """
+        Cache the changes of several commits, given as a dict keyed by commit SHA, in a single transaction
+        """
+        if not entries:
+            return
+        try:
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT OR IGNORE INTO changes (sha, changes) VALUES (?, ?)',
+                    [(sha, json.dumps(changes)) for sha, changes in entries.items()],
+                )
+        except sqlite3.Error as e:
+            logger.warning(f'Unable to write {len(entries)} entries to the changes cache: {e}')
+
+
 class GitBackup:
     repository = None
     driller = None
     location = None
+    cache = None
 
     def __init__(self):
         self.location = get_repository_dir()
+        self.local = threading.local()
 
         if os.path.exists(self.location):
             self.repository = repo.Repo(self.location)
@@ -40,50 +128,109 @@ class GitBackup:
             self.repository = repo.Repo.init(path=self.location, mkdir=True)
 
         if self.repository is not None:
+            self.cache = ChangesCache(os.path.join(self.repository.controldir(), 'netbox_config_backup.sqlite3'))
             try:
                 self.driller = Git(self.location)
             except OSError:
                 pass
 
-    def write(self, file, data):
-        path = f'{self.location}{os.path.sep}{file}'
-        with open(path, 'w') as f:
-            f.write(data)
-            f.close()
+    @property
+    def staged(self):
+        # Files staged with write() are kept per thread, so concurrent writers never commit each other's files
+        if not hasattr(self.local, 'staged'):
+            self.local.staged = {}
+        return self.local.staged
 
-        failures = 0
-        while failures < 10:
-            try:
-                porcelain.add(self.repository, path)
-                return
-            except FileExistsError:
-                sleep(1)
-                failures = failures + 1
-                if failures >= 10:
-                    raise Exception('Unable to acquire lock on repository in a timely manner')
+    def write(self, file, data):
+        """
+        Stage the contents of a file for this thread's next commit()
+        """
+        self.staged[file] = data
 
-    def commit(self, message):
+    def get_identities(self):
         committer = settings.PLUGINS_CONFIG.get('netbox_config_backup', {}).get('committer', None)
         author = settings.PLUGINS_CONFIG.get('netbox_config_backup', {}).get('author', None)
 
-        if author is not None:
+        try:
+            if author is None or committer is None:
+                raise repo.InvalidUserIdentity(None)
             author = author.encode('ascii')
-        if committer is not None:
             committer = committer.encode('ascii')
+            repo.check_user_identity(author)
+            repo.check_user_identity(committer)
+        except repo.InvalidUserIdentity:
+            committer = 'Your NetBox is misconfigured <netbox@localhost>'.encode('ascii')
+            author = 'Your NetBox is misconfigured <netbox@localhost>'.encode('ascii')
+        return author, committer
+
+    def build_commit(self, head, blobs, message):
+        """
+        Build a commit on top of `head` whose tree is head's tree with the given blobs replaced.  Only the changed
+        entries are written, the working tree and index are never touched.
+        """
+        store = self.repository.object_store
+        if head is not None:
+            tree = self.repository[self.repository[head].tree].copy()
+        else:
+            tree = objects.Tree()
+        changes = [(path, FILE_MODE, blob.id) for path, blob in blobs.items()]
+        tree_id = object_store.commit_tree_changes(store, tree, changes)
+
+        author, committer = self.get_identities()
+        now = int(time.time())
+        offset = time.localtime(now).tm_gmtoff
+
+        commit = objects.Commit()
+        commit.tree = tree_id
+        commit.parents = [head] if head is not None else []
+        commit.author = author
+        commit.committer = committer
+        commit.author_time = commit.commit_time = now
+        commit.author_timezone = commit.commit_timezone = offset
+        commit.encoding = b'UTF-8'
+        commit.message = message.encode('utf-8')
+        store.add_object(commit)
+        return commit
+
+    def commit_files(self, files, message):
+        """
+        Commit a mapping of file name to contents directly into the object store and atomically advance HEAD
+        """
+        store = self.repository.object_store
+        blobs = {}
+        for file, data in files.items():
+            blob = objects.Blob.from_string(data.encode('utf-8'))
+            store.add_object(blob)
+            blobs[file.encode('ascii')] = blob
 
         failures = 0
         while failures < 10:
             try:
-                commit = porcelain.commit(self.repository, message, committer=committer, author=author)
-                return commit.decode('ascii')
-            except repo.InvalidUserIdentity:
-                committer = 'Your NetBox is misconfigured <netbox@localhost>'.encode('ascii')
-                author = 'Your NetBox is misconfigured <netbox@localhost>'.encode('ascii')
-            except FileExistsError:
-                sleep(1)
-                failures = failures + 1
-                if failures >= 10:
-                    raise Exception('Unable to acquire lock on repository in a timely manner')
+                head = self.repository.refs[b'HEAD']
+            except KeyError:
+                head = None
+            commit = self.build_commit(head, blobs, message)
+            try:
+                if head is None:
+                    updated = self.repository.refs.add_if_new(b'HEAD', commit.id)
+                else:
+                    updated = self.repository.refs.set_if_equals(b'HEAD', head, commit.id)
+            except (FileLocked, FileExistsError):
+                # Another process holds the ref lock (older dulwich releases raised FileExistsError)
+                updated = False
+                sleep(0.1)
+            if updated:
+                return commit.id.decode('ascii')
+            failures = failures + 1
+        raise Exception('Unable to acquire lock on repository in a timely manner')
+
+    def commit(self, message):
+        """
+        Commit all files this thread staged with write()
+        """
+        files = self.staged
+        self.local.staged = {}
+        return self.commit_files(files, message)
 
     def read(self, file, index=None):
         path = file.encode('ascii')
@@ -98,6 +245,21 @@ class GitBackup:
         except KeyError:
             return None
 
+    def sha(self, file, index=None):
+        """
+        Return the blob SHA of a file at the given commit without reading the blob itself
+        """
+        path = file.encode('ascii')
+        if index is None:
+            index = 'HEAD'
+
+        try:
+            tree = self.repository[index.encode('ascii')].tree
+            _, sha = object_store.tree_lookup_path(self.repository.__getitem__, tree, path)
+            return sha.decode('ascii')
+        except KeyError:
+            return None
+
     def diff(self, file, a=None, b=None):
         _ = file.encode('ascii')
         commits = [a, b]
@@ -108,78 +270,108 @@ class GitBackup:
             else:
                 data.append(self.read(file, commit))
 
-        diff = DeepDiff(data[0], data[1]).diff()
-        return diff
-
-    def log(self, file=None, paths=[], index=None, depth=None):
-
-        if file is not None:
-            path = file.encode('ascii')
-            paths = [path]
-        else:
-            path = None
-            for idx in range(0, len(paths)):
-                path = paths[idx]
-                paths[idx] = path.encode('ascii')
-
-        if index is not None:
-            index = index.encode('ascii')
-
-        walker = self.repository.get_walker(include=index, paths=paths, max_entries=depth)
-        entries = [entry for entry in walker]
-
-        indexes = []
-        for entry in entries:
-            encoding = entry.commit.encoding.decode('ascii') if entry.commit.encoding else 'ascii'
-            output = {
-                'author': decode(entry.commit.author, encoding),
-                'committer': decode(entry.commit.committer, encoding),
-                'message': decode(entry.commit.message, encoding),
-                'parents': [decode(parent, encoding) for parent in entry.commit.parents],
-                'sha': str(entry.commit.sha().hexdigest()),
-                'time': datetime.fromtimestamp(entry.commit.commit_time),
-                'tree': decode(entry.commit.tree, encoding),
-            }
-            changes = []
-            for change in entry.changes():
-                old = {
-                    'sha': decode(getattr(change.old, 'sha', None), encoding),
-                    'path': decode(getattr(change.old, 'path', None), encoding),
+        return Differ(data[0], data[1]).diff()
+
+    def commit_changes(self, commit):
+        """
+        Return the tree changes a commit (or commit SHA) made relative to its first parent
+        """
+        if isinstance(commit, str):
+            commit = self.repository[commit.encode('ascii')]
+        sha = commit.id.decode('ascii')
+        changes = self.cache.get(sha)
+        if changes is None:
+            changes = self.tree_changes(commit)
+            self.cache.set(sha, changes)
+        return changes
+
+    def commits_changes(self, shas):
+        """
+        Return the tree changes of several commits, in order, caching any not yet cached in one transaction
+        """
+        cached = self.cache.get_many(shas)
+        computed = {
+            sha: self.tree_changes(self.repository[sha.encode('ascii')]) for sha in shas if sha not in cached
+        }
+        self.cache.set_many(computed)
+        return [cached[sha] if sha in cached else computed[sha] for sha in shas]
+
+    def tree_changes(self, commit):
+        """
+        Compute the tree changes a commit made relative to its first parent, bypassing the cache
+        """
+        encoding = commit.encoding.decode('ascii') if commit.encoding else 'ascii'
+        parent = self.repository[commit.parents[0]].tree if commit.parents else None
+        changes = []
+        for change in diff_tree.tree_changes(self.repository.object_store, parent, commit.tree):
+            changes.append(
+                {
+                    'type': change.type,
+                    'old': {
+                        'path': decode(getattr(change.old, 'path', None), encoding),
+                        'sha': decode(getattr(change.old, 'sha', None), encoding),
+                    },
+                    'new': {
+                        'path': decode(getattr(change.new, 'path', None), encoding),
+                        'sha': decode(getattr(change.new, 'sha', None), encoding),
+                    },
                 }
-                if path is not None and (old.get('path') == path or change.get('new') == path):
-                    output.update(
-                        {
-                            'change': {
-                                'type': change.type,
-                                'old': {
-                                    'path': old.get('path'),
-                                    'sha': old.get('sha'),
-                                },
-                                'new': {
-                                    'path': decode(getattr(change.new, 'path', None), encoding),
-                                    'sha': decode(getattr(change.new, 'sha', None), encoding),
-                                },
-                            }
-                        }
-                    )
-                changes.append(
-                    {
-                        'type': change.type,
-                        'old': {
-                            'path': decode(getattr(change.old, 'path', None), encoding),
-                            'sha': decode(getattr(change.old, 'sha', None), encoding),
-                        },
-                        'new': {
-                            'path': decode(getattr(change.new, 'path', None), encoding),
-                            'sha': decode(getattr(change.new, 'sha', None), encoding),
-                        },
-                    }
-                )
-
-            output.update({'changes': changes})
-            indexes.append(output)
-
-        return indexes
+            )
+        return changes
+
+    def log(
+        self, file=None, paths=None, index=None, depth=None, fields=None, reverse=False, exclude=None, since=None,
+        until=None
+    ):
+        """
+        Lazily yield the commit history, newest first (or oldest first with `reverse`).  `fields` restricts the
+        entries to the given keys of LOG_FIELDS, avoiding the decoding (and, for 'changes', the tree diff) of
+        anything which is not needed.  Commits reachable from any SHA in `exclude` are skipped, and `since`/`until`
+        limit the walk to a range of commit times.
+        """
+        fields = set(fields) if fields is not None else set(LOG_FIELDS)
+
+        path = None
+        if file is not None:
+            path = file
+            paths = [file]
+        paths = [path.encode('ascii') for path in paths] if paths else None
+        if path is not None:
+            fields.add('changes')
+
+        include = [index.encode('ascii')] if index is not None else None
+        exclude = [sha.encode('ascii') for sha in exclude] if exclude else None
+        since = int(since.timestamp()) if since is not None else None
+        until = int(until.timestamp()) if until is not None else None
+        walker = self.repository.get_walker(
+            include=include, exclude=exclude, paths=paths, max_entries=depth, reverse=reverse, since=since, until=until
+        )
+
+        for entry in walker:
+            commit = entry.commit
+            encoding = commit.encoding.decode('ascii') if commit.encoding else 'ascii'
+            output = {}
+            if 'author' in fields:
+                output['author'] = decode(commit.author, encoding)
+            if 'committer' in fields:
+                output['committer'] = decode(commit.committer, encoding)
+            if 'message' in fields:
+                output['message'] = decode(commit.message, encoding)
+            if 'parents' in fields:
+                output['parents'] = [decode(parent, encoding) for parent in commit.parents]
+            if 'sha' in fields:
+                output['sha'] = commit.id.decode('ascii')
+            if 'time' in fields:
+                output['time'] = datetime.fromtimestamp(commit.commit_time)
+            if 'tree' in fields:
+                output['tree'] = decode(commit.tree, encoding)
+            if 'changes' in fields:
+                output['changes'] = self.commit_changes(commit)
+                if path is not None:
+                    for change in output['changes']:
+                        if path in (change['old']['path'], change['new']['path']):
+                            output['change'] = change
+            yield output
 
 
 repository = GitBackup()
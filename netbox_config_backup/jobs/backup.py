@@ -3,20 +3,26 @@ import signal
 import time
 import uuid
 import traceback
-import multiprocessing
 from datetime import timedelta
 
+from django.db import transaction
+from django.db.models import Exists, OuterRef
 from django.utils import timezone
 
 from core.choices import JobStatusChoices, JobIntervalChoices
 from netbox import settings
 from netbox.jobs import JobRunner, system_job
-from netbox_config_backup.backup.processing import run_backup
+from netbox_config_backup.backup.commits import get_coordinator
+from netbox_config_backup.backup.dispatch import get_dispatcher
+from netbox_config_backup.backup.executors import get_executor
+from netbox_config_backup.backup.health import get_health
+from netbox_config_backup.backup.probe import get_prober
+from netbox_config_backup.backup.scheduling import get_scheduler
+from netbox_config_backup.backup.processing import get_next_job, run_backup
 from netbox_config_backup.choices import StatusChoices
 from netbox_config_backup.exceptions import JobExit
-from netbox_config_backup.models import Backup, BackupJob
-from netbox_config_backup.utils.db import close_db
-from netbox_config_backup.utils.rq import can_backup
+from netbox_config_backup.models import Backup, BackupJob, BackupStatus
+from netbox_config_backup.utils.db import close_db, merge_json
 
 __all__ = ('BackupRunner',)
 
@@ -28,7 +34,10 @@ job_frequency = settings.PLUGINS_CONFIG.get('netbox_config_backup', {}).get('fre
 
 @system_job(interval=JobIntervalChoices.INTERVAL_MINUTELY * 5)
 class BackupRunner(JobRunner):
-    processes = {}
+    executor = None
+    dispatcher = None
+    coordinator = None
+    finished = None
 
     class Meta:
         name = 'Backup Job Runner'
@@ -38,7 +47,7 @@ class BackupRunner(JobRunner):
         job.status = status
         if not job.data:
             job.data = {}
-        job.data.update({'error': 'Process terminated'})
+        job.data.update({'error': error or 'Process terminated'})
         job.save()
         job.refresh_from_db()
 
@@ -47,34 +56,38 @@ class BackupRunner(JobRunner):
         logger.info('Starting stale job cleanup')
         results = {'stale': 0, 'scheduled': 0}
 
-        jobs = (
-            BackupJob.objects.order_by('created')
-            .filter(
-                status__in=JobStatusChoices.ENQUEUED_STATE_CHOICES,
-            )
-            .prefetch_related('backup', 'backup__device')
-        )
+        jobs = BackupJob.objects.filter(status__in=JobStatusChoices.ENQUEUED_STATE_CHOICES)
         if backup:
             jobs = jobs.filter(backup=backup)
 
-        stale = jobs.filter(scheduled__lt=timezone.now() - timedelta(minutes=30))
-        for job in stale:
-            results['stale'] += 1
-            cls.fail_job(job, JobStatusChoices.STATUS_FAILED, 'Job hung')
-            logger.warning(f'Job {job.backup} appears stuck, deleting')
+        with transaction.atomic():
+            stale = jobs.filter(scheduled__lt=timezone.now() - timedelta(minutes=30))
+            touched = set(stale.order_by().values_list('backup_id', flat=True).distinct())
+            results['stale'] = stale.update(
+                status=JobStatusChoices.STATUS_FAILED,
+                data=merge_json('data', {'error': 'Job hung'}),
+            )
 
-        scheduled = jobs.filter(status=JobStatusChoices.STATUS_SCHEDULED)
-        for job in scheduled:
-            if job != scheduled.filter(backup=job.backup).last():
-                results['scheduled'] += 1
-                cls.fail_job(job, JobStatusChoices.STATUS_ERRORED, 'Job missed')
-                logger.warning(f'Job {job.backup} appears to have been missed, deleting')
+            # Only the most recently created scheduled job of each backup is kept
+            scheduled = jobs.filter(status=JobStatusChoices.STATUS_SCHEDULED)
+            latest = scheduled.order_by('backup_id', '-created', '-pk').distinct('backup_id').values('pk')
+            missed = scheduled.exclude(pk__in=latest)
+            touched.update(missed.order_by().values_list('backup_id', flat=True).distinct())
+            results['scheduled'] = missed.update(
+                status=JobStatusChoices.STATUS_ERRORED,
+                data=merge_json('data', {'error': 'Job missed'}),
+            )
 
+            BackupStatus.refresh(touched)
+
+        if results['stale']:
+            logger.warning(f'Failed {results["stale"]} jobs which appear stuck')
+        if results['scheduled']:
+            logger.warning(f'Errored {results["scheduled"]} jobs which appear to have been missed')
         return results
 
     @classmethod
     def schedule_jobs(cls, runner, backup=None, device=None):
-        scheduled_status = 0
         if backup:
             logging.debug(f'Scheduling backup for backup: {backup}')
             backups = Backup.objects.filter(pk=backup.pk, status=StatusChoices.STATUS_ACTIVE, device__isnull=False)
@@ -85,34 +98,68 @@ class BackupRunner(JobRunner):
             logging.debug('Scheduling all backups for')
             backups = Backup.objects.filter(status=StatusChoices.STATUS_ACTIVE, device__isnull=False)
 
-        for backup in backups:
-            if can_backup(backup):
-                logger.debug(f'Checking jobs for backup for {backup.device}' f'+')
-                jobs = backup.jobs.filter(status__in=JobStatusChoices.ENQUEUED_STATE_CHOICES)
-                if jobs.filter(status=JobStatusChoices.STATUS_SCHEDULED, scheduled__gte=timezone.now()).exists():
-                    continue
-                else:
-                    logger.debug(f'Queuing device {backup.device} for backup')
-                    scheduled = timezone.now()
-                    logger.info(f'Scheduling {backup} for {scheduled} (Now: {timezone.now()}')
-                    job = BackupJob(
-                        runner=None,
-                        backup=backup,
-                        status=JobStatusChoices.STATUS_SCHEDULED,
-                        scheduled=scheduled,
-                        job_id=uuid.uuid4(),
-                        data={},
+        now = timezone.now()
+        scheduler = get_scheduler()
+        eligible = backups.backupable()
+        due = eligible
+        brought_forward = []
+        if not backup and not device:
+            # Backups held back by the circuit breaker are left alone until their retry time, unless asked for
+            due = due.exclude(summary__retry_after__gt=now)
+        else:
+            # Backups asked for by backup or device run straight away, so a job booked for later is brought forward
+            later = BackupJob.objects.filter(
+                backup__in=eligible.values('pk'),
+                runner=None,
+                status=JobStatusChoices.STATUS_SCHEDULED,
+                scheduled__gt=now,
+            )
+            brought_forward = list(later.order_by().values_list('backup_id', flat=True).distinct())
+            later.update(scheduled=now)
+        # A backup with any job still to run (even one whose slot has passed) gets no other
+        due = dict(
+            due.filter(
+                ~Exists(
+                    BackupJob.objects.filter(
+                        backup=OuterRef('pk'),
+                        status__in=JobStatusChoices.ENQUEUED_STATE_CHOICES,
                     )
-                    job.full_clean()
-                    job.save()
-                    scheduled_status += 1
-            else:
-                jobs = BackupJob.objects.filter(backup=backup, status__in=JobStatusChoices.ENQUEUED_STATE_CHOICES)
-                for job in jobs:
-                    cls.fail_job(job, JobStatusChoices.STATUS_FAILED, 'Cannot queue job')
+                )
+            )
+            .values_list('pk', 'uuid')
+        )
+        jobs = [
+            BackupJob(
+                runner=None,
+                backup_id=pk,
+                status=JobStatusChoices.STATUS_SCHEDULED,
+                scheduled=now if backup or device else scheduler.first_run(backup_uuid, now=now),
+                job_id=uuid.uuid4(),
+                data={},
+            )
+            for pk, backup_uuid in due.items()
+        ]
 
-        return scheduled_status
+        # Backups which can no longer be backed up have their outstanding jobs failed
+        unavailable = BackupJob.objects.filter(
+            backup__in=backups.exclude(pk__in=eligible.values('pk')),
+            status__in=JobStatusChoices.ENQUEUED_STATE_CHOICES,
+        )
+        with transaction.atomic():
+            BackupJob.objects.bulk_create(jobs, batch_size=1000)
+            failed = list(unavailable.order_by().values_list('backup_id', flat=True).distinct())
+            unavailable.update(
+                status=JobStatusChoices.STATUS_FAILED,
+                data=merge_json('data', {'error': 'Cannot queue job'}),
+            )
+            BackupStatus.refresh(list(due.keys()) + failed + brought_forward)
 
+        logger.info(f'Scheduled {len(jobs)} backups')
+        if brought_forward:
+            logger.info(f'Brought forward {len(brought_forward)} backups which were already scheduled')
+        if failed:
+            logger.warning(f'Failed the queued jobs of {len(failed)} backups which can no longer be backed up')
+        return len(jobs)
 
     def get_scheduled_jobs(self):
         return BackupJob.objects.filter(
@@ -132,59 +179,116 @@ class BackupRunner(JobRunner):
             jobs = jobs.filter(backup=backup)
             logger.info(f'Backup Job Count: {jobs.count()}')
 
-        for job in jobs:
-            job.runner = self.job
-            job.status = JobStatusChoices.STATUS_PENDING
-
-        BackupJob.objects.bulk_update(jobs, ['runner', 'status'])
+        jobs = list(
+            jobs.select_related(
+                'backup__ip',
+                'backup__device__site',
+                'backup__device__platform__napalm',
+                'backup__device__primary_ip4',
+                'backup__device__primary_ip6',
+            )
+        )
+        jobs, unreachable = self.probe_jobs(jobs)
+        # Queued jobs stay scheduled and unclaimed until a worker is free for them (see claim_jobs)
+        self.dispatcher.extend(jobs)
 
-        self.job.data.update({'status': {'pending': jobs.count()}})
+        self.job.data.update(
+            {'status': {'pending': len(jobs), 'unreachable': unreachable, **self.dispatcher.status}}
+        )
         self.job.clean()
         self.job.save()
 
         close_db()
+        self.dispatch_jobs()
+
+    def probe_jobs(self, jobs):
+        """
+        Fail, in bulk, the jobs of devices which do not answer the reachability probe, booking their next attempts, and
+        return the rest along with the number failed
+        """
+        prober = get_prober()
+        if not prober.enabled or not jobs:
+            return jobs, 0
 
+        try:
+            jobs, unreachable = prober.split(jobs)
+        except Exception as e:
+            logger.warning(f'Unable to probe devices, collecting all: {e}')
+            return jobs, 0
+        if not unreachable:
+            return jobs, 0
+
+        with transaction.atomic():
+            BackupJob.objects.filter(pk__in=[job.pk for job in unreachable]).update(
+                runner=self.job,
+                status=JobStatusChoices.STATUS_FAILED,
+                data=merge_json('data', {'error': 'Device unreachable'}),
+            )
+            # The next attempt is booked as after any other connection failure
+            retry_after = get_health().record_failures(job.backup_id for job in unreachable)
+            BackupJob.objects.bulk_create(
+                [get_next_job(job.backup, retry_after=retry_after.get(job.backup_id)) for job in unreachable]
+            )
+            BackupStatus.refresh(job.backup_id for job in unreachable)
+        logger.warning(f'Failed {len(unreachable)} jobs whose device is unreachable')
+        return jobs, len(unreachable)
+
+    def claim_jobs(self, jobs):
+        """
+        Mark jobs as taken by this runner just before they are started.  Jobs which are no longer scheduled and
+        unclaimed (failed by stale job cleanup or taken by another runner while they were queued) are dropped.
+        """
+        if not jobs:
+            return []
+        with transaction.atomic():
+            claimed = set(
+                BackupJob.objects.select_for_update(skip_locked=True)
+                .filter(pk__in=[job.pk for job in jobs], runner=None, status=JobStatusChoices.STATUS_SCHEDULED)
+                .order_by()
+                .values_list('pk', flat=True)
+            )
+            BackupJob.objects.filter(pk__in=claimed).update(runner=self.job, status=JobStatusChoices.STATUS_PENDING)
+
+        started = []
         for job in jobs:
+            if job.pk in claimed:
+                job.runner = self.job
+                job.status = JobStatusChoices.STATUS_PENDING
+                started.append(job)
+            else:
+                logger.info(f'Skipping {job}, it is no longer scheduled')
+                self.dispatcher.release(job.pk)
+        return started
+
+    def dispatch_jobs(self):
+        if not self.running:
+            return
+        for job in self.claim_jobs(self.dispatcher.take(self.executor.available)):
             try:
-                logger.info(f'Forking {job} ({job.backup.name})')
-                process = self.fork_process(job)
-                process.join(1)
+                logger.info(f'Starting {job} ({job.backup.name})')
+                self.executor.submit(job)
             except Exception as e:
-                logger.warning(f'Exception forking: {e}')
+                logger.warning(f'Exception starting job: {e}')
                 try:
                     import sentry_sdk
 
                     sentry_sdk.capture_exception(e)
                 except ModuleNotFoundError:
                     pass
+                self.dispatcher.release(job.pk)
                 job.status = JobStatusChoices.STATUS_FAILED
                 job.data['error'] = str(e)
                 job.full_clean()
                 job.save()
-        close_db()
+                BackupStatus.refresh([job.backup_id])
 
-    def run_backup(self, job_id):
+    def run_backup(self, job_id, commit_queue=None):
         self.job_id = job_id
         if not self.running:
             self.handle_main_exit(signal.SIGTERM, None)
         signal.signal(signal.SIGTERM, self.handle_child_exit)
         signal.signal(signal.SIGINT, self.handle_child_exit)
-        run_backup(job_id)
-
-    def fork_process(self, job):
-        if not self.running:
-            logger.info('Not running')
-            return
-        close_db()
-        process = self.ctx.Process(
-            target=self.run_backup,
-            args=(job.pk,),
-        )
-        data = {job.backup.pk: {'process': process, 'backup': job.backup.pk, 'job': job.pk}}
-        self.processes.update(data)
-        process.start()
-        logger.debug(f'Forking process {process.pid} for {job.backup} backup')
-        return process
+        run_backup(job_id, commit_queue=commit_queue)
 
     def handle_stuck_jobs(self):
         jobs = BackupJob.objects.filter(
@@ -192,49 +296,72 @@ class BackupRunner(JobRunner):
             started__gte=timezone.now() + timedelta(seconds=job_frequency),
         )
         for job in jobs:
-            if self.processes.get(job.backup.pk):
-                process = self.processes.get(job.backup.pk)
-                if process.is_alive():
-                    process.terminate()
-                del self.processes[job.backup.pk]
+            self.executor.terminate(job.pk)
+            self.dispatcher.release(job.pk)
             job.status = JobStatusChoices.STATUS_ERRORED
             if not job.data:
                 job.data = {}
             job.data.update({'error': 'Process terminated'})
-        BackupJob.objects.bulk_update(jobs, ['status', 'data'])
+        with transaction.atomic():
+            BackupJob.objects.bulk_update(jobs, ['status', 'data'])
+            BackupStatus.refresh(job.backup_id for job in jobs)
+
+    def handle_commits(self, flush=False):
+        try:
+            committed = self.coordinator.collect()
+            if flush:
+                committed.extend(self.coordinator.flush())
+        except Exception as e:
+            logger.error(f'Unable to commit collected backups: {e}')
+            logger.debug(f'\t{traceback.format_exc()}')
+            return
+        if committed:
+            status = self.job.data.setdefault('status', {})
+            status.update(
+                {
+                    'committed': status.get('committed', 0) + len(committed),
+                    'completed': status.get('completed', 0) + self.count_finished(committed),
+                }
+            )
+            self.job.save()
+
+    def count_finished(self, pks):
+        # A job is finished either by its worker or, when its config goes through the commit coordinator, by a flush,
+        # and whichever is seen second must not count it again
+        pks = set(pks) - self.finished
+        self.finished.update(pks)
+        return len(pks)
 
     def handle_processes(self):
-        for pk in list(self.processes.keys()):
-            completed = self.job.data.get('status', {}).get('completed', 0)
-
-            process = self.processes.get(pk, {}).get('process')
-            job_pk = self.processes.get(pk, {}).get('job')
-            backup = self.processes.get(pk, {}).get('backup')
-            if not process.is_alive():
-                logger.debug(f'Terminating process {process.pid} with job pk of {pk} for {backup}')
-                process.terminate()
-                del self.processes[pk]
-                job = BackupJob.objects.filter(pk=job_pk).first()
-                job.refresh_from_db()
-                if job and job.status not in [
-                    JobStatusChoices.STATUS_COMPLETED,
-                    JobStatusChoices.STATUS_FAILED,
-                    JobStatusChoices.STATUS_ERRORED,
-                ]:
-                    logger.debug(f'Job status not completed for {backup}: {job.status}')
-                else:
-                    job.data.update(
-                        {
-                            'status': {'completed': completed},
-                            'job': {
-                                'status': job.status,
-                                'pid': process.pid,
-                                'exitcode': process.exitcode,
-                            },
-                        }
-                    )
-                    job.save()
+        completed = self.job.data.get('status', {}).get('completed', 0)
+        for pk, info in self.executor.reap():
+            logger.debug(f'Reaping job pk of {pk}')
+            self.dispatcher.release(pk)
+            job = BackupJob.objects.filter(pk=pk).first()
+            if job is None:
+                continue
+            if job.status not in [
+                JobStatusChoices.STATUS_COMPLETED,
+                JobStatusChoices.STATUS_FAILED,
+                JobStatusChoices.STATUS_ERRORED,
+            ]:
+                logger.debug(f'Job status not completed for {job.backup}: {job.status}')
+            else:
+                completed += self.count_finished([pk])
+                if not job.data:
+                    job.data = {}
+                job.data.update(
+                    {
+                        'status': {'completed': completed},
+                        'job': {
+                            'status': job.status,
+                            **info,
+                        },
+                    }
+                )
+                job.save()
 
+        self.job.data.setdefault('status', {}).update({'completed': completed, **self.dispatcher.status})
         self.job.save()
         self.job.refresh_from_db()
 
@@ -260,23 +387,28 @@ class BackupRunner(JobRunner):
         self.job.data.update({'status': {'terminated': 1}})
         if process != 'Child':
             self.running = False
-            for pk in list(self.processes.keys()):
-                process = self.processes.get(pk, {}).get('process')
-                job_pk = self.processes.get(pk, {}).get('job')
-                job = BackupJob.objects.filter(pk=job_pk).first()
-                job.status = JobStatusChoices.STATUS_ERRORED
-                job.data.update({'error': f'{process}: {code}'})
-                job.clean()
-                job.save()
-                process.terminate()
-                try:
-                    process.join()
-                except AssertionError:
-                    pass
+            touched = set()
+            for pk in list(self.executor.tasks.keys()):
+                job = BackupJob.objects.filter(pk=pk).first()
+                if job is not None:
+                    job.status = JobStatusChoices.STATUS_ERRORED
+                    job.data.update({'error': f'{process}: {code}'})
+                    job.clean()
+                    job.save()
+                    touched.add(job.backup_id)
+            self.executor.shutdown()
+            self.handle_commits(flush=True)
+
+            # Jobs that never started were never claimed, so they are still scheduled for the next runner
+            self.dispatcher.clear()
+            BackupStatus.refresh(touched)
 
     def run(self, backup=None, device=None, *args, **kwargs):
 
-        self.ctx = multiprocessing.get_context()
+        self.executor = get_executor(self)
+        self.dispatcher = get_dispatcher()
+        self.coordinator = get_coordinator(self.executor.queue)
+        self.finished = set()
         self.running = True
 
         signal.signal(signal.SIGTERM, self.handle_main_exit)
@@ -296,13 +428,13 @@ class BackupRunner(JobRunner):
             self.job.save()
             self.run_processes(backup=backup)
 
-            self.handle_processes()
-            self.handle_stuck_jobs()
-
             while self.running:
+                self.dispatch_jobs()
                 self.handle_processes()
                 self.handle_stuck_jobs()
-                if len(self.processes) == 0:
+                self.handle_commits()
+                if len(self.executor) == 0 and not self.dispatcher:
+                    self.handle_commits(flush=True)
                     self.running = False
                 time.sleep(1)
         except JobExit as e:
@@ -317,3 +449,5 @@ class BackupRunner(JobRunner):
             logger.warning(f'{traceback.format_exc()}')
             logger.error(f'{e}')
             raise e
+        finally:
+            self.executor.shutdown()
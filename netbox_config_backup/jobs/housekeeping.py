@@ -9,6 +9,7 @@ from core.models import Job
 from netbox import settings
 from netbox.jobs import JobRunner, system_job
 
+from netbox_config_backup.backup.retention import get_retention
 from netbox_config_backup.jobs import BackupRunner
 
 __all__ = 'BackupHousekeeping'
@@ -39,3 +40,8 @@ class BackupHousekeeping(JobRunner):
                     logger.info(f'\tNew Backup Job Runner enqueued as {job} ({job.pk})')
         else:
             logger.info('No stale jobs')
+
+        retention = get_retention()
+        if retention.enabled:
+            deleted = retention.prune()
+            logger.info(f'Deleted {deleted} expired backup jobs')
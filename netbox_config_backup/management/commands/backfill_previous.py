@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+
+class Command(BaseCommand):
+    help = 'Link every backup change to the previous change of the same file'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=5000,
+            help='Number of changes updated per transaction',
+        )
+
+    def handle(self, *args, **options):
+        from netbox_config_backup.models import BackupCommitTreeChange
+
+        batch_size = max(options['batch_size'], 1)
+        changes = (
+            BackupCommitTreeChange.objects.annotate_previous()
+            .order_by()
+            .values_list('pk', 'previous_change_id', 'previous_pk')
+        )
+
+        checked = 0
+        updated = 0
+        pending = []
+        for pk, current, previous in changes.iterator(chunk_size=batch_size):
+            checked += 1
+            if current != previous:
+                pending.append(BackupCommitTreeChange(pk=pk, previous_change_id=previous))
+            if len(pending) >= batch_size:
+                updated += self.update(pending)
+                pending = []
+                print(f'Checked {checked} changes, updated {updated}')
+        updated += self.update(pending)
+        print(f'Checked {checked} changes, updated {updated}')
+
+    @staticmethod
+    def update(changes):
+        from netbox_config_backup.models import BackupCommitTreeChange
+
+        if not changes:
+            return 0
+        with transaction.atomic():
+            BackupCommitTreeChange.objects.bulk_update(changes, ['previous_change'])
+        return len(changes)
@@ -0,0 +1,167 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = 'Print the query plans of the backup scheduler and list view queries, optionally against synthetic data'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--jobs',
+            dest='jobs',
+            type=int,
+            default=0,
+            help='Number of synthetic backup jobs to generate before explaining (rolled back afterwards)',
+        )
+        parser.add_argument(
+            '--backups',
+            dest='backups',
+            type=int,
+            default=10000,
+            help='Number of synthetic backups the synthetic jobs are spread over',
+        )
+        parser.add_argument(
+            '--compare',
+            dest='compare',
+            action='store_true',
+            help='Explain the queries again with the plugin indexes dropped (rolled back afterwards)',
+        )
+        parser.add_argument(
+            '--parsers',
+            dest='parsers',
+            type=int,
+            default=0,
+            help='Instead of explaining queries, time this many parses of each config save time parser',
+        )
+        parser.add_argument(
+            '--analyze',
+            dest='analyze',
+            action='store_true',
+            help='Run the queries and report actual timings (EXPLAIN ANALYZE)',
+        )
+
+    def get_queries(self):
+        from core.choices import JobStatusChoices
+        from netbox_config_backup.models import Backup, BackupCommit, BackupCommitTreeChange, BackupJob
+
+        now = timezone.now()
+        backups = list(Backup.objects.order_by('pk').values_list('pk', flat=True)[:1000])
+        commit = BackupCommit.objects.order_by('-pk').values_list('sha', flat=True).first() or ''
+        change = BackupCommitTreeChange.objects.order_by('-pk').values_list('file_id', flat=True).first()
+
+        return {
+            'Due jobs': BackupJob.objects.filter(
+                runner=None, status=JobStatusChoices.STATUS_SCHEDULED, scheduled__lte=now
+            ),
+            'Stale jobs': BackupJob.objects.filter(
+                status__in=JobStatusChoices.ENQUEUED_STATE_CHOICES, scheduled__lt=now - timedelta(minutes=30)
+            ),
+            'Last backup': BackupJob.objects.filter(backup_id__in=backups, status=JobStatusChoices.STATUS_COMPLETED)
+            .order_by()
+            .values('backup_id')
+            .annotate(value=Max('completed')),
+            'Next attempt': BackupJob.objects.filter(
+                backup_id__in=backups, status__in=JobStatusChoices.ENQUEUED_STATE_CHOICES
+            )
+            .order_by()
+            .values('backup_id')
+            .annotate(value=Max('scheduled')),
+            'Previous change': BackupCommitTreeChange.objects.filter(file_id=change).order_by(
+                '-commit__time', '-pk'
+            )[:1],
+            'Commit lookup': BackupCommit.objects.filter(sha=commit),
+            'Backup list': Backup.objects.default_annotate().order_by('-last_backup')[:50],
+        }
+
+    def explain(self, title, analyze=False):
+        print(f'==== {title} ====')
+        for name, queryset in self.get_queries().items():
+            print(f'-- {name}')
+            print(queryset.explain(analyze=analyze) if analyze else queryset.explain())
+            print()
+
+    def populate(self, jobs, backups):
+        from netbox_config_backup.models import Backup, BackupJob, BackupStatus
+
+        print(f'Generating {backups} backups and {jobs} jobs')
+        created = Backup.objects.bulk_create(
+            [Backup(name=f'benchmark-{idx}') for idx in range(backups)], batch_size=5000
+        )
+        pks = [backup.pk for backup in created]
+
+        table = BackupJob._meta.db_table
+        with connection.cursor() as cursor:
+            # Mostly completed jobs, one scheduled job per backup cycle and a sprinkling of failures
+            cursor.execute(
+                f'''
+                INSERT INTO {table}
+                    (created, custom_field_data, backup_id, scheduled, started, completed, status, job_id)
+                SELECT
+                    now() - (n || ' minutes')::interval,
+                    '{{}}'::jsonb,
+                    (%(pks)s::bigint[])[1 + n %% %(count)s],
+                    now() - (n || ' minutes')::interval,
+                    now() - (n || ' minutes')::interval,
+                    CASE WHEN n < %(count)s THEN NULL ELSE now() - (n || ' minutes')::interval END,
+                    CASE
+                        WHEN n < %(count)s THEN 'scheduled'
+                        WHEN n %% 50 = 0 THEN 'failed'
+                        WHEN n %% 97 = 0 THEN 'errored'
+                        ELSE 'completed'
+                    END,
+                    gen_random_uuid()
+                FROM generate_series(0, %(jobs)s - 1) AS n
+                ''',
+                {'pks': pks, 'count': len(pks), 'jobs': jobs},
+            )
+            cursor.execute(f'ANALYZE {table}')
+
+        BackupStatus.refresh(pks)
+        print('Generated synthetic data')
+
+    def drop_indexes(self):
+        from netbox_config_backup.models import BackupCommitTreeChange, BackupJob
+
+        with connection.schema_editor() as editor:
+            for model in (BackupJob, BackupCommitTreeChange):
+                for index in model._meta.indexes:
+                    print(f'Dropping index {index.name}')
+                    editor.remove_index(model, index)
+
+    def benchmark_parsers(self, iterations):
+        from netbox_config_backup.utils.parsers import PARSERS
+
+        print(f'Timing {iterations} parses per parser')
+        for driver, parsers in PARSERS.items():
+            for file, parser in parsers.items():
+                if not parser.example:
+                    continue
+                text = f'version 1\n{parser.example}\nhostname device\n'
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    parser.parse(parser.find(text))
+                elapsed = time.perf_counter() - started
+                print(f'{driver:>10} {file:>8}: {elapsed / iterations * 1000000:.2f} us/parse')
+
+    def handle(self, *args, **options):
+        if options['parsers']:
+            self.benchmark_parsers(options['parsers'])
+            return
+
+        with transaction.atomic():
+            if options['jobs']:
+                self.populate(jobs=options['jobs'], backups=max(options['backups'], 1))
+
+            self.explain('With indexes', analyze=options['analyze'])
+            if options['compare']:
+                self.drop_indexes()
+                self.explain('Without indexes', analyze=options['analyze'])
+
+            # Nothing done here is ever kept
+            transaction.set_rollback(True)
+        print('Rolled back benchmark data')
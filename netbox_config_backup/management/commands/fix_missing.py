@@ -1,90 +1,76 @@
 import datetime
-from django.core.management.base import BaseCommand
+import os
 
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date, parse_datetime
 
-class Command(BaseCommand):
-    def handle(self, *args, **options):
-        from netbox_config_backup.git import repository
-        from netbox_config_backup.models import (
-            Backup,
-            BackupCommit,
-            BackupFile,
-            BackupObject,
-            BackupCommitTreeChange,
-        )
 
-        LOCAL_TIMEZONE = (
-            datetime.datetime.now(datetime.timezone.utc).astimezone().tzinfo
-        )
-
-        print('Fetching Git log')
-        log = reversed(repository.log())
-        print('Fetched Git log')
+def parse_time(value):
+    time = parse_datetime(value)
+    if time is None and parse_date(value) is not None:
+        time = datetime.datetime.combine(parse_date(value), datetime.time())
+    if time is None:
+        raise CommandError(f'Invalid date/time: {value}')
+    if time.tzinfo is None:
+        time = time.astimezone()
+    return time
 
-        for entry in log:
-            time = entry.get('time', datetime.datetime.now()).replace(
-                tzinfo=LOCAL_TIMEZONE
-            )
 
-            try:
-                bc = BackupCommit.objects.get(sha=entry.get('sha', None))
-            except BackupCommit.DoesNotExist:
-                bc = BackupCommit(sha=entry.get('sha', None), time=time)
-            print(
-                f'Saving commit: {bc.sha} at time {bc.time} with parent {entry.get("parents", [])}'
-            )
-            bc.save()
-            for change in entry.get('changes'):
-                backup = None
-                backupfile = None
+class Command(BaseCommand):
+    help = 'Index git commits which are missing from the database, resuming from the newest indexed commit'
 
-                change_data = {}
-                for key in ['old', 'new']:
-                    sha = change.get(key, {}).get('sha', None)
-                    file = change.get(key, {}).get('path', None)
-                    if file is not None and file is not None:
-                        uuid, type = file.split('.')
-                        try:
-                            backup = Backup.objects.get(uuid=uuid)
-                        except Backup.DoesNotExist:
-                            backup = Backup.objects.create(uuid=uuid, name=uuid)
-                        try:
-                            backupfile = BackupFile.objects.get(
-                                backup=backup, type=type
-                            )
-                        except BackupFile.DoesNotExist:
-                            backupfile = BackupFile.objects.create(
-                                backup=backup, type=type
-                            )
-                        try:
-                            object = BackupObject.objects.get(sha=sha)
-                        except BackupObject.DoesNotExist:
-                            object = BackupObject.objects.create(sha=sha)
-                        change_data[key] = object
+    def add_arguments(self, parser):
+        parser.add_argument('--since', dest='since', type=parse_time, help='Only index commits made after this time')
+        parser.add_argument(
+            '--until', dest='until', type=parse_time, help='Only index commits made before this time'
+        )
+        parser.add_argument(
+            '--full', dest='full', action='store_true', help='Walk the entire history instead of resuming'
+        )
+        parser.add_argument(
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=5000,
+            help='Number of changes written per transaction',
+        )
+        parser.add_argument(
+            '--workers',
+            dest='workers',
+            type=int,
+            default=os.cpu_count(),
+            help='Number of processes computing tree changes (1 to index in this process)',
+        )
 
-                    index = f'{key}-{sha}-{file}'
-                    print(f'\t\t{index}')
+    def handle(self, *args, **options):
+        from netbox_config_backup.backup.indexer import HistoryIndexer
+        from netbox_config_backup.git import repository
+        from netbox_config_backup.models import BackupCommit
 
+        exclude = None
+        if not options['full'] and not options['since']:
+            last = BackupCommit.objects.order_by('-time', '-pk').first()
+            if last is not None:
                 try:
-                    bctc = BackupCommitTreeChange.objects.get(
-                        backup=backup,
-                        file=backupfile,
-                        commit=bc,
-                        type=change.get('type', None),
-                        old=change_data.get('old', None),
-                        new=change_data.get('new', None),
-                    )
-                except BackupCommitTreeChange.DoesNotExist:
-                    bctc = BackupCommitTreeChange.objects.create(
-                        backup=backup,
-                        file=backupfile,
-                        commit=bc,
-                        type=change.get('type', None),
-                        old=change_data.get('old', None),
-                        new=change_data.get('new', None),
-                    )
+                    repository.repository[last.sha.encode('ascii')]
+                    exclude = [last.sha]
+                    print(f'Resuming after commit {last.sha} at time {last.time}')
+                except KeyError:
+                    print(f'Last indexed commit {last.sha} is not in the repository, walking the entire history')
+
+        print('Loading lookup tables')
+        indexer = HistoryIndexer(batch_size=options['batch_size'])
 
-                newsha = bctc.new.sha if bctc.new else None
-                oldsha = bctc.old.sha if bctc.old else None
-                print(f'\tSaving change {bc.sha}, {oldsha}, {newsha}')
-            print("")
+        print('Indexing Git log')
+        log = repository.log(
+            reverse=True,
+            exclude=exclude,
+            since=options['since'],
+            until=options['until'],
+            fields=('sha', 'time') if options['workers'] > 1 else ('sha', 'time', 'changes'),
+        )
+        if options['workers'] > 1:
+            indexed = indexer.index_parallel(log, workers=options['workers'])
+        else:
+            indexed = indexer.index(log)
+        print(f'Indexed {indexed["commits"]} commits and {indexed["changes"]} changes')
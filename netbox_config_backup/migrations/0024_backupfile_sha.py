@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netbox_config_backup', '0023_netbox_v040500'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backupfile',
+            name='sha',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,50 @@
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models.functions import Lag
+
+
+def populate_previous_change(apps, schema_editor):
+    BackupCommitTreeChange = apps.get_model('netbox_config_backup', 'BackupCommitTreeChange')
+
+    changes = (
+        BackupCommitTreeChange.objects.annotate(
+            previous_pk=models.Window(
+                expression=Lag('pk'),
+                partition_by=[models.F('backup_id'), models.F('file_id')],
+                order_by=[models.F('commit__time').asc(), models.F('pk').asc()],
+            )
+        )
+        .order_by()
+        .values_list('pk', 'previous_pk')
+    )
+
+    pending = []
+    for pk, previous in changes.iterator(chunk_size=5000):
+        if previous is not None:
+            pending.append(BackupCommitTreeChange(pk=pk, previous_change_id=previous))
+        if len(pending) >= 5000:
+            BackupCommitTreeChange.objects.bulk_update(pending, ['previous_change'])
+            pending = []
+    BackupCommitTreeChange.objects.bulk_update(pending, ['previous_change'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netbox_config_backup', '0024_backupfile_sha'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backupcommittreechange',
+            name='previous_change',
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name='+',
+                to='netbox_config_backup.backupcommittreechange',
+            ),
+        ),
+        migrations.RunPython(populate_previous_change, migrations.RunPython.noop),
+    ]
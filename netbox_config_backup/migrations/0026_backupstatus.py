@@ -0,0 +1,67 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+from core.choices import JobStatusChoices
+
+
+def populate_status(apps, schema_editor):
+    Backup = apps.get_model('netbox_config_backup', 'Backup')
+    BackupJob = apps.get_model('netbox_config_backup', 'BackupJob')
+    BackupCommitTreeChange = apps.get_model('netbox_config_backup', 'BackupCommitTreeChange')
+    BackupStatus = apps.get_model('netbox_config_backup', 'BackupStatus')
+
+    def latest(queryset, field):
+        return dict(
+            queryset.order_by().values('backup_id').annotate(value=models.Max(field)).values_list('backup_id', 'value')
+        )
+
+    last_backup = latest(BackupJob.objects.filter(status=JobStatusChoices.STATUS_COMPLETED), 'completed')
+    next_attempt = latest(
+        BackupJob.objects.filter(status__in=JobStatusChoices.ENQUEUED_STATE_CHOICES), 'scheduled'
+    )
+    last_change = latest(BackupCommitTreeChange.objects.all(), 'commit__time')
+
+    BackupStatus.objects.bulk_create(
+        [
+            BackupStatus(
+                backup_id=pk,
+                last_backup=last_backup.get(pk),
+                next_attempt=next_attempt.get(pk),
+                last_change=last_change.get(pk),
+            )
+            for pk in Backup.objects.values_list('pk', flat=True)
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netbox_config_backup', '0025_backupcommittreechange_previous_change'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackupStatus',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('last_backup', models.DateTimeField(blank=True, null=True)),
+                ('next_attempt', models.DateTimeField(blank=True, null=True)),
+                ('last_change', models.DateTimeField(blank=True, null=True)),
+                (
+                    'backup',
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='summary',
+                        to='netbox_config_backup.backup',
+                    ),
+                ),
+            ],
+            options={
+                'verbose_name_plural': 'backup statuses',
+                'ordering': ('pk',),
+            },
+        ),
+        migrations.RunPython(populate_status, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+from django.db import migrations, models
+
+
+def dedupe_commits(apps, schema_editor):
+    BackupCommit = apps.get_model('netbox_config_backup', 'BackupCommit')
+    BackupCommitTreeChange = apps.get_model('netbox_config_backup', 'BackupCommitTreeChange')
+
+    duplicates = (
+        BackupCommit.objects.order_by()
+        .values('sha')
+        .annotate(count=models.Count('pk'), keep=models.Min('pk'))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        others = BackupCommit.objects.filter(sha=duplicate['sha']).exclude(pk=duplicate['keep'])
+        BackupCommitTreeChange.objects.filter(commit__in=others).update(commit_id=duplicate['keep'])
+        others.delete()
+
+        # The same change may have been recorded against each copy of the commit
+        changes = (
+            BackupCommitTreeChange.objects.filter(commit_id=duplicate['keep'])
+            .order_by()
+            .values('backup_id', 'file_id')
+            .annotate(count=models.Count('pk'), keep=models.Min('pk'))
+            .filter(count__gt=1)
+        )
+        for change in changes:
+            BackupCommitTreeChange.objects.filter(
+                commit_id=duplicate['keep'], backup_id=change['backup_id'], file_id=change['file_id']
+            ).exclude(pk=change['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netbox_config_backup', '0026_backupstatus'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_commits, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netbox_config_backup', '0027_dedupe_backupcommit'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='backupcommit',
+            name='sha',
+            field=models.CharField(max_length=64, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='backupjob',
+            index=models.Index(fields=['status', 'scheduled'], name='ncb_job_status_scheduled'),
+        ),
+        migrations.AddIndex(
+            model_name='backupjob',
+            index=models.Index(fields=['backup', 'status', 'completed'], name='ncb_job_backup_completed'),
+        ),
+        migrations.AddIndex(
+            model_name='backupjob',
+            index=models.Index(
+                condition=models.Q(('status__in', ['pending', 'scheduled', 'running'])),
+                fields=['backup', 'scheduled'],
+                name='ncb_job_enqueued',
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='backupcommittreechange',
+            index=models.Index(fields=['backup', 'file', 'commit'], name='ncb_change_backup_file_commit'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netbox_config_backup', '0028_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackupJobRollup',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('date', models.DateField()),
+                ('completed', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('errored', models.PositiveIntegerField(default=0)),
+                (
+                    'backup',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='job_rollups',
+                        to='netbox_config_backup.backup',
+                    ),
+                ),
+            ],
+            options={
+                'ordering': ('backup', 'date'),
+                'constraints': [
+                    models.UniqueConstraint(fields=('backup', 'date'), name='ncb_jobrollup_backup_date'),
+                ],
+            },
+        ),
+    ]
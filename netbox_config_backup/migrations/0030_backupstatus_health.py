@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netbox_config_backup', '0029_backupjobrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backupstatus',
+            name='connect_time',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='backupstatus',
+            name='fetch_time',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='backupstatus',
+            name='failures',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='backupstatus',
+            name='retry_after',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
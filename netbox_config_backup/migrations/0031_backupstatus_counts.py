@@ -0,0 +1,53 @@
+from django.db import migrations, models
+
+
+def populate_counts(apps, schema_editor):
+    BackupCommitTreeChange = apps.get_model('netbox_config_backup', 'BackupCommitTreeChange')
+    BackupStatus = apps.get_model('netbox_config_backup', 'BackupStatus')
+
+    counts = {
+        row['backup_id']: row
+        for row in BackupCommitTreeChange.objects.order_by()
+        .values('backup_id')
+        .annotate(
+            change_count=models.Count('pk'),
+            running_count=models.Count('pk', filter=models.Q(file__type='running')),
+            startup_count=models.Count('pk', filter=models.Q(file__type='startup')),
+        )
+    }
+
+    statuses = []
+    for status in BackupStatus.objects.filter(backup_id__in=counts.keys()).iterator(chunk_size=1000):
+        status.change_count = counts[status.backup_id]['change_count']
+        status.running_count = counts[status.backup_id]['running_count']
+        status.startup_count = counts[status.backup_id]['startup_count']
+        statuses.append(status)
+    BackupStatus.objects.bulk_update(
+        statuses, ['change_count', 'running_count', 'startup_count'], batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netbox_config_backup', '0030_backupstatus_health'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backupstatus',
+            name='change_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='backupstatus',
+            name='running_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='backupstatus',
+            name='startup_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(populate_counts, migrations.RunPython.noop),
+    ]
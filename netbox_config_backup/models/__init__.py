@@ -5,7 +5,8 @@ from netbox_config_backup.models.repository import (
     BackupObject,
     BackupCommitTreeChange,
 )
-from netbox_config_backup.models.jobs import BackupJob
+from netbox_config_backup.models.jobs import BackupJob, BackupJobRollup
+from netbox_config_backup.models.status import BackupStatus
 
 
 __all__ = (
@@ -15,4 +16,6 @@ __all__ = (
     'BackupObject',
     'BackupCommitTreeChange',
     'BackupJob',
+    'BackupJobRollup',
+    'BackupStatus',
 )
@@ -1,5 +1,4 @@
 import logging
-import datetime
 import uuid as uuid
 
 from django.db import models
@@ -12,7 +11,6 @@ from netbox_config_backup.choices import StatusChoices
 from netbox_config_backup.helpers import get_repository_dir
 
 from ..querysets import BackupQuerySet
-from ..utils import Differ
 
 
 logger = logging.getLogger("netbox_config_backup")
@@ -58,98 +56,50 @@ class Backup(PrimaryModel):
             'startup': startup if startup is not None else '',
         }
 
-    def set_config(self, configs, files=('running', 'startup'), pk=None):
-        from netbox_config_backup.models.repository import (
-            BackupCommit,
-            BackupObject,
-            BackupFile,
-            BackupCommitTreeChange,
-        )
-        from netbox_config_backup.git import repository
-
-        LOCAL_TIMEZONE = (
-            datetime.datetime.now(datetime.timezone.utc).astimezone().tzinfo
-        )
+    def get_changed_configs(self, configs, files=('running', 'startup')):
+        """
+        Return the configs which differ from the stored ones.  The blob SHA of each collected config is compared to
+        the one recorded on the BackupFile (or, failing that, in the repository tree), so unchanged configs are never
+        read back from the repository or diffed.
+        """
+        from netbox_config_backup.git import get_blob_sha, repository
 
-        stored_configs = self.get_config()
-        changes = False
+        stored_files = {backupfile.type: backupfile for backupfile in self.files.all()}
+        changed = {}
         for file in files:
-            # logger.debug(f'[{pk}] Getting existing config for {file}')
-            stored = (
-                stored_configs.get(file) if stored_configs.get(file) is not None else ''
-            )
-            # logger.debug(f'[{pk}] Getting new config')
             current = configs.get(file) if configs.get(file) is not None else ''
 
-            # logger.debug(f'[{pk}] Starting diff for {file}')
-            if Differ(stored, current).is_diff():
-                changes = True
-                output = repository.write(f'{self.uuid}.{file}', current)  # noqa: F841
-            # logger.debug(f'[{pk}] Finished diff for {file}')
-        if not changes:
+            backupfile = stored_files.get(file)
+            stored = backupfile.sha if backupfile is not None else None
+            if stored is None:
+                stored = repository.sha(f'{self.uuid}.{file}')
+                if stored is not None and backupfile is not None:
+                    # Files last changed before SHAs were recorded get theirs from the repository, once
+                    backupfile.sha = stored
+                    backupfile.save(update_fields=['sha'])
+            if stored is None and current == '':
+                continue
+
+            if stored != get_blob_sha(current):
+                changed[file] = current
+        return changed
+
+    def get_commit_message(self):
+        return f'Backup of {self.device.name} for backup {self.name}'
+
+    def set_config(self, configs, files=('running', 'startup'), pk=None):
+        from netbox_config_backup.models.repository import BackupCommit
+        from netbox_config_backup.git import repository
+
+        changed = self.get_changed_configs(configs, files=files)
+        if not changed:
             return None
 
-        # logger.debug(f'[{pk}] Commiting files')
-        commit = repository.commit(
-            f'Backup of {self.device.name} for backup {self.name}'
-        )
-
-        # logger.debug(f'[{pk}] Getting repository log')
-        log = repository.log(index=commit, depth=1)[0]
-
-        # logger.debug(f'[{pk}] Saving commit to DB')
-        bc = BackupCommit.objects.filter(sha=commit)
-        time = log.get('time', datetime.datetime.now()).replace(tzinfo=LOCAL_TIMEZONE)
-        if bc.count() > 0:
-            # logger.debug(f'[{pk}] Error committing')
-            raise Exception('Commit already exists for this backup and sha value')
-        else:
-            # logger.debug(f'[{pk}] Saving commit')
-            bc = BackupCommit(sha=commit, time=time)
-            logger.debug(f'{self}: {commit}:{bc.time}')
-            bc.save()
-
-        for change in log.get('changes', []):
-            # logger.debug(f'[{pk}] Adding backup tree changes')
-            backupfile = None
-            change_data = {}
-            for key in ['old', 'new']:
-                sha = change.get(key, {}).get('sha', None)
-                file = change.get(key, {}).get('path', None)
-                if sha is not None and file is not None:
-                    uuid, type = file.split('.')  # noqa: F841
-                    try:
-                        object = BackupObject.objects.get(sha=sha)
-                    except BackupObject.DoesNotExist:
-                        object = BackupObject.objects.create(sha=sha)
-                    try:
-                        backupfile = BackupFile.objects.get(backup=self, type=type)
-                    except BackupFile.DoesNotExist:
-                        backupfile = BackupFile.objects.create(backup=self, type=type)
-                    change_data[key] = object
-
-            bctc = BackupCommitTreeChange.objects.filter(
-                backup=self,
-                file=backupfile,
-                commit=bc,
-                type=change.get('type', None),
-                old=change_data.get('old', None),
-                new=change_data.get('new', None),
-            )
-            if bctc.count() > 0:
-                bctc = bctc.first()
-            elif bctc.count() == 0:
-                bctc = BackupCommitTreeChange(
-                    backup=self,
-                    file=backupfile,
-                    commit=bc,
-                    type=change.get('type', None),
-                    old=change_data.get('old', None),
-                    new=change_data.get('new', None),
-                )
-                bctc.save()
-                # logger.debug(f'[{pk}] Tree saved')
-        # logger.debug(f'[{pk}] Get config saved')
+        files = {f'{self.uuid}.{file}': current for file, current in changed.items()}
+        commit = repository.commit_files(files, self.get_commit_message())
+        log = next(repository.log(index=commit, depth=1, fields=('sha', 'time', 'changes')))
+        BackupCommit.record(log, backups=[self])
+
         return commit
 
     @classmethod
@@ -9,6 +9,7 @@ from django_rq import get_queue
 
 from core.choices import JobStatusChoices
 from netbox.models import NetBoxModel
+from netbox_config_backup.models.abstract import BigIDModel
 from utilities.querysets import RestrictedQuerySet
 
 
@@ -50,6 +51,15 @@ class BackupJob(NetBoxModel):
 
     class Meta:
         ordering = ('pk',)
+        indexes = (
+            models.Index(fields=('status', 'scheduled'), name='ncb_job_status_scheduled'),
+            models.Index(fields=('backup', 'status', 'completed'), name='ncb_job_backup_completed'),
+            models.Index(
+                fields=('backup', 'scheduled'),
+                condition=models.Q(status__in=JobStatusChoices.ENQUEUED_STATE_CHOICES),
+                name='ncb_job_enqueued',
+            ),
+        )
 
     def __str__(self):
         return str(self.job_id)
@@ -79,3 +89,26 @@ class BackupJob(NetBoxModel):
         self.status = status
         if status in JobStatusChoices.TERMINAL_STATE_CHOICES:
             self.completed = timezone.now()
+
+
+class BackupJobRollup(BigIDModel):
+    """
+    Daily count of a backup's finished jobs by status, kept for jobs deleted by housekeeping
+    """
+
+    backup = ForeignKey(
+        to='Backup',
+        on_delete=models.CASCADE,
+        related_name='job_rollups',
+    )
+    date = models.DateField()
+    completed = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    errored = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ('backup', 'date')
+        constraints = (models.UniqueConstraint(fields=('backup', 'date'), name='ncb_jobrollup_backup_date'),)
+
+    def __str__(self):
+        return f'{self.backup}: {self.date}'
@@ -1,13 +1,20 @@
-from django.db import models
+import datetime
+import logging
+
+from django.db import models, transaction
 from django.urls import reverse
 
 from netbox_config_backup.choices import FileTypeChoices
 from netbox_config_backup.models import Backup
 from netbox_config_backup.models.abstract import BigIDModel
+from netbox_config_backup.querysets import BackupCommitTreeChangeQuerySet
+
+
+logger = logging.getLogger("netbox_config_backup")
 
 
 class BackupCommit(BigIDModel):
-    sha = models.CharField(max_length=64)
+    sha = models.CharField(max_length=64, unique=True)
     time = models.DateTimeField()
 
     class Meta:
@@ -16,6 +23,70 @@ class BackupCommit(BigIDModel):
     def __str__(self):
         return self.sha
 
+    @classmethod
+    def record(cls, log, backups):
+        """
+        Save a git log entry, and the tree changes it made to the given backups' files, to the database
+        """
+        from netbox_config_backup.models.status import BackupStatus
+
+        LOCAL_TIMEZONE = datetime.datetime.now(datetime.timezone.utc).astimezone().tzinfo
+
+        backups = {f'{backup.uuid}': backup for backup in backups}
+        sha = log.get('sha')
+        time = log.get('time', datetime.datetime.now()).replace(tzinfo=LOCAL_TIMEZONE)
+        with transaction.atomic():
+            if cls.objects.filter(sha=sha).exists():
+                raise Exception('Commit already exists for this backup and sha value')
+            bc = cls(sha=sha, time=time)
+            bc.save()
+
+            for change in log.get('changes', []):
+                backup = None
+                backupfile = None
+                change_data = {}
+                for key in ['old', 'new']:
+                    sha = change.get(key, {}).get('sha', None)
+                    file = change.get(key, {}).get('path', None)
+                    if sha is not None and file is not None:
+                        uuid, type = file.split('.')
+                        backup = backups.get(uuid)
+                        if backup is None:
+                            continue
+                        try:
+                            object = BackupObject.objects.get(sha=sha)
+                        except BackupObject.DoesNotExist:
+                            object = BackupObject.objects.create(sha=sha)
+                        try:
+                            backupfile = BackupFile.objects.get(backup=backup, type=type)
+                        except BackupFile.DoesNotExist:
+                            backupfile = BackupFile.objects.create(backup=backup, type=type)
+                        change_data[key] = object
+
+                if backup is None or backupfile is None:
+                    continue
+
+                new = change_data.get('new', None)
+                if backupfile.sha != (new.sha if new is not None else None):
+                    backupfile.sha = new.sha if new is not None else None
+                    backupfile.save()
+
+                logger.debug(f'{backup}: {bc.sha}:{bc.time}')
+                previous = backupfile.changes.order_by('-commit__time', '-pk').values_list('pk', flat=True).first()
+                BackupCommitTreeChange.objects.get_or_create(
+                    backup=backup,
+                    file=backupfile,
+                    commit=bc,
+                    type=change.get('type', None),
+                    old=change_data.get('old', None),
+                    new=change_data.get('new', None),
+                    defaults={'previous_change_id': previous},
+                )
+
+            BackupStatus.refresh(backups.values())
+
+        return bc
+
 
 class BackupObject(BigIDModel):
     sha = models.CharField(max_length=64, unique=True)
@@ -38,6 +109,7 @@ class BackupFile(BigIDModel):
     type = models.CharField(max_length=10, choices=FileTypeChoices, null=False, blank=False)
 
     last_change = models.DateTimeField(null=True, blank=True)
+    sha = models.CharField(max_length=64, null=True, blank=True)
 
     class Meta:
         ordering = ('pk',)
@@ -50,6 +122,22 @@ class BackupFile(BigIDModel):
     def name(self):
         return f'{self.backup.uuid}'
 
+    @classmethod
+    def record_last_changes(cls, changes):
+        """
+        Save the times devices report their configs last changed, given as {backup pk: {type: time}}.  Only call this
+        once the configs have been committed: a stored time matching the device's is taken to mean the config held
+        in the repository is current, and the startup config is then no longer fetched.
+        """
+        files = list(cls.objects.filter(backup_id__in=changes.keys()))
+        updated = []
+        for backupfile in files:
+            times = changes[backupfile.backup_id]
+            if backupfile.type in times and backupfile.last_change != times[backupfile.type]:
+                backupfile.last_change = times[backupfile.type]
+                updated.append(backupfile)
+        cls.objects.bulk_update(updated, ['last_change'])
+
     @property
     def path(self):
         return f'{self.name}.{self.type}'
@@ -75,9 +163,19 @@ class BackupCommitTreeChange(BigIDModel):
     type = models.CharField(max_length=10)
     old = models.ForeignKey(to=BackupObject, on_delete=models.PROTECT, related_name='previous', null=True)
     new = models.ForeignKey(to=BackupObject, on_delete=models.PROTECT, related_name='changes', null=True)
+    previous_change = models.ForeignKey(
+        to='self',
+        on_delete=models.SET_NULL,
+        related_name='+',
+        null=True,
+        blank=True,
+    )
+
+    objects = BackupCommitTreeChangeQuerySet.as_manager()
 
     class Meta:
         ordering = ('pk',)
+        indexes = (models.Index(fields=('backup', 'file', 'commit'), name='ncb_change_backup_file_commit'),)
 
     def __str__(self):
         return f'{self.commit.sha}-{self.type}'
@@ -93,4 +191,5 @@ class BackupCommitTreeChange(BigIDModel):
 
     @property
     def previous(self):
-        return self.backup.changes.filter(file__type=self.file.type, commit__time__lt=self.commit.time).last()
+        # Linked when the change is recorded or indexed, and for older changes when migrating (see backfill_previous)
+        return self.previous_change
@@ -0,0 +1,108 @@
+import logging
+
+from django.db import models
+
+from core.choices import JobStatusChoices
+from netbox_config_backup.choices import FileTypeChoices
+from netbox_config_backup.models.abstract import BigIDModel
+from netbox_config_backup.models.backups import Backup
+from netbox_config_backup.models.jobs import BackupJob
+from netbox_config_backup.models.repository import BackupCommitTreeChange
+
+
+logger = logging.getLogger("netbox_config_backup")
+
+
+class BackupStatus(BigIDModel):
+    """
+    Summary of a backup's jobs and changes, kept up to date by `refresh()` whenever a job or commit changes state so
+    that backup lists can be filtered and sorted without aggregating the job and change tables per row.
+    """
+
+    backup = models.OneToOneField(
+        to=Backup,
+        on_delete=models.CASCADE,
+        related_name='summary',
+    )
+    last_backup = models.DateTimeField(null=True, blank=True)
+    next_attempt = models.DateTimeField(null=True, blank=True)
+    last_change = models.DateTimeField(null=True, blank=True)
+    change_count = models.PositiveIntegerField(default=0)
+    running_count = models.PositiveIntegerField(default=0)
+    startup_count = models.PositiveIntegerField(default=0)
+    # Smoothed connect and fetch durations in seconds, and the circuit breaker state, kept by DeviceHealth
+    connect_time = models.FloatField(null=True, blank=True)
+    fetch_time = models.FloatField(null=True, blank=True)
+    failures = models.PositiveIntegerField(default=0)
+    retry_after = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('pk',)
+        verbose_name_plural = 'backup statuses'
+
+    def __str__(self):
+        return f'{self.backup}'
+
+    @classmethod
+    def refresh(cls, backups=None, batch_size=1000):
+        """
+        Recompute the summary of the given backups (instances or pks), or of every backup if none are given, with one
+        grouped query per table and batch of `batch_size` backups
+        """
+        if backups is None:
+            pks = list(Backup.objects.values_list('pk', flat=True))
+        else:
+            pks = list({getattr(backup, 'pk', backup) for backup in backups if backup is not None})
+
+        for idx in range(0, len(pks), batch_size):
+            batch = pks[idx:idx + batch_size]
+            last_backup = dict(
+                BackupJob.objects.filter(backup_id__in=batch, status=JobStatusChoices.STATUS_COMPLETED)
+                .order_by()
+                .values('backup_id')
+                .annotate(value=models.Max('completed'))
+                .values_list('backup_id', 'value')
+            )
+            next_attempt = dict(
+                BackupJob.objects.filter(backup_id__in=batch, status__in=JobStatusChoices.ENQUEUED_STATE_CHOICES)
+                .order_by()
+                .values('backup_id')
+                .annotate(value=models.Max('scheduled'))
+                .values_list('backup_id', 'value')
+            )
+            changes = {
+                row['backup_id']: row
+                for row in BackupCommitTreeChange.objects.filter(backup_id__in=batch)
+                .order_by()
+                .values('backup_id')
+                .annotate(
+                    last_change=models.Max('commit__time'),
+                    change_count=models.Count('pk'),
+                    running_count=models.Count('pk', filter=models.Q(file__type=FileTypeChoices.TYPE_RUNNING)),
+                    startup_count=models.Count('pk', filter=models.Q(file__type=FileTypeChoices.TYPE_STARTUP)),
+                )
+            }
+            cls.objects.bulk_create(
+                [
+                    cls(
+                        backup_id=pk,
+                        last_backup=last_backup.get(pk),
+                        next_attempt=next_attempt.get(pk),
+                        last_change=changes.get(pk, {}).get('last_change'),
+                        change_count=changes.get(pk, {}).get('change_count', 0),
+                        running_count=changes.get(pk, {}).get('running_count', 0),
+                        startup_count=changes.get(pk, {}).get('startup_count', 0),
+                    )
+                    for pk in batch
+                ],
+                update_conflicts=True,
+                unique_fields=['backup'],
+                update_fields=[
+                    'last_backup',
+                    'next_attempt',
+                    'last_change',
+                    'change_count',
+                    'running_count',
+                    'startup_count',
+                ],
+            )
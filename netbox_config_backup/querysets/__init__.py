@@ -1,33 +1,65 @@
 from django.db import models
+from django.db.models.functions import Coalesce, Lag
 
-from core.choices import JobStatusChoices
+from dcim.choices import DeviceStatusChoices
+from netbox_config_backup.choices import StatusChoices
 from utilities.querysets import RestrictedQuerySet
 
 
 class BackupQuerySet(RestrictedQuerySet):
+    def backupable(self):
+        """
+        Backups which utils.rq.can_backup() would accept, expressed as joins so they are selected in one query
+        """
+        return self.filter(
+            ~models.Q(status=StatusChoices.STATUS_DISABLED),
+            ~models.Q(
+                device__status__in=[
+                    DeviceStatusChoices.STATUS_OFFLINE,
+                    DeviceStatusChoices.STATUS_FAILED,
+                    DeviceStatusChoices.STATUS_INVENTORY,
+                    DeviceStatusChoices.STATUS_PLANNED,
+                ]
+            ),
+            ~models.Q(device__platform__napalm__napalm_driver=''),
+            models.Q(ip__isnull=False)
+            | models.Q(device__primary_ip4__isnull=False)
+            | models.Q(device__primary_ip6__isnull=False),
+            device__isnull=False,
+            device__platform__napalm__napalm_driver__isnull=False,
+        )
+
     def default_annotate(self):
-        from netbox_config_backup.models import BackupJob, BackupCommitTreeChange
+        # Read from the BackupStatus summary rather than aggregating the job and change tables for every row
+        return self.annotate(
+            last_backup=models.F('summary__last_backup'),
+            next_attempt=models.F('summary__next_attempt'),
+            last_change=models.F('summary__last_change'),
+        ).annotate_counts()
 
+    def annotate_counts(self):
+        """
+        Annotate the number of changes to each backup, in total and per file type, from the BackupStatus summary
+        (kept by BackupStatus.refresh()) rather than counting the change table per row
+        """
         return self.annotate(
-            last_backup=models.Subquery(
-                BackupJob.objects.filter(
-                    backup=models.OuterRef('id'),
-                    status=JobStatusChoices.STATUS_COMPLETED,
-                )
-                .order_by('-completed')
-                .values('completed')[:1]
-            ),
-            next_attempt=models.Subquery(
-                BackupJob.objects.filter(
-                    backup=models.OuterRef('id'),
-                    status__in=JobStatusChoices.ENQUEUED_STATE_CHOICES,
-                )
-                .order_by('-scheduled')
-                .values('scheduled')[:1]
-            ),
-            last_change=models.Subquery(
-                BackupCommitTreeChange.objects.filter(backup=models.OuterRef('id'))
-                .order_by('-id')
-                .values('commit__time')[:1]
-            ),
+            backup_count=Coalesce(models.F('summary__change_count'), 0),
+            running_count=Coalesce(models.F('summary__running_count'), 0),
+            startup_count=Coalesce(models.F('summary__startup_count'), 0),
+        )
+
+
+class BackupCommitTreeChangeQuerySet(RestrictedQuerySet):
+    def annotate_previous(self):
+        """
+        Annotate each change with the pk of the change before it to the same backup file (`previous_pk`), computed
+        in one query with a LAG() window over (backup, file) ordered by commit time.  Filters on anything other than
+        the backup or file narrow the window, so apply those afterwards.
+        """
+        return self.annotate(
+            previous_pk=models.Window(
+                expression=Lag('pk'),
+                partition_by=[models.F('backup'), models.F('file')],
+                order_by=[models.F('commit__time').asc(), models.F('pk').asc()],
+            )
         )
@@ -16,8 +16,8 @@ class ActionButtonsColumn(tables.TemplateColumn):
       class="btn btn-sm btn-outline-dark" title="View">
         <i class="mdi mdi-cloud-download"></i>
     </a>
-    {% if record.previous %}
-        <a href="{% url 'plugins:netbox_config_backup:backup_diff' pk=record.backup.pk current=record.pk previous=record.previous.pk %}" class="btn btn-outline-dark btn-sm" title="Diff">
+    {% if record.previous_change_id %}
+        <a href="{% url 'plugins:netbox_config_backup:backup_diff' pk=record.backup_id current=record.pk previous=record.previous_change_id %}" class="btn btn-outline-dark btn-sm" title="Diff">
             <i class="mdi mdi-file-compare"></i>
         </a>
     {% endif %}
@@ -79,7 +79,9 @@ class BackupTable(BaseTable):
     last_backup = tables.DateTimeColumn()
     next_attempt = tables.DateTimeColumn()
     last_change = tables.DateTimeColumn()
-    backup_count = tables.Column(accessor='changes')
+    backup_count = tables.Column(verbose_name='Changes')
+    running_count = tables.Column(verbose_name='Running Changes')
+    startup_count = tables.Column(verbose_name='Startup Changes')
     config_status = tables.BooleanColumn(verbose_name='Config Saved')
 
     class Meta(BaseTable.Meta):
@@ -92,6 +94,8 @@ class BackupTable(BaseTable):
             'next_attempt',
             'last_change',
             'backup_count',
+            'running_count',
+            'startup_count',
         )
         default_columns = (
             'pk',
@@ -102,9 +106,6 @@ class BackupTable(BaseTable):
             'backup_count',
         )
 
-    def render_backup_count(self, value):
-        return f'{value.count()}'
-
 
 class BackupsTable(NetBoxTable):
     files = columns.ToggleColumn(accessor='pk', visible=True)
@@ -0,0 +1,496 @@
+import contextlib
+import datetime
+import io
+import queue
+import tempfile
+import threading
+import uuid
+from types import SimpleNamespace
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+
+from core.choices import JobStatusChoices
+from netbox import settings
+from netbox_config_backup.backup.commits import CommitCoordinator
+from netbox_config_backup.backup.dispatch import Dispatcher
+from netbox_config_backup.backup.executors import ProcessExecutor, ThreadExecutor, get_executor
+from netbox_config_backup.backup.indexer import HistoryIndexer
+from netbox_config_backup.backup.processing import run_backup
+from netbox_config_backup.git import GitBackup
+from netbox_config_backup.models import (
+    Backup,
+    BackupCommit,
+    BackupCommitTreeChange,
+    BackupFile,
+    BackupJob,
+    BackupStatus,
+)
+from netbox_config_backup.tests.utils import DeviceTestDataMixin
+
+
+def stub_job(pk, site=None, region=None, driver=None):
+    device = SimpleNamespace(
+        site=SimpleNamespace(pk=site, region_id=region) if site else None,
+        platform=SimpleNamespace(napalm=SimpleNamespace(napalm_driver=driver)) if driver else None,
+    )
+    return SimpleNamespace(pk=pk, backup=SimpleNamespace(device=device))
+
+
+class DispatcherTestCase(SimpleTestCase):
+    def test_unlimited(self):
+        dispatcher = Dispatcher()
+        dispatcher.extend([stub_job(pk) for pk in range(1, 6)])
+
+        self.assertEqual([job.pk for job in dispatcher.take(3)], [1, 2, 3])
+        self.assertEqual([job.pk for job in dispatcher], [4, 5])
+        self.assertEqual(dispatcher.status, {'queued': 2, 'in_flight': 3, 'in_flight_by': {}})
+
+    def test_limits(self):
+        dispatcher = Dispatcher(limits={'site': 1, 'platform': 2, 'unknown': 1})
+        dispatcher.extend(
+            [
+                stub_job(1, site=1, driver='ios'),
+                stub_job(2, site=1, driver='ios'),
+                stub_job(3, site=2, driver='ios'),
+                stub_job(4, site=3, driver='ios'),
+                stub_job(5, site=3, driver='junos'),
+                stub_job(6),
+            ]
+        )
+
+        # Jobs held back by a limit keep their place in the queue
+        self.assertEqual([job.pk for job in dispatcher.take(10)], [1, 3, 5, 6])
+        self.assertEqual([job.pk for job in dispatcher], [2, 4])
+        self.assertEqual(
+            dispatcher.status,
+            {
+                'queued': 2,
+                'in_flight': 4,
+                'in_flight_by': {'site:1': 1, 'site:2': 1, 'site:3': 1, 'platform:ios': 2, 'platform:junos': 1},
+            },
+        )
+
+        self.assertEqual(dispatcher.take(10), [])
+        dispatcher.release(1)
+        self.assertEqual([job.pk for job in dispatcher.take(10)], [2])
+        dispatcher.release(5)
+        self.assertEqual(dispatcher.take(10), [])
+        dispatcher.release(3)
+        self.assertEqual([job.pk for job in dispatcher.take(10)], [4])
+        self.assertFalse(dispatcher)
+
+    def test_region_limit(self):
+        dispatcher = Dispatcher(limits={'region': 1})
+        dispatcher.extend([stub_job(1, site=1, region=1), stub_job(2, site=2, region=1), stub_job(3, site=3)])
+
+        self.assertEqual([job.pk for job in dispatcher.take(1)], [1])
+        self.assertEqual([job.pk for job in dispatcher.take(5)], [3])
+        self.assertEqual([job.pk for job in dispatcher.clear()], [2])
+        self.assertEqual(len(dispatcher), 0)
+
+
+class ThreadExecutorTestCase(SimpleTestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.executor = ThreadExecutor(workers=1)
+        self.addCleanup(self.executor.shutdown)
+        self.addCleanup(self.release.set)
+
+    def run_backup(self, pk, commit_queue=None):
+        if pk == 3:
+            raise ValueError('Unable to connect')
+        self.release.wait(10)
+
+    def test_executor(self):
+        with mock.patch('netbox_config_backup.backup.executors.run_backup', side_effect=self.run_backup):
+            running = self.executor.submit(stub_job(1))
+            queued = self.executor.submit(stub_job(2))
+
+            self.assertEqual(len(self.executor), 2)
+            self.assertEqual(self.executor.available, 0)
+            self.assertEqual(self.executor.reap(), [])
+
+            # A job still waiting for a thread is cancelled and forgotten
+            self.executor.terminate(2)
+            self.assertTrue(queued.cancelled())
+            self.assertEqual(len(self.executor), 1)
+
+            self.release.set()
+            running.result(10)
+            self.assertEqual(self.executor.reap(), [(1, {})])
+            self.assertEqual(self.executor.available, 1)
+
+            self.executor.submit(stub_job(3)).exception(10)
+            self.assertEqual(self.executor.reap(), [(3, {'error': 'Unable to connect'})])
+            self.assertEqual(len(self.executor), 0)
+
+
+class GetExecutorTestCase(SimpleTestCase):
+    runner = SimpleNamespace(run_backup=lambda pk, commit_queue=None: None)
+
+    def get_executor(self, **config):
+        with mock.patch.dict(settings.PLUGINS_CONFIG, {'netbox_config_backup': config}):
+            return get_executor(self.runner)
+
+    def test_thread(self):
+        executor = self.get_executor(workers=4)
+        self.addCleanup(executor.shutdown)
+
+        self.assertIsInstance(executor, ThreadExecutor)
+        self.assertEqual(executor.available, 4)
+
+    def test_process(self):
+        executor = self.get_executor(executor='process', workers=0)
+
+        self.assertIsInstance(executor, ProcessExecutor)
+        self.assertEqual(executor.available, 1)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            self.get_executor(executor='unknown')
+
+
+class CommitCoordinatorTestCase(DeviceTestDataMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        device = cls.create_device('Coordinator Device', platform=None)
+        cls.backups = (
+            Backup.objects.create(name='Coordinator Backup 1', device=device),
+            Backup.objects.create(name='Coordinator Backup 2', device=device),
+        )
+
+    def setUp(self):
+        self.queue = queue.Queue()
+        self.jobs = [
+            BackupJob.objects.create(
+                backup=self.backups[idx % 2],
+                status=JobStatusChoices.STATUS_RUNNING,
+                job_id=uuid.uuid4(),
+            )
+            for idx in range(3)
+        ]
+
+    def put(self, job, running):
+        self.queue.put((job.pk, job.backup_id, {'running': running, 'startup': running}, ('running', 'startup')))
+
+    def get_statuses(self):
+        return [BackupJob.objects.get(pk=job.pk).status for job in self.jobs]
+
+    def test_batch(self):
+        coordinator = CommitCoordinator(self.queue, batch_size=10, interval=3600)
+        commits = BackupCommit.objects.count()
+        self.put(self.jobs[0], 'Superseded config')
+        self.put(self.jobs[1], 'Config 2')
+        self.put(self.jobs[2], 'Config 1')
+
+        # The first backup's first collection is superseded by its second, nothing is committed yet
+        self.assertEqual(coordinator.collect(), [self.jobs[0].pk])
+        self.assertEqual(len(coordinator), 2)
+        self.assertEqual(
+            self.get_statuses(),
+            [JobStatusChoices.STATUS_COMPLETED, JobStatusChoices.STATUS_RUNNING, JobStatusChoices.STATUS_RUNNING],
+        )
+
+        self.assertEqual(sorted(coordinator.flush()), sorted([self.jobs[1].pk, self.jobs[2].pk]))
+        self.assertFalse(coordinator)
+        self.assertEqual(self.get_statuses(), [JobStatusChoices.STATUS_COMPLETED] * 3)
+        self.assertEqual(BackupCommit.objects.count(), commits + 1)
+        self.assertEqual(self.backups[0].get_config()['running'], 'Config 1')
+        self.assertEqual(self.backups[1].get_config()['running'], 'Config 2')
+        self.assertEqual(coordinator.flush(), [])
+
+    def test_batch_size(self):
+        coordinator = CommitCoordinator(self.queue, batch_size=2, interval=3600)
+        self.put(self.jobs[1], 'Config 2')
+
+        self.assertEqual(coordinator.collect(), [])
+        self.put(self.jobs[2], 'Config 1')
+        self.assertEqual(sorted(coordinator.collect()), sorted([self.jobs[1].pk, self.jobs[2].pk]))
+
+    def test_interval(self):
+        coordinator = CommitCoordinator(self.queue, batch_size=10, interval=0)
+        self.put(self.jobs[1], 'Config 2')
+
+        self.assertEqual(coordinator.collect(), [self.jobs[1].pk])
+
+    def test_commit_error(self):
+        coordinator = CommitCoordinator(self.queue, batch_size=10, interval=3600)
+        self.put(self.jobs[1], 'Config 2')
+        self.put(self.jobs[2], 'Config 1')
+        coordinator.collect()
+
+        with mock.patch('netbox_config_backup.git.repository.commit_files', side_effect=OSError('Disk full')):
+            self.assertEqual(len(coordinator.flush()), 2)
+
+        for job in BackupJob.objects.filter(pk__in=[self.jobs[1].pk, self.jobs[2].pk]):
+            self.assertEqual(job.status, JobStatusChoices.STATUS_ERRORED)
+            self.assertEqual(job.data['error'], 'Disk full')
+
+
+class HistoryIndexerTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.backup = Backup.objects.create(name='Indexed Backup')
+
+    def get_entry(self, idx, old=None):
+        return {
+            'sha': f'{idx:040x}',
+            'time': datetime.datetime(2024, 3, 5, 10, idx),
+            'changes': [
+                {
+                    'type': 'modify' if old else 'add',
+                    'old': {'path': f'{self.backup.uuid}.running' if old else None, 'sha': old},
+                    'new': {'path': f'{self.backup.uuid}.running', 'sha': f'{idx + 100:040x}'},
+                }
+            ],
+        }
+
+    def test_index(self):
+        entries = [self.get_entry(1), self.get_entry(2, old=f'{101:040x}'), self.get_entry(3, old=f'{102:040x}')]
+
+        indexed = HistoryIndexer(batch_size=1, output=lambda line: None).index(entries[:2])
+        self.assertEqual(indexed, {'commits': 2, 'changes': 2})
+
+        # A second run skips what is indexed and chains on to the changes indexed before
+        indexed = HistoryIndexer(output=lambda line: None).index(entries)
+        self.assertEqual(indexed, {'commits': 1, 'changes': 1})
+
+        changes = list(BackupCommitTreeChange.objects.order_by('commit__time'))
+        self.assertEqual(len(changes), 3)
+        self.assertEqual([change.previous_change_id for change in changes], [None, changes[0].pk, changes[1].pk])
+        self.assertEqual(BackupFile.objects.get(backup=self.backup, type='running').sha, f'{103:040x}')
+        self.assertEqual(BackupStatus.objects.get(backup=self.backup).last_change, changes[2].commit.time)
+
+
+class TemporaryRepositoryMixin:
+    """
+    Points the repository at an empty temporary one for the duration of each test
+    """
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.plugins_config = {'netbox_config_backup': {'repository': directory.name}}
+        with mock.patch.dict(settings.PLUGINS_CONFIG, self.plugins_config):
+            self.repository = GitBackup()
+        patcher = mock.patch('netbox_config_backup.git.repository', self.repository)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def commit(self, day, configs):
+        """
+        Commit configs of the backup at noon on the given day of March 2024, without indexing them
+        """
+        files = {f'{self.backup.uuid}.{file}': config for file, config in configs.items()}
+        with mock.patch('time.time', return_value=datetime.datetime(2024, 3, day, 12).timestamp()):
+            return self.repository.commit_files(files, f'Day {day}')
+
+
+class FixMissingTestCase(TemporaryRepositoryMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.backup = Backup.objects.create(name='Missing Backup')
+
+    def setUp(self):
+        super().setUp()
+        self.shas = [self.commit(day, {'running': f'Version {day}'}) for day in range(1, 4)]
+
+    def fix_missing(self, *args):
+        """
+        Run the command in this process, returning the keyword arguments the git log was walked with
+        """
+        with mock.patch.object(self.repository, 'log', wraps=self.repository.log) as log:
+            with contextlib.redirect_stdout(io.StringIO()):
+                call_command('fix_missing', '--workers', '1', *args)
+        return log.call_args.kwargs
+
+    def get_indexed(self):
+        return list(BackupCommit.objects.order_by('time').values_list('sha', flat=True))
+
+    def test_resume(self):
+        self.assertIsNone(self.fix_missing('--until', '2024-03-02T18:00:00')['exclude'])
+        self.assertEqual(self.get_indexed(), self.shas[:2])
+
+        # Only the commits after the newest indexed one are walked
+        self.assertEqual(self.fix_missing()['exclude'], [self.shas[1]])
+        self.assertEqual(self.get_indexed(), self.shas)
+        self.assertEqual(self.fix_missing()['exclude'], [self.shas[2]])
+        self.assertEqual(self.get_indexed(), self.shas)
+
+    def test_full(self):
+        self.fix_missing('--since', '2024-03-02')
+        self.assertEqual(self.get_indexed(), self.shas[1:])
+
+        # Resuming cannot find the gap before the newest indexed commit, walking the entire history does
+        self.fix_missing()
+        self.assertEqual(self.get_indexed(), self.shas[1:])
+        self.assertIsNone(self.fix_missing('--full')['exclude'])
+        self.assertEqual(self.get_indexed(), self.shas)
+
+    def test_batch_size(self):
+        with mock.patch('netbox_config_backup.backup.indexer.BackupStatus.refresh') as refresh:
+            self.fix_missing('--batch-size', '1')
+
+        # One batch, and so one transaction, per change
+        self.assertEqual(refresh.call_count, 3)
+        self.assertEqual(self.get_indexed(), self.shas)
+        changes = list(BackupCommitTreeChange.objects.order_by('commit__time'))
+        self.assertEqual([change.previous_change_id for change in changes], [None, changes[0].pk, changes[1].pk])
+
+
+class IndexParallelTestCase(TemporaryRepositoryMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.backup = Backup.objects.create(name='Parallel Backup')
+
+    @staticmethod
+    def get_changes():
+        return sorted(
+            BackupCommitTreeChange.objects.values_list(
+                'commit__sha', 'file__type', 'old__sha', 'new__sha', 'previous_change__commit__sha'
+            )
+        )
+
+    def test_index_parallel(self):
+        for day in range(1, 8):
+            self.commit(day, {'running': f'Running {day}', 'startup': f'Startup {day // 2}'})
+
+        serial = HistoryIndexer(output=lambda line: None).index(self.repository.log(reverse=True))
+        changes = self.get_changes()
+        self.assertEqual(serial, {'commits': 7, 'changes': 11})
+
+        BackupCommitTreeChange.objects.all().delete()
+        BackupCommit.objects.all().delete()
+        indexer = HistoryIndexer(batch_size=2, output=lambda line: None)
+        # The test's database connection stays open, the workers never use it
+        with mock.patch('netbox_config_backup.backup.indexer.close_db'):
+            with mock.patch.dict(settings.PLUGINS_CONFIG, self.plugins_config):
+                parallel = indexer.index_parallel(
+                    self.repository.log(reverse=True, fields=('sha', 'time')), workers=2, chunk_size=3
+                )
+
+        self.assertEqual(parallel, serial)
+        self.assertEqual(self.get_changes(), changes)
+
+
+class StubDriver:
+    hostname = 'switch'
+    platform = 'ios'
+
+    def __init__(self, running, startup):
+        self.configs = {'running': running, 'startup': startup}
+        self.retrieved = []
+        self.closed = False
+
+    def get_config(self, retrieve='all'):
+        self.retrieved.append(retrieve)
+        # A config given as an exception is raised when it is fetched
+        if isinstance(self.configs[retrieve], Exception):
+            raise self.configs[retrieve]
+        return {file: config if file == retrieve else '' for file, config in self.configs.items()}
+
+    def cli(self, commands):
+        return {command: '' for command in commands}
+
+    def close(self):
+        self.closed = True
+
+
+class RunBackupTestCase(DeviceTestDataMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        device = cls.create_device('Collected Device')
+        cls.backup = Backup.objects.create(name='Collected Backup', device=device, ip=cls.ip)
+
+    @staticmethod
+    def get_running(saved):
+        return (
+            '! Last configuration change at 09:00:00 UTC Tue Mar 5 2024 by admin\n'
+            f'! NVRAM config last updated at {saved} UTC Tue Mar 5 2024 by admin\n'
+            'hostname switch\n'
+        )
+
+    def run_backup(self, driver, commit_queue):
+        job = BackupJob.objects.create(
+            backup=self.backup, status=JobStatusChoices.STATUS_SCHEDULED, job_id=uuid.uuid4()
+        )
+        with mock.patch('netbox_config_backup.backup.processing.close_db'):
+            with mock.patch('netbox_config_backup.backup.processing.napalm_init', return_value=driver):
+                run_backup(job.pk, commit_queue=commit_queue)
+        job.refresh_from_db()
+        return job
+
+    def collect(self, saved, startup, commit_error=None):
+        """
+        Run a backup against a stub device through the commit coordinator, returning the configs fetched
+        """
+        driver = StubDriver(self.get_running(saved), startup)
+        commit_queue = queue.Queue()
+        self.run_backup(driver, commit_queue)
+
+        coordinator = CommitCoordinator(commit_queue, batch_size=10, interval=3600)
+        coordinator.collect()
+        if commit_error is not None:
+            with mock.patch('netbox_config_backup.git.repository.commit_files', side_effect=commit_error):
+                coordinator.flush()
+        else:
+            coordinator.flush()
+        return driver.retrieved
+
+    def get_startup_change(self):
+        return BackupFile.objects.get(backup=self.backup, type='startup').last_change
+
+    def test_startup_fetched_after_failed_commit(self):
+        self.assertEqual(self.collect('09:01:00', 'startup 1'), ['running', 'startup'])
+        saved = self.get_startup_change()
+        self.assertEqual((saved.hour, saved.minute), (9, 1))
+
+        # Unchanged since it was committed, so the startup config is not fetched
+        self.assertEqual(self.collect('09:01:00', 'startup 1'), ['running'])
+
+        # Saved on the device, but the commit fails, so the stored time is left alone
+        retrieved = self.collect('09:30:00', 'startup 2', commit_error=OSError('Disk full'))
+        self.assertEqual(retrieved, ['running', 'startup'])
+        self.assertEqual(self.get_startup_change(), saved)
+        self.assertEqual(self.backup.get_config()['startup'], 'startup 1')
+
+        # and the next run fetches (and this time commits) the startup config again
+        self.assertEqual(self.collect('09:30:00', 'startup 2'), ['running', 'startup'])
+        self.assertEqual(self.get_startup_change().minute, 30)
+        self.assertEqual(self.backup.get_config()['startup'], 'startup 2')
+
+    def assert_retried(self, job, status, failures):
+        self.assertEqual(job.status, status)
+        self.assertEqual(BackupStatus.objects.get(backup=self.backup).failures, failures)
+        self.assertTrue(
+            BackupJob.objects.filter(backup=self.backup, status=JobStatusChoices.STATUS_SCHEDULED).exists()
+        )
+
+    def test_fetch_timeout(self):
+        driver = StubDriver(self.get_running('09:01:00'), TimeoutError('timed out'))
+        job = self.run_backup(driver, queue.Queue())
+
+        self.assertEqual(driver.retrieved, ['running', 'startup'])
+        self.assertTrue(driver.closed)
+        self.assert_retried(job, JobStatusChoices.STATUS_FAILED, 1)
+        self.assertEqual(job.data['error'], f'Timeout fetching config from {self.backup.device} with ip {self.ip}')
+
+    def test_fetch_error(self):
+        driver = StubDriver(ValueError('Unexpected output'), 'startup 1')
+        commit_queue = queue.Queue()
+        job = self.run_backup(driver, commit_queue)
+
+        self.assertTrue(driver.closed)
+        self.assertTrue(commit_queue.empty())
+        self.assert_retried(job, JobStatusChoices.STATUS_ERRORED, 1)
+        self.assertEqual(job.data['error'], 'Unexpected output')
@@ -1,10 +1,13 @@
+from datetime import timedelta
+
 from django.test import TestCase
+from django.utils import timezone
 
 from dcim.models import Site, Manufacturer, DeviceType, DeviceRole, Device
 from ipam.models import IPAddress
 
 from netbox_config_backup.filtersets import BackupFilterSet
-from netbox_config_backup.models import Backup
+from netbox_config_backup.models import Backup, BackupStatus
 
 
 class BackupTestCase(TestCase):
@@ -37,6 +40,14 @@ class BackupTestCase(TestCase):
         )
         Backup.objects.bulk_create(backups)
 
+        now = timezone.now()
+        BackupStatus.objects.bulk_create(
+            (
+                BackupStatus(backup=backups[0], last_backup=now, last_change=now - timedelta(days=60)),
+                BackupStatus(backup=backups[1], last_backup=now - timedelta(days=2), last_change=now),
+            )
+        )
+
     def test_q(self):
         params = {'q': 'Backup 1'}
         self.assertEqual(self.filterset(params, self.queryset).qs.count(), 1)
@@ -52,3 +63,21 @@ class BackupTestCase(TestCase):
     def test_ip(self):
         params = {'ip': '10.10.10.10'}
         self.assertEqual(self.filterset(params, self.queryset).qs.count(), 1)
+
+    def test_last_backup(self):
+        params = {'last_backup__after': timezone.now() - timedelta(days=1)}
+        self.assertEqual(self.filterset(params, self.queryset).qs.count(), 1)
+
+    def test_last_change(self):
+        params = {'last_change__before': timezone.now() - timedelta(days=30)}
+        self.assertEqual(self.filterset(params, self.queryset).qs.count(), 1)
+
+    def test_backup_count(self):
+        params = {'backup_count': 0}
+        self.assertEqual(self.filterset(params, self.queryset).qs.count(), 3)
+        params = {'backup_count__gte': 1}
+        self.assertEqual(self.filterset(params, self.queryset).qs.count(), 0)
+
+    def test_unchanged_for(self):
+        params = {'unchanged_for': 30}
+        self.assertEqual(self.filterset(params, self.queryset).qs.count(), 2)
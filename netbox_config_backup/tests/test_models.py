@@ -1,7 +1,25 @@
+import os
+import threading
+import uuid
+from datetime import timedelta
+from unittest import mock
+
+from django.db.models import Sum
 from django.test import TestCase
+from django.utils import timezone
 
+from core.choices import JobStatusChoices
+from core.models import Job
+from dcim.choices import DeviceStatusChoices
 from dcim.models import Site, Manufacturer, DeviceType, DeviceRole, Device
+from netbox_config_backup.backup.dispatch import Dispatcher
+from netbox_config_backup.backup.health import DeviceHealth
+from netbox_config_backup.backup.probe import Prober
+from netbox_config_backup.backup.retention import JobRetention
+from netbox_config_backup.choices import StatusChoices
 from netbox_config_backup.models import *
+from netbox_config_backup.tests.utils import DeviceTestDataMixin
+from netbox_config_backup.utils.rq import can_backup
 
 
 class TestBackup(TestCase):
@@ -33,3 +51,379 @@ class TestBackup(TestCase):
 
         self.assertEqual(configs['running'], retrieved['running'])
         self.assertEqual(configs['startup'], retrieved['startup'])
+
+        backup = Backup.objects.default_annotate().get(pk=backup.pk)
+        self.assertIsNotNone(backup.last_change)
+        self.assertEqual(backup.last_change, backup.summary.last_change)
+        self.assertEqual((backup.backup_count, backup.running_count, backup.startup_count), (2, 1, 1))
+
+    def test_unchanged_backup_not_committed(self):
+        configs = {'running': 'Unchanged Backup', 'startup': 'Unchanged Backup'}
+
+        site = Site.objects.first()
+        role = DeviceRole.objects.first()
+        device_type = DeviceType.objects.first()
+
+        device = Device.objects.create(
+            name='Unchanged Device', device_type=device_type, role=role, site=site
+        )
+        backup = Backup.objects.create(name='Backup 2', device=device)
+
+        self.assertIsNotNone(backup.set_config(configs))
+        self.assertIsNone(backup.set_config(configs))
+        self.assertEqual(backup.changes.count(), 2)
+
+        running = backup.files.get(type='running')
+        self.assertIsNotNone(running.sha)
+        self.assertEqual(backup.get_changed_configs(configs), {})
+
+        # A file recorded before SHAs were kept has its SHA filled in from the repository
+        backup.files.update(sha=None)
+        self.assertEqual(backup.get_changed_configs(configs), {})
+        self.assertEqual(backup.files.get(type='running').sha, running.sha)
+
+    def test_staging_per_thread(self):
+        from netbox_config_backup.git import repository
+
+        thread = threading.Thread(target=repository.write, args=('other-thread.running', 'Other thread'))
+        thread.start()
+        thread.join()
+
+        self.assertNotIn('other-thread.running', repository.staged)
+
+    def test_commit_retries_locked_head(self):
+        from netbox_config_backup.git import repository
+
+        repository.commit_files({'locked.running': 'Version 1'}, 'Before lock')
+        refs, _ = repository.repository.refs.follow(b'HEAD')
+        lock = os.path.join(repository.repository.controldir(), refs[-1].decode('ascii')) + '.lock'
+        with open(lock, 'wb'):
+            pass
+
+        # The lock is released while the commit waits to try again
+        with mock.patch('netbox_config_backup.git.sleep', side_effect=lambda seconds: os.remove(lock)) as sleep:
+            sha = repository.commit_files({'locked.running': 'Version 2'}, 'While locked')
+
+        sleep.assert_called_once_with(0.1)
+        self.assertEqual(repository.repository.refs[b'HEAD'].decode('ascii'), sha)
+        self.assertEqual(repository.read('locked.running'), 'Version 2')
+
+    def test_annotate_previous(self):
+        site = Site.objects.first()
+        role = DeviceRole.objects.first()
+        device_type = DeviceType.objects.first()
+
+        device = Device.objects.create(
+            name='Previous Device', device_type=device_type, role=role, site=site
+        )
+        backup = Backup.objects.create(name='Backup 3', device=device)
+        backup.set_config({'running': 'Version 1', 'startup': 'Version 1'})
+        backup.set_config({'running': 'Version 2', 'startup': 'Version 1'})
+
+        changes = BackupCommitTreeChange.objects.filter(backup=backup).annotate_previous()
+        running = [change for change in changes if change.file.type == 'running']
+        startup = [change for change in changes if change.file.type == 'startup']
+        running.sort(key=lambda change: change.commit.time)
+
+        self.assertEqual(len(running), 2)
+        self.assertIsNone(running[0].previous_pk)
+        self.assertEqual(running[1].previous_pk, running[0].pk)
+        self.assertEqual(running[1].previous, running[0])
+        self.assertEqual(running[1].previous_change_id, running[0].pk)
+        self.assertIsNone(running[0].previous_change_id)
+        self.assertEqual(len(startup), 1)
+        self.assertIsNone(startup[0].previous_pk)
+
+
+class TestBackupable(DeviceTestDataMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        devices = (
+            cls.get_device('Device 1'),
+            cls.get_device('Device 2', platform=None),
+            cls.get_device('Device 3', status=DeviceStatusChoices.STATUS_OFFLINE),
+        )
+        Device.objects.bulk_create(devices)
+        Backup.objects.bulk_create(
+            (
+                Backup(name='Backup 1', device=devices[0], ip=cls.ip),
+                Backup(name='Backup 2', device=devices[0]),
+                Backup(name='Backup 3', device=devices[1], ip=cls.ip),
+                Backup(name='Backup 4', device=devices[2], ip=cls.ip),
+                Backup(name='Backup 5', ip=cls.ip),
+                Backup(name='Backup 6', device=devices[0], ip=cls.ip, status=StatusChoices.STATUS_DISABLED),
+            )
+        )
+
+    def test_backupable(self):
+        backupable = Backup.objects.backupable()
+
+        self.assertEqual(list(backupable.values_list('name', flat=True)), ['Backup 1'])
+        for backup in Backup.objects.all():
+            self.assertEqual(can_backup(backup), backup in backupable)
+
+
+class TestJobRetention(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        backup = Backup.objects.create(name='Retention Backup')
+        now = timezone.now()
+        jobs = [
+            BackupJob(
+                backup=backup,
+                status=JobStatusChoices.STATUS_COMPLETED if idx % 2 else JobStatusChoices.STATUS_FAILED,
+                scheduled=now - timedelta(days=idx, hours=12),
+                completed=now - timedelta(days=idx, hours=12),
+                job_id=uuid.uuid4(),
+            )
+            for idx in range(10)
+        ]
+        jobs.append(
+            BackupJob(
+                backup=backup,
+                status=JobStatusChoices.STATUS_SCHEDULED,
+                scheduled=now - timedelta(days=20),
+                job_id=uuid.uuid4(),
+            )
+        )
+        BackupJob.objects.bulk_create(jobs)
+        for job in jobs:
+            BackupJob.objects.filter(pk=job.pk).update(created=job.scheduled)
+
+    def test_keep_jobs(self):
+        deleted = JobRetention(keep_jobs=3, rollup=True).prune()
+
+        self.assertEqual(deleted, 7)
+        self.assertEqual(BackupJob.objects.count(), 4)
+        self.assertTrue(BackupJob.objects.filter(status=JobStatusChoices.STATUS_SCHEDULED).exists())
+        rollups = BackupJobRollup.objects.aggregate(completed=Sum('completed'), failed=Sum('failed'))
+        self.assertEqual(rollups, {'completed': 4, 'failed': 3})
+
+    def test_keep_days(self):
+        deleted = JobRetention(keep_days=5).prune()
+
+        self.assertEqual(deleted, 5)
+        self.assertEqual(BackupJobRollup.objects.count(), 0)
+
+    def test_disabled(self):
+        self.assertEqual(JobRetention().prune(), 0)
+        self.assertEqual(BackupJob.objects.count(), 11)
+
+
+class TestCleanStaleJobs(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        backups = (Backup(name='Stale Backup 1'), Backup(name='Stale Backup 2'))
+        Backup.objects.bulk_create(backups)
+        now = timezone.now()
+        jobs = (
+            BackupJob(backup=backups[0], status=JobStatusChoices.STATUS_PENDING, scheduled=now - timedelta(hours=1)),
+            BackupJob(backup=backups[0], status=JobStatusChoices.STATUS_SCHEDULED, scheduled=now),
+            BackupJob(backup=backups[1], status=JobStatusChoices.STATUS_SCHEDULED, scheduled=now),
+            BackupJob(backup=backups[1], status=JobStatusChoices.STATUS_SCHEDULED, scheduled=now),
+        )
+        for job in jobs:
+            job.job_id = uuid.uuid4()
+            job.save()
+
+    def test_clean_stale_jobs(self):
+        from netbox_config_backup.jobs import BackupRunner
+
+        results = BackupRunner.clean_stale_jobs()
+
+        self.assertEqual(results, {'stale': 1, 'scheduled': 1})
+        jobs = list(BackupJob.objects.order_by('pk'))
+        self.assertEqual(jobs[0].status, JobStatusChoices.STATUS_FAILED)
+        self.assertEqual(jobs[0].data, {'error': 'Job hung'})
+        self.assertEqual(jobs[1].status, JobStatusChoices.STATUS_SCHEDULED)
+        self.assertEqual(jobs[2].status, JobStatusChoices.STATUS_ERRORED)
+        self.assertEqual(jobs[3].status, JobStatusChoices.STATUS_SCHEDULED)
+
+
+class TestScheduleJobs(DeviceTestDataMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        device = cls.create_device('Scheduled Device')
+        cls.backup = Backup.objects.create(name='Scheduled Backup', device=device, ip=cls.ip)
+
+    def get_enqueued(self):
+        return BackupJob.objects.filter(backup=self.backup, status__in=JobStatusChoices.ENQUEUED_STATE_CHOICES)
+
+    def test_passed_slot(self):
+        from netbox_config_backup.jobs import BackupRunner
+
+        self.assertEqual(BackupRunner.schedule_jobs(runner=None), 1)
+
+        # The job's slot passes before a worker is free for it, the next pass books nothing more
+        self.get_enqueued().update(scheduled=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(BackupRunner.clean_stale_jobs(), {'stale': 0, 'scheduled': 0})
+        self.assertEqual(BackupRunner.schedule_jobs(runner=None), 0)
+
+        self.assertEqual(self.get_enqueued().count(), 1)
+        self.assertEqual(BackupRunner.clean_stale_jobs(), {'stale': 0, 'scheduled': 0})
+        self.assertFalse(BackupJob.objects.filter(status=JobStatusChoices.STATUS_ERRORED).exists())
+
+    def test_bring_forward(self):
+        from netbox_config_backup.jobs import BackupRunner
+
+        BackupJob.objects.create(
+            backup=self.backup,
+            status=JobStatusChoices.STATUS_SCHEDULED,
+            scheduled=timezone.now() + timedelta(minutes=30),
+            job_id=uuid.uuid4(),
+        )
+
+        # Asking for the backup runs its booked job now rather than adding another
+        self.assertEqual(BackupRunner.schedule_jobs(runner=None, backup=self.backup), 0)
+        self.assertEqual(self.get_enqueued().count(), 1)
+        self.assertLessEqual(self.get_enqueued().get().scheduled, timezone.now())
+        self.assertEqual(self.backup.summary.next_attempt, self.get_enqueued().get().scheduled)
+
+
+class TestClaimJobs(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.backup = Backup.objects.create(name='Claimed Backup')
+
+    def get_runner(self, jobs):
+        from netbox_config_backup.jobs import BackupRunner
+
+        runner = BackupRunner.__new__(BackupRunner)
+        runner.job = Job.objects.create(name='Backup Job Runner', job_id=uuid.uuid4())
+        runner.running = True
+        runner.dispatcher = Dispatcher()
+        runner.dispatcher.extend(jobs)
+        runner.executor = mock.Mock(available=len(jobs))
+        return runner
+
+    def test_claim_jobs(self):
+        now = timezone.now()
+        jobs = [
+            BackupJob.objects.create(
+                backup=self.backup, status=JobStatusChoices.STATUS_SCHEDULED, scheduled=now, job_id=uuid.uuid4()
+            )
+            for idx in range(3)
+        ]
+        runner = self.get_runner(jobs)
+        other = self.get_runner(list(BackupJob.objects.filter(pk__in=[job.pk for job in jobs]).order_by('pk')))
+
+        # While queued, one job is errored by stale job cleanup and another is claimed by another runner
+        BackupJob.objects.filter(pk=jobs[1].pk).update(status=JobStatusChoices.STATUS_ERRORED)
+        BackupJob.objects.filter(pk=jobs[2].pk).update(runner=other.job, status=JobStatusChoices.STATUS_PENDING)
+
+        runner.dispatch_jobs()
+        runner.executor.submit.assert_called_once_with(jobs[0])
+        self.assertEqual(runner.dispatcher.status['in_flight'], 1)
+
+        # The other runner's copies of the jobs are all taken or finished, so none are started twice
+        other.dispatch_jobs()
+        other.executor.submit.assert_not_called()
+        self.assertEqual(other.dispatcher.status['in_flight'], 0)
+
+        claims = BackupJob.objects.filter(pk__in=[job.pk for job in jobs]).order_by('pk')
+        self.assertEqual(
+            list(claims.values_list('runner', 'status')),
+            [
+                (runner.job.pk, JobStatusChoices.STATUS_PENDING),
+                (None, JobStatusChoices.STATUS_ERRORED),
+                (other.job.pk, JobStatusChoices.STATUS_PENDING),
+            ],
+        )
+
+
+class TestDeviceHealth(DeviceTestDataMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        device = cls.create_device('Device 1')
+        cls.backup = Backup.objects.create(name='Health Backup', device=device, ip=cls.ip)
+
+    def test_circuit_breaker(self):
+        from netbox_config_backup.jobs import BackupRunner
+
+        health = DeviceHealth(failure_threshold=2, backoff=600)
+        now = timezone.now()
+
+        self.assertIsNone(health.record_failure(self.backup, now=now))
+        self.assertEqual(health.record_failure(self.backup, now=now), now + timedelta(seconds=600))
+        self.assertEqual(BackupRunner.schedule_jobs(runner=None), 0)
+
+        status = health.record_success(self.backup, 2.0, 4.0)
+        self.assertEqual((status.failures, status.retry_after), (0, None))
+        self.assertEqual((status.connect_time, status.fetch_time), (2.0, 4.0))
+        self.assertEqual(BackupRunner.schedule_jobs(runner=None), 1)
+
+    def test_schedule_backup_now(self):
+        from netbox_config_backup.jobs import BackupRunner
+
+        DeviceHealth(failure_threshold=1).record_failure(self.backup)
+        before = timezone.now()
+
+        self.assertEqual(BackupRunner.schedule_jobs(runner=None, backup=self.backup), 1)
+        job = BackupJob.objects.get(backup=self.backup, status=JobStatusChoices.STATUS_SCHEDULED)
+        self.assertGreaterEqual(job.scheduled, before)
+        self.assertLessEqual(job.scheduled, timezone.now())
+
+    def test_unreachable(self):
+        from netbox_config_backup.jobs import BackupRunner
+
+        job = BackupJob.objects.create(
+            backup=self.backup, status=JobStatusChoices.STATUS_SCHEDULED, scheduled=timezone.now(), job_id=uuid.uuid4()
+        )
+        runner = BackupRunner.__new__(BackupRunner)
+        runner.job = None
+        prober = Prober(enabled=True)
+
+        with mock.patch('netbox_config_backup.jobs.backup.get_prober', return_value=prober):
+            with mock.patch.object(prober, 'probe', return_value=set()):
+                self.assertEqual(runner.probe_jobs([job]), ([], 1))
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, JobStatusChoices.STATUS_FAILED)
+        self.assertEqual(job.data, {'error': 'Device unreachable'})
+        self.assertEqual(self.backup.summary.failures, 1)
+        self.assertTrue(
+            BackupJob.objects.filter(
+                backup=self.backup, status=JobStatusChoices.STATUS_SCHEDULED, scheduled__gt=timezone.now()
+            ).exists()
+        )
+
+    def test_unreachable_many(self):
+        from netbox_config_backup.jobs import BackupRunner
+
+        now = timezone.now()
+        backups = [self.backup] + [
+            Backup.objects.create(name=f'Health Backup {idx}', device=self.create_device(f'Device {idx}'), ip=self.ip)
+            for idx in (2, 3)
+        ]
+        # The last device has failed twice before, so this failure opens its circuit breaker
+        BackupStatus.objects.create(backup=backups[2], failures=2)
+        jobs = [
+            BackupJob.objects.create(
+                backup=backup, status=JobStatusChoices.STATUS_SCHEDULED, scheduled=now, job_id=uuid.uuid4()
+            )
+            for backup in backups
+        ]
+        runner = BackupRunner.__new__(BackupRunner)
+        runner.job = None
+        prober = Prober(enabled=True)
+
+        with mock.patch('netbox_config_backup.jobs.backup.get_prober', return_value=prober):
+            with mock.patch.object(prober, 'probe', return_value=set()):
+                self.assertEqual(runner.probe_jobs(jobs), ([], 3))
+
+        statuses = [BackupStatus.objects.get(backup=backup) for backup in backups]
+        self.assertEqual([status.failures for status in statuses], [1, 1, 3])
+        self.assertEqual([status.retry_after is not None for status in statuses], [False, False, True])
+        booked = [BackupJob.objects.get(backup=backup, status=JobStatusChoices.STATUS_SCHEDULED) for backup in backups]
+        for job in booked:
+            self.assertGreater(job.scheduled, now)
+        self.assertGreaterEqual(booked[2].scheduled, statuses[2].retry_after)
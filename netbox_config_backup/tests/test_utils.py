@@ -0,0 +1,232 @@
+import datetime
+import difflib
+import os
+import socket
+import tempfile
+import uuid
+
+from django.test import SimpleTestCase
+
+from netbox_config_backup.backup.health import DeviceHealth
+from netbox_config_backup.backup.probe import Prober
+from netbox_config_backup.backup.scheduling import Scheduler
+from netbox_config_backup.git import ChangesCache
+from netbox_config_backup.models import BackupStatus
+from netbox_config_backup.utils import Differ
+from netbox_config_backup.utils.configs import check_config_save_status
+from netbox_config_backup.utils.parsers import PARSERS
+
+
+class DifferTestCase(SimpleTestCase):
+    old = '\n'.join(f'interface Gi1/0/{i}\n description port {i}\n!' for i in range(1, 50))
+
+    def test_is_diff(self):
+        self.assertFalse(Differ(self.old, self.old).is_diff())
+        self.assertTrue(Differ(self.old, self.old.replace('port 10\n', 'port ten\n')).is_diff())
+        self.assertTrue(Differ(self.old, f'{self.old}\nend').is_diff())
+        self.assertFalse(Differ(None, '').is_diff())
+
+    def test_compare(self):
+        new = self.old.replace('port 10\n', 'port ten\n').replace(' description port 40\n', '')
+        expected = list(difflib.unified_diff(self.old.splitlines(), new.splitlines(), lineterm=''))
+        self.assertEqual([line.rstrip() for line in expected], list(Differ(self.old, new).compare()))
+
+    def test_line_endings(self):
+        crlf = self.old.replace('\n', '\r\n')
+        self.assertFalse(Differ(self.old, crlf).is_diff())
+        self.assertEqual(list(Differ(self.old, crlf).compare()), [])
+
+        # A lone carriage return does not end a line, so is_diff() and compare() agree it is a change
+        carriage = self.old.replace('port 10\n', 'port 10\r')
+        self.assertTrue(Differ(self.old, carriage).is_diff())
+        self.assertNotEqual(list(Differ(self.old, carriage).compare()), [])
+
+        changed = crlf.replace('port 10\r\n', 'port ten\r\n')
+        self.assertEqual(
+            [line for line in Differ(self.old, changed).compare() if line[:1] in '+-'],
+            ['---', '+++', '- description port 10', '+ description port ten'],
+        )
+
+    def test_no_changes(self):
+        self.assertEqual(list(Differ(self.old, self.old).compare()), [])
+
+    def test_cisco_compare(self):
+        old = 'interface Gi1\n description a\n shutdown\ninterface Gi2\n description b\n'
+        reordered = 'interface Gi2\n description b\ninterface Gi1\n shutdown\n description a\n'
+        self.assertEqual(list(Differ(old, reordered).cisco_compare()), [])
+
+        changed = reordered.replace(' description a\n', ' description c\n')
+        self.assertEqual(
+            list(Differ(old, changed).cisco_compare()),
+            ['---', '+++', ' interface Gi1', '- description a', '+ description c'],
+        )
+
+
+class SchedulerTestCase(SimpleTestCase):
+    now = datetime.datetime(2024, 1, 1, 12, 0, 30, tzinfo=datetime.timezone.utc)
+
+    def test_spread(self):
+        scheduler = Scheduler(frequency=3600)
+        backups = [uuid.uuid4() for _ in range(1000)]
+        runs = [scheduler.first_run(backup, now=self.now) for backup in backups]
+
+        for backup, run in zip(backups, runs):
+            self.assertTrue(self.now <= run < self.now + datetime.timedelta(hours=1))
+            self.assertEqual(scheduler.first_run(backup, now=self.now), run)
+            self.assertEqual(scheduler.next_run(backup, now=run), run + datetime.timedelta(hours=1))
+
+        # Every quarter of the window gets roughly a quarter of the backups
+        quarters = [0, 0, 0, 0]
+        for run in runs:
+            quarters[int((run - self.now).total_seconds() // 900)] += 1
+        for count in quarters:
+            self.assertTrue(150 < count < 350)
+
+    def test_interval(self):
+        scheduler = Scheduler(frequency=3600, spread=False)
+        backup = uuid.uuid4()
+
+        self.assertEqual(scheduler.first_run(backup, now=self.now), self.now)
+        self.assertEqual(scheduler.next_run(backup, now=self.now), self.now + datetime.timedelta(hours=1))
+
+    def test_jitter(self):
+        scheduler = Scheduler(frequency=3600, jitter=60)
+        backup = uuid.uuid4()
+        slot = Scheduler(frequency=3600).next_run(backup, now=self.now)
+
+        run = scheduler.next_run(backup, now=self.now)
+        self.assertTrue(slot <= run <= slot + datetime.timedelta(seconds=60))
+
+
+class Driver:
+    hostname = 'switch'
+
+    def __init__(self, platform, outputs=None):
+        self.platform = platform
+        self.outputs = outputs or {}
+        self.commands = []
+
+    def cli(self, commands):
+        self.commands.extend(commands)
+        return {command: self.outputs.get(command, '') for command in commands}
+
+
+class ChangesCacheTestCase(SimpleTestCase):
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ChangesCache(os.path.join(directory, 'cache.sqlite3'))
+            cache.chunk_size = 2
+            entries = {f'{idx:040x}': [{'type': 'modify', 'index': idx}] for idx in range(5)}
+            entries['empty'] = []
+
+            cache.set_many(entries)
+            cache.set('a' * 40, [])
+
+            self.assertEqual(cache.get_many(list(entries.keys()) + ['missing']), entries)
+            self.assertEqual(cache.get('a' * 40), [])
+            self.assertIsNone(cache.get('missing'))
+            self.assertEqual(cache.connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            cache.connection.close()
+
+
+class DeviceHealthTestCase(SimpleTestCase):
+    def test_timeout(self):
+        health = DeviceHealth(timeout_factor=3, timeout_min=10, timeout_max=60)
+
+        self.assertIsNone(health.get_timeout(None))
+        self.assertIsNone(health.get_timeout(BackupStatus(connect_time=None)))
+        self.assertEqual(health.get_timeout(BackupStatus(connect_time=1, fetch_time=2)), 10)
+        self.assertEqual(health.get_timeout(BackupStatus(connect_time=5, fetch_time=8)), 24)
+        self.assertEqual(health.get_timeout(BackupStatus(connect_time=30, fetch_time=None)), 60)
+        self.assertIsNone(DeviceHealth(timeout_factor=0).get_timeout(BackupStatus(connect_time=5)))
+
+    def test_smooth(self):
+        health = DeviceHealth(smoothing=0.5)
+
+        self.assertEqual(health.smooth(None, 4), 4)
+        self.assertEqual(health.smooth(4, 8), 6)
+
+    def test_backoff(self):
+        health = DeviceHealth(failure_threshold=3, backoff=60, backoff_max=300)
+
+        self.assertIsNone(health.get_backoff(2))
+        self.assertEqual(health.get_backoff(3), datetime.timedelta(seconds=60))
+        self.assertEqual(health.get_backoff(4), datetime.timedelta(seconds=120))
+        self.assertEqual(health.get_backoff(10), datetime.timedelta(seconds=300))
+        self.assertEqual(health.get_backoff(1000), datetime.timedelta(seconds=300))
+        self.assertIsNone(DeviceHealth(failure_threshold=0).get_backoff(10))
+
+
+class ProberTestCase(SimpleTestCase):
+    def test_probe(self):
+        with socket.socket() as listening, socket.socket() as closed:
+            listening.bind(('127.0.0.1', 0))
+            listening.listen()
+            closed.bind(('127.0.0.1', 0))
+            open_port = listening.getsockname()[1]
+            closed_port = closed.getsockname()[1]
+
+            reachable = Prober(enabled=True, timeout=1).probe(
+                {
+                    'open': ('127.0.0.1', [closed_port, open_port]),
+                    'closed': ('127.0.0.1', [closed_port]),
+                }
+            )
+
+        self.assertEqual(reachable, {'open'})
+
+    def test_probe_nothing(self):
+        self.assertEqual(Prober(enabled=True).probe({}), set())
+
+
+class ConfigSaveStatusTestCase(SimpleTestCase):
+    running = (
+        'Building configuration...\n\n'
+        '! Last configuration change at 10:15:30 UTC Tue Mar 5 2024 by admin\n'
+        '! NVRAM config last updated at 09:01:00 UTC Tue Mar 5 2024 by admin\n'
+        'version 15.2\n'
+    )
+    startup = (
+        '! Last configuration change at 09:00:00 UTC Tue Mar 5 2024 by admin\n'
+        '! NVRAM config last updated at 09:01:00 UTC Tue Mar 5 2024 by admin\n'
+        'version 15.2\n'
+    )
+
+    def test_from_configs(self):
+        # The startup time of IOS comes from the running config, so startup need not have been fetched
+        d = Driver('ios')
+        status = check_config_save_status(d, configs={'running': self.running, 'startup': ''})
+
+        self.assertEqual(d.commands, [])
+        self.assertEqual((status['running'].hour, status['running'].minute), (10, 15))
+        self.assertEqual((status['startup'].hour, status['startup'].minute), (9, 1))
+        self.assertFalse(status['status'])
+
+    def test_command_fallback(self):
+        command = 'show startup-config | inc "!Startup config saved at:"'
+        d = Driver('nxos_ssh', outputs={command: '!Startup config saved at: Tue Mar  5 10:20:00 2024'})
+        status = check_config_save_status(
+            d,
+            configs={'running': '!Running configuration last done at: Tue Mar  5 10:15:30 2024\n', 'startup': ''},
+        )
+
+        self.assertEqual(d.commands, [command])
+        self.assertEqual((status['startup'].hour, status['startup'].minute), (10, 20))
+        self.assertTrue(status['status'])
+
+    def test_unknown_platform(self):
+        d = Driver('unknown')
+        status = check_config_save_status(d, configs={'running': self.running, 'startup': self.startup})
+
+        self.assertEqual(d.commands, [])
+        self.assertEqual(status, {'running': None, 'startup': None, 'status': None})
+
+    def test_parsers(self):
+        for driver, parsers in PARSERS.items():
+            for file, parser in parsers.items():
+                with self.subTest(driver=driver, file=file):
+                    value = parser.parse(parser.find(f'hostname device\n{parser.example}\n'))
+                    self.assertEqual(
+                        (value.year, value.month, value.day, value.hour, value.minute, value.second),
+                        (2024, 3, 5, 10, 15, 30),
+                    )
@@ -0,0 +1,38 @@
+from dcim.models import Device, DeviceRole, DeviceType, Manufacturer, Platform, Site
+from ipam.models import IPAddress
+from netbox_napalm_plugin.models import NapalmPlatformConfig
+
+__all__ = ('DeviceTestDataMixin',)
+
+
+class DeviceTestDataMixin:
+    """
+    Creates the site, device type, role, NAPALM platform and IP address which test devices are built from
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.site = Site.objects.create(name='Site 1', slug='site-1')
+        manufacturer = Manufacturer.objects.create(name='Manufacturer 1', slug='manufacturer-1')
+        cls.device_type = DeviceType.objects.create(
+            model='Generic Type', slug='generic-type', manufacturer=manufacturer
+        )
+        cls.role = DeviceRole.objects.create(name='Generic Role', slug='generic-role')
+        cls.platform = Platform.objects.create(name='Platform 1', slug='platform-1')
+        NapalmPlatformConfig.objects.create(platform=cls.platform, napalm_driver='ios')
+        cls.ip = IPAddress.objects.create(address='10.10.10.10/24')
+
+    @classmethod
+    def get_device(cls, name, **kwargs):
+        """
+        Return an unsaved device on the shared site, type, role and (unless given) platform
+        """
+        kwargs.setdefault('platform', cls.platform)
+        return Device(name=name, device_type=cls.device_type, role=cls.role, site=cls.site, **kwargs)
+
+    @classmethod
+    def create_device(cls, name, **kwargs):
+        device = cls.get_device(name, **kwargs)
+        device.save()
+        return device
@@ -8,13 +8,13 @@ def get_backup_tables(instance):
     from netbox_config_backup.tables import BackupsTable
 
     def get_backup_table(data):
+        rows = list(data)
+        changes = {row.pk: row for row in rows}
         backups = []
-        for row in data:
+        for row in rows:
             commit = row.commit
             current = row
-            previous = row.backup.changes.filter(
-                file__type=row.file.type, commit__time__lt=commit.time
-            ).last()
+            previous = changes.get(row.previous_change_id)
             backup = {
                 'pk': instance.pk,
                 'date': commit.time,
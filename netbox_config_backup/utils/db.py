@@ -1,5 +1,21 @@
 from django import db
+from django.db.models import F, JSONField, Value
+from django.db.models.expressions import CombinedExpression
+from django.db.models.functions import Coalesce
 
 
 def close_db():
     db.connections.close_all()
+
+
+def merge_json(field, data):
+    """
+    Expression for use in a bulk update which merges `data` into the JSON object in `field` (NULL is treated as an
+    empty object)
+    """
+    return CombinedExpression(
+        Coalesce(F(field), Value({}, output_field=JSONField())),
+        '||',
+        Value(data, output_field=JSONField()),
+        output_field=JSONField(),
+    )
@@ -0,0 +1,357 @@
+import difflib
+import io
+from dataclasses import dataclass, field
+from itertools import zip_longest
+
+__all__ = (
+    'ConfigBlock',
+    'ConfigDiff',
+    'HierarchicalDiff',
+    'Hunk',
+)
+
+
+@dataclass
+class Hunk:
+    old_start: int
+    old_count: int
+    new_start: int
+    new_count: int
+    lines: list = field(default_factory=list)
+
+    @staticmethod
+    def format_range(start, count):
+        # Same conventions as difflib.unified_diff
+        beginning = start + 1
+        if count == 1:
+            return f'{beginning}'
+        if not count:
+            beginning -= 1
+        return f'{beginning},{count}'
+
+    @property
+    def header(self):
+        return (
+            f'@@ -{self.format_range(self.old_start, self.old_count)} '
+            f'+{self.format_range(self.new_start, self.new_count)} @@'
+        )
+
+    def __iter__(self):
+        yield self.header
+        for tag, line in self.lines:
+            yield f'{tag}{line}'
+
+
+class ConfigDiff:
+    """
+    Line based diff of two configurations.  Lines are interned to integers once, the common head and tail are
+    stripped, and the remainder is aligned with a patience diff (anchoring on lines which are unique to both sides),
+    only falling back to difflib for stretches without any unique lines.  Hunks are produced lazily.
+    """
+
+    def __init__(self, old, new, context=3):
+        self.old = old if old is not None else ''
+        self.new = new if new is not None else ''
+        self.context = context
+        self._old_lines = None
+        self._new_lines = None
+
+    @staticmethod
+    def iter_lines(text):
+        # Both is_diff() and the hunks split lines this way, so they agree on CRLF and other line endings
+        for line in io.StringIO(text):
+            yield line.rstrip('\r\n')
+
+    def is_diff(self):
+        """
+        Return True as soon as the first differing line is found
+        """
+        if self.old is self.new:
+            return False
+        for old, new in zip_longest(self.iter_lines(self.old), self.iter_lines(self.new)):
+            if old != new:
+                return True
+        return False
+
+    @property
+    def old_lines(self):
+        if self._old_lines is None:
+            self._old_lines = list(self.iter_lines(self.old))
+        return self._old_lines
+
+    @property
+    def new_lines(self):
+        if self._new_lines is None:
+            self._new_lines = list(self.iter_lines(self.new))
+        return self._new_lines
+
+    def intern(self):
+        table = {}
+        old = [table.setdefault(line, len(table)) for line in self.old_lines]
+        new = [table.setdefault(line, len(table)) for line in self.new_lines]
+        return old, new
+
+    @staticmethod
+    def longest_increasing(pairs):
+        # Patience sorting: longest run of pairs increasing in both old and new index
+        tails = []
+        links = []
+        for idx, (_, new) in enumerate(pairs):
+            low, high = 0, len(tails)
+            while low < high:
+                mid = (low + high) // 2
+                if pairs[tails[mid]][1] < new:
+                    low = mid + 1
+                else:
+                    high = mid
+            links.append(tails[low - 1] if low > 0 else None)
+            if low == len(tails):
+                tails.append(idx)
+            else:
+                tails[low] = idx
+
+        result = []
+        idx = tails[-1] if tails else None
+        while idx is not None:
+            result.append(pairs[idx])
+            idx = links[idx]
+        result.reverse()
+        return result
+
+    def matches(self, old, new):
+        """
+        Return the (old index, new index, length) blocks of lines common to both sides, in order
+        """
+        blocks = []
+        stack = [(0, len(old), 0, len(new))]
+        while stack:
+            alo, ahi, blo, bhi = stack.pop()
+
+            head = 0
+            while alo + head < ahi and blo + head < bhi and old[alo + head] == new[blo + head]:
+                head += 1
+            if head:
+                blocks.append((alo, blo, head))
+                alo, blo = alo + head, blo + head
+
+            tail = 0
+            while alo < ahi - tail and blo < bhi - tail and old[ahi - tail - 1] == new[bhi - tail - 1]:
+                tail += 1
+            if tail:
+                blocks.append((ahi - tail, bhi - tail, tail))
+                ahi, bhi = ahi - tail, bhi - tail
+
+            if alo >= ahi or blo >= bhi:
+                continue
+
+            counts = {}
+            for idx in range(alo, ahi):
+                count, _ = counts.get(old[idx], (0, None))
+                counts[old[idx]] = (count + 1, idx)
+            unique = {}
+            for idx in range(blo, bhi):
+                count, position = counts.get(new[idx], (0, None))
+                if count == 1:
+                    unique[new[idx]] = None if new[idx] in unique else (position, idx)
+            pairs = sorted(pair for pair in unique.values() if pair is not None)
+
+            anchors = self.longest_increasing(pairs)
+            if not anchors:
+                matcher = difflib.SequenceMatcher(None, old[alo:ahi], new[blo:bhi], autojunk=False)
+                for a, b, size in matcher.get_matching_blocks():
+                    if size:
+                        blocks.append((alo + a, blo + b, size))
+                continue
+
+            previous = (alo, blo)
+            for a, b in anchors:
+                stack.append((previous[0], a, previous[1], b))
+                blocks.append((a, b, 1))
+                previous = (a + 1, b + 1)
+            stack.append((previous[0], ahi, previous[1], bhi))
+
+        blocks.sort()
+        merged = []
+        for a, b, size in blocks:
+            if merged and merged[-1][0] + merged[-1][2] == a and merged[-1][1] + merged[-1][2] == b:
+                merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + size)
+            else:
+                merged.append((a, b, size))
+        return merged
+
+    def opcodes(self):
+        old, new = self.intern()
+        i = j = 0
+        for a, b, size in self.matches(old, new) + [(len(old), len(new), 0)]:
+            if i < a and j < b:
+                yield 'replace', i, a, j, b
+            elif i < a:
+                yield 'delete', i, a, j, b
+            elif j < b:
+                yield 'insert', i, a, j, b
+            if size:
+                yield 'equal', a, a + size, b, b + size
+            i, j = a + size, b + size
+
+    def groups(self):
+        # Same grouping as difflib.SequenceMatcher.get_grouped_opcodes()
+        context = self.context
+        codes = list(self.opcodes())
+        if not codes or (len(codes) == 1 and codes[0][0] == 'equal'):
+            return
+        tag, i1, i2, j1, j2 = codes[0]
+        if tag == 'equal':
+            codes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+        tag, i1, i2, j1, j2 = codes[-1]
+        if tag == 'equal':
+            codes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+
+        group = []
+        for tag, i1, i2, j1, j2 in codes:
+            if tag == 'equal' and i2 - i1 > context * 2:
+                group.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+                yield group
+                group = []
+                i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+            group.append((tag, i1, i2, j1, j2))
+        if group and not (len(group) == 1 and group[0][0] == 'equal'):
+            yield group
+
+    def hunks(self):
+        """
+        Yield the differences as unified diff hunks with `context` lines of surrounding context
+        """
+        old, new = self.old_lines, self.new_lines
+        for group in self.groups():
+            hunk = Hunk(
+                old_start=group[0][1],
+                old_count=group[-1][2] - group[0][1],
+                new_start=group[0][3],
+                new_count=group[-1][4] - group[0][3],
+            )
+            for tag, i1, i2, j1, j2 in group:
+                if tag == 'equal':
+                    hunk.lines.extend((' ', line) for line in old[i1:i2])
+                    continue
+                if tag in ('replace', 'delete'):
+                    hunk.lines.extend(('-', line) for line in old[i1:i2])
+                if tag in ('replace', 'insert'):
+                    hunk.lines.extend(('+', line) for line in new[j1:j2])
+            yield hunk
+
+    def unified(self):
+        """
+        Yield the lines of a unified diff, in the same format as difflib.unified_diff(lineterm='')
+        """
+        header = False
+        for hunk in self.hunks():
+            if not header:
+                yield '--- '
+                yield '+++ '
+                header = True
+            yield from hunk
+
+
+class ConfigBlock:
+    """
+    A configuration line and the block of lines indented beneath it.  The block hash covers the line and its
+    children regardless of the order of the children.
+    """
+
+    __slots__ = ('line', 'key', 'children', 'hash')
+
+    def __init__(self, line=None):
+        self.line = line
+        self.key = line.strip() if line is not None else None
+        self.children = []
+        self.hash = None
+
+    @classmethod
+    def parse(cls, text, comment='!'):
+        root = cls()
+        stack = [(-1, root)]
+        for line in (text or '').splitlines():
+            stripped = line.strip()
+            if not stripped or stripped.startswith(comment):
+                continue
+            indent = len(line) - len(line.lstrip())
+            while stack[-1][0] >= indent:
+                stack.pop()
+            block = cls(line.rstrip())
+            stack[-1][1].children.append(block)
+            stack.append((indent, block))
+        root.rehash()
+        return root
+
+    def rehash(self):
+        # Iterative post-order walk, so deeply nested configs cannot hit the recursion limit
+        stack = [(self, False)]
+        while stack:
+            block, visited = stack.pop()
+            if visited:
+                block.hash = hash((block.key, tuple(sorted(child.hash for child in block.children))))
+                continue
+            stack.append((block, True))
+            stack.extend((child, False) for child in block.children)
+
+    def walk(self):
+        stack = [self]
+        while stack:
+            block = stack.pop()
+            yield block.line
+            stack.extend(reversed(block.children))
+
+
+class HierarchicalDiff:
+    """
+    Section aware diff of two indentation structured configurations (IOS, NX-OS and similar).  Both configurations
+    are parsed into trees of blocks once; sections are matched by their header line and only descended into when
+    their hashes differ, so reordered sections or reordered lines within a section are not reported as changes.
+    """
+
+    def __init__(self, old, new):
+        self.old = ConfigBlock.parse(old)
+        self.new = ConfigBlock.parse(new)
+
+    def is_diff(self):
+        return self.old.hash != self.new.hash
+
+    @staticmethod
+    def pair(old, new):
+        remaining = {}
+        for block in old.children:
+            remaining.setdefault(block.key, []).append(block)
+
+        pairs = []
+        for block in new.children:
+            matches = remaining.get(block.key)
+            if matches:
+                # Prefer an identical block when a header line appears more than once
+                match = next((candidate for candidate in matches if candidate.hash == block.hash), matches[0])
+                matches.remove(match)
+                pairs.append((match, block))
+            else:
+                pairs.append((None, block))
+        leftover = {id(block) for blocks in remaining.values() for block in blocks}
+        removed = [block for block in old.children if id(block) in leftover]
+        return removed, pairs
+
+    def changes(self, old, new):
+        removed, pairs = self.pair(old, new)
+        for block in removed:
+            for line in block.walk():
+                yield f'-{line}'
+        for previous, block in pairs:
+            if previous is None:
+                for line in block.walk():
+                    yield f'+{line}'
+            elif previous.hash != block.hash:
+                yield f' {block.line}'
+                yield from self.changes(previous, block)
+
+    def unified(self):
+        if not self.is_diff():
+            return
+        yield '--- '
+        yield '+++ '
+        yield from self.changes(self.old, self.new)
@@ -1,22 +1,18 @@
 import logging
-from deepdiff import DeepDiff
 
-logger = logging.getLogger("netbox_config_backup")
+from netbox_config_backup.utils.diff import ConfigDiff, HierarchicalDiff
 
+logger = logging.getLogger("netbox_config_backup")
 
-class Differ(DeepDiff):
-    def is_diff(self):
-        if self.get('values_changed'):
-            return True
-        return False
 
+class Differ(ConfigDiff):
     def diff(self):
-        diff = self.get('values_changed', {}).get('root', {}).get('diff', '')
-        return diff
+        return '\n'.join(self.unified())
 
     def compare(self):
-        diff = self.diff()
-        return diff.splitlines()
+        for line in self.unified():
+            yield line.rstrip()
 
     def cisco_compare(self):
-        return self.compare()
+        for line in HierarchicalDiff(self.old, self.new).unified():
+            yield line.rstrip()
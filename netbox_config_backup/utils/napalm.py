@@ -6,7 +6,7 @@ from netbox.api.exceptions import ServiceUnavailable
 logger = logging.getLogger("netbox_config_backup")
 
 
-def napalm_init(device, ip=None, extra_args={}):
+def napalm_init(device, ip=None, extra_args={}, timeout=None):
     from netbox import settings
 
     username = settings.PLUGINS_CONFIG.get('netbox_napalm_plugin', {}).get(
@@ -15,9 +15,10 @@ def napalm_init(device, ip=None, extra_args={}):
     password = settings.PLUGINS_CONFIG.get('netbox_napalm_plugin', {}).get(
         'NAPALM_PASSWORD', None
     )
-    timeout = settings.PLUGINS_CONFIG.get('netbox_napalm_plugin', {}).get(
-        'NAPALM_TIMEOUT', None
-    )
+    if timeout is None:
+        timeout = settings.PLUGINS_CONFIG.get('netbox_napalm_plugin', {}).get(
+            'NAPALM_TIMEOUT', None
+        )
     optional_args = (
         settings.PLUGINS_CONFIG.get('netbox_napalm_plugin', {})
         .get('NAPALM_ARGS', [])
@@ -0,0 +1,183 @@
+import datetime
+import logging
+import re
+
+from django.utils import timezone
+
+__all__ = (
+    'TimestampParser',
+    'get_parsers',
+    'register_parser',
+)
+
+
+logger = logging.getLogger("netbox_config_backup")
+
+MONTHS = {
+    month: index
+    for index, month in enumerate(
+        ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'), start=1
+    )
+}
+
+# Cisco style "10:15:30 UTC Tue Mar 5 2024"
+CISCO_TIME = r'(?P<hours>\d+):(?P<minutes>\d+):(?P<seconds>\d+) \S+ \S+ (?P<month>\S+) (?P<day>\d+) (?P<year>\d+)'
+# ctime style "Tue Mar  5 10:15:30 2024"
+CTIME = r'(?P<month>[A-Za-z]+)\s+(?P<day>\d+) (?P<hours>\d+):(?P<minutes>\d+):(?P<seconds>\d+) (?P<year>\d+)'
+# ISO style "2024-03-05 10:15:30"
+ISO_TIME = r'(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2}) (?P<hours>\d+):(?P<minutes>\d+):(?P<seconds>\d+)'
+
+
+class TimestampParser:
+    """
+    Finds the line holding a configuration's last change (or save) time, either by its `marker` in the text of the
+    fetched `source` configuration (by default the configuration the time is for) or by running `command` on the
+    device, and turns it into a datetime with the precompiled `regex`, which must capture year, month, day, hours,
+    minutes and seconds.
+    """
+
+    def __init__(self, marker, command, regex, example=None, source=None):
+        self.marker = marker
+        self.command = command
+        self.regex = re.compile(regex) if isinstance(regex, str) else regex
+        self.example = example
+        self.source = source
+
+    def find(self, text):
+        """
+        Return the first line of `text` containing the marker, without splitting the whole text
+        """
+        index = text.find(self.marker) if text and self.marker else -1
+        if index < 0:
+            return None
+        start = text.rfind('\n', 0, index) + 1
+        end = text.find('\n', index)
+        return text[start:end if end >= 0 else len(text)]
+
+    def parse(self, line):
+        match = self.regex.search(line) if line else None
+        if match is None:
+            return None
+        groups = match.groupdict()
+        month = groups['month']
+        month = int(month) if month.isdigit() else MONTHS.get(month[:3].lower())
+        if month is None:
+            return None
+        try:
+            value = datetime.datetime(
+                int(groups['year']),
+                month,
+                int(groups['day']),
+                int(groups['hours']),
+                int(groups['minutes']),
+                int(groups['seconds']),
+            )
+        except ValueError:
+            return None
+        return timezone.make_aware(value)
+
+
+# Keyed by NAPALM driver and then file.  Times found in the running configuration are read from it even for the
+# startup configuration, which is then only fetched when it has changed: IOS notes when NVRAM was last written, and
+# platforms whose committed configuration is persistent (Junos, IOS-XR) report the last commit for both files
+PARSERS = {
+    'ios': {
+        'running': TimestampParser(
+            marker='! Last configuration change',
+            command='show running-config | inc ! Last configuration change',
+            regex=CISCO_TIME,
+            example='! Last configuration change at 10:15:30 UTC Tue Mar 5 2024 by admin',
+        ),
+        'startup': TimestampParser(
+            marker='! NVRAM config last updated',
+            command='show running-config | inc ! NVRAM config last updated',
+            regex=CISCO_TIME,
+            example='! NVRAM config last updated at 10:15:30 UTC Tue Mar 5 2024 by admin',
+            source='running',
+        ),
+    },
+    'nxos_ssh': {
+        'running': TimestampParser(
+            marker='!Running configuration last done at:',
+            command='show running-config | inc "!Running configuration last done at:"',
+            regex=CTIME,
+            example='!Running configuration last done at: Tue Mar  5 10:15:30 2024',
+        ),
+        'startup': TimestampParser(
+            marker='!Startup config saved at:',
+            command='show startup-config | inc "!Startup config saved at:"',
+            regex=CTIME,
+            example='!Startup config saved at: Tue Mar  5 10:15:30 2024',
+        ),
+    },
+    'eos': {
+        'startup': TimestampParser(
+            marker='! Startup-config last modified at',
+            command='show startup-config | include Startup-config last modified',
+            regex=CTIME,
+            example='! Startup-config last modified at  Tue Mar  5 10:15:30 2024 by admin',
+        ),
+    },
+    'junos': {
+        'running': TimestampParser(
+            marker='## Last commit:',
+            command='show configuration | match "Last commit"',
+            regex=ISO_TIME,
+            example='## Last commit: 2024-03-05 10:15:30 UTC by admin',
+        ),
+        'startup': TimestampParser(
+            marker='## Last commit:',
+            command='show configuration | match "Last commit"',
+            regex=ISO_TIME,
+            example='## Last commit: 2024-03-05 10:15:30 UTC by admin',
+            source='running',
+        ),
+    },
+    'iosxr': {
+        'running': TimestampParser(
+            marker='!! Last configuration change',
+            command='show running-config | include Last configuration change',
+            regex=CTIME,
+            example='!! Last configuration change at Tue Mar  5 10:15:30 2024 by admin',
+        ),
+        'startup': TimestampParser(
+            marker='!! Last configuration change',
+            command='show running-config | include Last configuration change',
+            regex=CTIME,
+            example='!! Last configuration change at Tue Mar  5 10:15:30 2024 by admin',
+            source='running',
+        ),
+    },
+}
+PARSERS['nxos'] = PARSERS['nxos_ssh']
+
+configured = False
+
+
+def register_parser(driver, file, marker, command, regex, example=None, source=None):
+    """
+    Add or replace the parser for a NAPALM driver's running or startup configuration
+    """
+    PARSERS.setdefault(driver, {})[file] = TimestampParser(
+        marker=marker, command=command, regex=regex, example=example, source=source
+    )
+
+
+def get_parsers(driver):
+    """
+    Return the parsers for a NAPALM driver, keyed by file.  Parsers from the 'status_parsers' plugin setting, in the
+    form {driver: {file: {'marker': ..., 'command': ..., 'regex': ..., 'source': ...}}}, are registered on first use.
+    """
+    global configured
+    if not configured:
+        from netbox import settings
+
+        configured = True
+        extra = settings.PLUGINS_CONFIG.get('netbox_config_backup', {}).get('status_parsers', {})
+        for name, files in extra.items():
+            for file, parser in files.items():
+                try:
+                    register_parser(name, file, **parser)
+                except (TypeError, re.error) as e:
+                    logger.error(f'Invalid config status parser for {name} {file}: {e}')
+    return PARSERS.get(driver, {})
@@ -7,6 +7,7 @@ logger = logging.getLogger("netbox_config_backup")
 
 
 def can_backup(backup):
+    # Kept in step with BackupQuerySet.backupable(), which applies the same checks in SQL
     logger.debug(f'Checking backup suitability for {backup}')
     if backup.device is None:
         logger.info(f'No device for {backup}')
@@ -243,7 +243,7 @@ class ConfigView(ObjectView):
 
         previous = None
         if current is not None and current.old is not None:
-            previous = backup.changes.filter(file__type=current.file.type, commit__time__lt=current.commit.time).last()
+            previous = current.previous
 
         return render(
             request,
@@ -298,6 +298,7 @@ class ComplianceView(ObjectView):
         if backup.device and backup.device.platform.napalm.napalm_driver in [
             'ios',
             'nxos',
+            'nxos_ssh',
         ]:
             differ = Differ(rendered, current)
             diff = differ.cisco_compare()
@@ -305,8 +306,6 @@ class ComplianceView(ObjectView):
             differ = Differ(rendered, current)
             diff = differ.compare()
 
-        for idx, line in enumerate(diff):
-            diff[idx] = line.rstrip()
         return diff
 
     def get(self, request, pk, current=None, previous=None):
@@ -377,11 +376,7 @@ class DiffView(ObjectView):
         if previous:
             previous = get_object_or_404(BackupCommitTreeChange.objects.all(), pk=previous)
         else:
-            previous = BackupCommitTreeChange.objects.filter(
-                backup=backup,
-                file__type=current.file.type,
-                commit__time__lt=current.commit.time,
-            ).last()
+            previous = current.previous
             if not previous:
                 raise Http404("No Previous Commit")
 
@@ -393,6 +388,7 @@ class DiffView(ObjectView):
         if backup.device and backup.device.platform.napalm.napalm_driver in [
             'ios',
             'nxos',
+            'nxos_ssh',
         ]:
             new = repo.read(current.file.path, current_sha)
             old = repo.read(previous.file.path, previous_sha)
@@ -404,9 +400,6 @@ class DiffView(ObjectView):
             differ = Differ(old, new)
             diff = differ.compare()
 
-        for idx, line in enumerate(diff):
-            diff[idx] = line.rstrip()
-
         return render(
             request,
             'netbox_config_backup/diff.html',